@@ -0,0 +1,41 @@
+"""Cost of the in-memory replay check per login.
+
+Adds unique assertion IDs, each valid for 5 minutes, at 100 logins per simulated
+second, so old buckets expire along the way as they do on a busy hub
+
+    python benchmarks/bench_idstore.py [logins]
+"""
+from unittest import mock
+import asyncio
+import sys
+import time
+
+from jupyterhub_saml_auth import idstore
+
+
+async def run(store: idstore.InMemoryIdStore, logins: int, clock: dict) -> float:
+    start = clock["now"]
+    began = time.perf_counter()
+    for i in range(logins):
+        clock["now"] = start + i / 100
+        await store.add(f"_{i:040x}", clock["now"] + 300)
+    return time.perf_counter() - began
+
+
+def main():
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    clock = {"now": time.time()}
+    store = idstore.InMemoryIdStore()
+
+    # simulated time, only while the store runs
+    with mock.patch.object(idstore.time, "time", lambda: clock["now"]):
+        elapsed = asyncio.run(run(store, logins, clock))
+    print(
+        f"{logins} logins: {elapsed * 1e6 / logins:.2f} us/login, "
+        f"{len(store)} IDs kept"
+    )
+
+
+if __name__ == "__main__":
+    main()
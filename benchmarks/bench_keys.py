@@ -0,0 +1,65 @@
+"""Cost of verifying a response signature with IdP key rollover configured.
+
+python3-saml tries every x509certMulti signing certificate until one verifies the
+signature. With the KeyIndex the certificate named in the signature's KeyInfo is the
+only one tried. The current certificate is listed last, as during a rollover
+
+    python benchmarks/bench_keys.py [iterations]
+"""
+import json
+import os
+import sys
+import timeit
+
+from onelogin.saml2.settings import OneLogin_Saml2_Settings
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+
+from jupyterhub_saml_auth import keys
+
+SETTINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "etc")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    with open(os.path.join(SETTINGS_PATH, "settings.json")) as f:
+        settings_dict = json.load(f)
+    old_cert = OneLogin_Saml2_Utils.format_cert(settings_dict["idp"]["x509cert"])
+    # the SP key pair signs the response, so its certificate is the current one
+    cert = OneLogin_Saml2_Utils.format_cert(settings_dict["sp"]["x509cert"])
+    key = OneLogin_Saml2_Utils.format_private_key(settings_dict["sp"]["privateKey"])
+    settings_dict["idp"]["x509certMulti"] = {"signing": [old_cert, old_cert, cert]}
+    saml_settings = OneLogin_Saml2_Settings(settings_dict)
+
+    attributes = "".join(
+        f'<saml:Attribute Name="memberOf"><saml:AttributeValue>group{i}'
+        f"</saml:AttributeValue></saml:Attribute>"
+        for i in range(200)
+    )
+    xml = (
+        '<samlp:Response xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" '
+        'xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="_response1">'
+        f"<saml:Issuer>idp</saml:Issuer>{attributes}</samlp:Response>"
+    )
+    signed = OneLogin_Saml2_Utils.add_sign(xml, key, cert)
+    certs = [settings_dict["sp"]["x509cert"]]
+
+    def verify(verifying_settings):
+        multicerts = verifying_settings.get_idp_data().get("x509certMulti")
+        assert OneLogin_Saml2_Utils.validate_sign(
+            signed,
+            verifying_settings.get_idp_cert(),
+            multicerts=multicerts["signing"] if multicerts else None,
+        )
+
+    cases = {
+        "all certs": lambda: verify(saml_settings),
+        "indexed": lambda: verify(keys.index(saml_settings).find(certs)),
+    }
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=iterations, repeat=3))
+        print(f"{name:>10}: {seconds / iterations * 1e6:8.1f} us/response")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Cost of rejecting junk posted to /acs.
+
+Times the prefilter on a ~60 KB response from the wrong issuer (decoded and
+scanned), the same response posted again (hashed only), and an oversized post, next
+to parsing the XML the way python3-saml starts processing a response
+
+    python benchmarks/bench_prefilter.py [iterations]
+"""
+import base64
+import sys
+import timeit
+
+from onelogin.saml2.xml_utils import OneLogin_Saml2_XML
+
+from jupyterhub_saml_auth.prefilter import Prefilter, PrefilterError
+
+ACS_URL = "https://hub.example.com/hub/acs"
+IDP = "https://idp.example.com/metadata"
+
+
+def response(issuer: str) -> str:
+    attributes = "".join(
+        f'<saml:Attribute Name="memberOf"><saml:AttributeValue>'
+        f"cn=course-{i:04d},ou=groups,dc=university,dc=edu"
+        f"</saml:AttributeValue></saml:Attribute>"
+        for i in range(800)
+    )
+    xml = (
+        '<samlp:Response xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" '
+        'xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" '
+        f'ID="_response1" Destination="{ACS_URL}">'
+        f"<saml:Issuer>{issuer}</saml:Issuer><saml:Assertion>{attributes}"
+        "</saml:Assertion></samlp:Response>"
+    )
+    return base64.b64encode(xml.encode()).decode()
+
+
+def reject(prefilter: Prefilter, saml_response: str):
+    try:
+        prefilter.check(saml_response, IDP, ACS_URL)
+    except PrefilterError:
+        pass
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    junk = response("https://evil.example.com")
+    oversized = "A" * (1024 * 1024)
+
+    cases = {
+        "parse XML": lambda: OneLogin_Saml2_XML.to_etree(base64.b64decode(junk)),
+        "prefilter": lambda: reject(Prefilter(), junk),
+        "duplicate": lambda: reject(duplicates, junk),
+        "oversized": lambda: reject(duplicates, oversized),
+    }
+    duplicates = Prefilter()
+    reject(duplicates, junk)
+
+    print(f"response is {len(junk)} characters")
+    for name, case in cases.items():
+        seconds = timeit.timeit(case, number=iterations)
+        print(f"{name:>10}: {seconds * 1e6 / iterations:8.1f} us/post")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Size and encode/decode time of a session entry with a large attribute set.
+
+"redisjson" is the JSON document the RedisJSON path sends to redis. The others are
+the values stored as plain redis strings with the serializer cache_spec option
+
+    python benchmarks/bench_serializers.py [number of groups] [iterations]
+"""
+import json
+import sys
+import timeit
+
+from jupyterhub_saml_auth import serializers
+from jupyterhub_saml_auth.cache import SessionEntry
+
+
+def session_entry(groups: int) -> SessionEntry:
+    return SessionEntry(
+        name_id="student123@university.edu",
+        saml_attrs={
+            "email": ["student123@university.edu"],
+            "eduPersonAffiliation": ["student", "member"],
+            "department": ["Computer Science and Engineering"],
+            "memberOf": [
+                f"cn=course-{i:05d},ou=groups,dc=university,dc=edu" for i in range(groups)
+            ],
+        },
+        session_index="_be9967abd904ddcae3c0eb4189adbe3f71e327cf93",
+        session_expiration=1767225600,
+    )
+
+
+def candidates():
+    yield "redisjson", json.dumps, json.loads
+    for name in serializers.serializer_map:
+        for compression in (None, "zlib", "zstd"):
+            try:
+                serializer = serializers.create(name, compression)
+            except serializers.SerializerError:
+                continue
+            label = name if compression is None else f"{name}+{compression}"
+            yield label, serializer.dumps, serializer.loads
+
+
+def main():
+    groups = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    obj = session_entry(groups).to_dict()
+
+    print(f"{'':>14} {'bytes':>8} {'encode us':>10} {'decode us':>10}")
+    for label, dumps, loads in candidates():
+        payload = dumps(obj)
+        encode = min(timeit.repeat(lambda: dumps(obj), number=iterations, repeat=5))
+        decode = min(timeit.repeat(lambda: loads(payload), number=iterations, repeat=5))
+        print(
+            f"{label:>14} {len(payload):>8} "
+            f"{encode / iterations * 1e6:>10.1f} {decode / iterations * 1e6:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Memory held by an in-memory session table.
+
+Compares the previous dataclass SessionEntry, which kept its own copy of every
+attribute list, with the slotted and interned SessionEntry. Attribute values are
+built as fresh string objects per session, the way python3-saml hands them over
+
+    python benchmarks/bench_session_entry.py [sessions]
+"""
+from dataclasses import dataclass
+import random
+import sys
+import tracemalloc
+
+from jupyterhub_saml_auth.cache import SessionEntry
+
+
+@dataclass
+class DataclassSessionEntry:
+    name_id: str = None
+    saml_attrs: dict = None
+    session_index: str = None
+    session_expiration: int = None
+
+
+AFFILIATIONS = [["student", "member"], ["staff", "member"], ["faculty", "member"]]
+DEPARTMENTS = [f"Department {i}" for i in range(40)]
+COURSES = [f"cn=course-{i:04d},ou=groups,dc=university,dc=edu" for i in range(300)]
+
+
+def fresh(value: str) -> str:
+    # a new, equal string object
+    return "".join(list(value))
+
+
+def attributes(rng: random.Random, user: int) -> dict:
+    courses = sorted(rng.sample(range(len(COURSES)), 5))
+    return {
+        fresh("email"): [f"user{user}@university.edu"],
+        fresh("eduPersonAffiliation"): [fresh(a) for a in rng.choice(AFFILIATIONS)],
+        fresh("department"): [fresh(rng.choice(DEPARTMENTS))],
+        fresh("memberOf"): [fresh(COURSES[c]) for c in courses],
+    }
+
+
+def measure(entry_cls, sessions: int) -> int:
+    rng = random.Random(0)
+    tracemalloc.start()
+    table = {
+        f"user{i}": entry_cls(
+            name_id=f"user{i}@university.edu",
+            saml_attrs=attributes(rng, i),
+            session_index=f"_{rng.getrandbits(160):040x}",
+            session_expiration=1767225600 + i,
+        )
+        for i in range(sessions)
+    }
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del table
+    return current
+
+
+def main():
+    sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    for name, entry_cls in (
+        ("dataclass", DataclassSessionEntry),
+        ("interned", SessionEntry),
+    ):
+        used = measure(entry_cls, sessions)
+        print(
+            f"{name:>10}: {used / 2**20:8.1f} MiB total, "
+            f"{used / sessions:6.0f} bytes/session for {sessions} sessions"
+        )
+
+
+if __name__ == "__main__":
+    main()
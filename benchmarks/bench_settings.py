@@ -0,0 +1,45 @@
+"""Per-request cost of building the python3-saml auth object.
+
+Compares re-reading settings.json/advanced_settings.json on every request
+(the old behavior) with reusing the parsed settings from jupyterhub_saml_auth.settings
+
+    python benchmarks/bench_settings.py [settings_path] [iterations]
+"""
+import os
+import sys
+import timeit
+
+from onelogin.saml2.auth import OneLogin_Saml2_Auth
+
+from jupyterhub_saml_auth import settings
+
+SETTINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "etc")
+
+request = {
+    "https": "off",
+    "http_host": "localhost",
+    "script_name": "/hub/saml_login",
+    "server_port": "8000",
+    "get_data": {},
+    "post_data": {},
+    "query_string": "",
+}
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else SETTINGS_PATH
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    def uncached():
+        OneLogin_Saml2_Auth(request, custom_base_path=path)
+
+    def cached():
+        OneLogin_Saml2_Auth(request, old_settings=settings.get(path))
+
+    for name, fn in (("uncached", uncached), ("cached", cached)):
+        seconds = min(timeit.repeat(fn, number=iterations, repeat=5))
+        print(f"{name:>10}: {seconds / iterations * 1e6:8.1f} us/request")
+
+
+if __name__ == "__main__":
+    main()
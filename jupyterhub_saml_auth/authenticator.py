@@ -1,6 +1,7 @@
 from jupyterhub.auth import Authenticator
 from jupyterhub.utils import url_path_join
-from traitlets import Unicode, validate, Set, Callable, Dict, Bool
+from traitlets import Unicode, validate, Set, Callable, Dict, Bool, Float, Integer, List
+from concurrent.futures import ThreadPoolExecutor
 import os
 
 from .handlers import (
@@ -8,8 +9,15 @@ from .handlers import (
     MetadataHandler,
     SamlLoginHandler,
     SamlLogoutHandler,
+    SamlSLOHandler,
+    SessionRevocationHandler,
 )
 from . import cache
+from . import idp_metadata
+from . import idstore
+from . import prefilter
+from . import settings
+from . import tenants
 
 
 class SAMLAuthenticator(Authenticator):
@@ -18,6 +26,8 @@ class SAMLAuthenticator(Authenticator):
     metadata_handler = MetadataHandler
     login_handler = SamlLoginHandler
     logout_handler = SamlLogoutHandler
+    slo_handler = SamlSLOHandler
+    session_revocation_handler = SessionRevocationHandler
 
     session_cookie_names = Set(
         help="""
@@ -37,13 +47,163 @@ class SAMLAuthenticator(Authenticator):
         """,
     )
 
+    tenant_settings_paths = Dict(
+        Unicode(),
+        key_trait=Unicode(),
+        config=True,
+        help="""
+        Settings directories of further IdPs by tenant name, e.g.
+        {"campus-a": "/etc/saml/campus-a"}. A request goes to the tenant of its host
+        (see tenant_hosts), the tenant of a /saml/<tenant>/ endpoint prefix such as
+        /hub/saml/campus-a/acs, the tenant named by the tenant_query_param argument of
+        /hub/saml_login, or the tenant the user logged in with last. Other requests
+        use saml_settings_path. A tenant's settings are loaded when it is first used,
+        and its sessions are kept in their own namespace of the session cache.
+        """,
+    )
+
+    tenant_hosts = Dict(
+        Unicode(),
+        key_trait=Unicode(),
+        config=True,
+        help="""
+        Tenants by host name, for hubs served under a host name per tenant.
+        """,
+    )
+
+    tenant_query_param = Unicode(
+        "idp",
+        config=True,
+        help="""
+        Name of the /hub/saml_login argument choosing the tenant (IdP discovery).
+        """,
+    )
+
+    tenant_username_prefix = Unicode(
+        "",
+        config=True,
+        help="""
+        Prefix of the hub usernames of a tenant's users, formatted with {tenant},
+        e.g. "{tenant}-". Every IdP logs users into the same hub usernames, so without
+        a prefix any tenant's IdP can log a user in as a hub user of another tenant.
+        Users logging in through saml_settings_path aren't prefixed.
+        """,
+    )
+
+    saml_settings_reload_interval = Float(
+        0,
+        config=True,
+        help="""
+        Seconds between checks of saml_settings_path for changed settings or
+        certificates. Changed settings are parsed and validated in the background
+        and swapped in without a restart; if they are invalid the previous settings
+        keep serving. Set to 0 to disable reloading.
+        """,
+    )
+
+    idp_metadata_url = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        help="""
+        http(s) URL or file path of the IdP's metadata. If set, the metadata is
+        fetched in the background every idp_metadata_refresh_interval seconds and
+        its IdP endpoints and certificates take precedence over the idp section of
+        settings.json. If it can't be fetched or is invalid, the last good copy
+        keeps serving.
+        """,
+    )
+
+    idp_metadata_refresh_interval = Float(
+        3600,
+        config=True,
+        help="""
+        Seconds between checks of idp_metadata_url. URLs are fetched with
+        conditional GETs, files are only read when they change.
+        """,
+    )
+
+    idp_metadata_entity_id = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        help="""
+        entityID of the IdP to use when idp_metadata_url describes several.
+        """,
+    )
+
+    idp_metadata_signing_cert = Unicode(
+        None,
+        allow_none=True,
+        config=True,
+        help="""
+        Certificate (PEM or base64) the metadata at idp_metadata_url must be signed
+        with. Unsigned metadata is accepted if this isn't set.
+        """,
+    )
+
     cache_spec = Dict(
         {"type": "disabled", "client": None, "client_kwargs": None},
         config=True,
         help="""
         Specifications for the session cache. Defaults to disabled.
 
-        Allowed values for type = {'in-memory', 'disabled', 'redis'}
+        Allowed values for type = {'in-memory', 'disabled', 'sqlite', 'redis',
+        'async-redis', 'tiered', 'auth-state'}
+        """,
+    )
+
+    replay_cache_spec = Dict(
+        {"type": "in-memory"},
+        config=True,
+        help="""
+        Specifications for the store of consumed assertion IDs, which rejects a SAML
+        response that is posted to /acs a second time. Use redis when several hubs
+        share the IdP's responses.
+
+        Allowed values for type = {'in-memory', 'redis', 'disabled'}
+        """,
+    )
+
+    request_id_store_spec = Dict(
+        {"type": "in-memory", "default_ttl": 600, "max_entries": 100000},
+        config=True,
+        help="""
+        Specifications for the store of outstanding AuthnRequest IDs. Every login
+        records the ID of its AuthnRequest for default_ttl seconds, and a response
+        posted to /acs must answer one of them (InResponseTo) that hasn't been used
+        yet. Use redis when several hubs share the IdP's responses.
+
+        Allowed values for type = {'in-memory', 'redis', 'disabled'}
+        """,
+    )
+
+    allow_unsolicited_responses = Bool(
+        True,
+        config=True,
+        help="""
+        Accept SAML responses without InResponseTo, i.e. logins started at the IdP.
+        Only has an effect if request_id_store_spec isn't disabled.
+        """,
+    )
+
+    cached_attributes = List(
+        Unicode(),
+        default_value=None,
+        allow_none=True,
+        config=True,
+        help="""
+        Names of the SAML attributes stored in the session cache. None stores every
+        attribute sent by the IdP. extract_username always receives all attributes.
+        """,
+    )
+
+    cached_attribute_limits = Dict(
+        {},
+        config=True,
+        help="""
+        Maximum number of values stored in the session cache per attribute, e.g.
+        {"memberOf": 50}. Attributes not listed keep all of their values.
         """,
     )
 
@@ -114,6 +274,72 @@ class SAMLAuthenticator(Authenticator):
         """,
     )
 
+    acs_executor_workers = Integer(
+        4,
+        config=True,
+        help="""
+        Number of threads used to process SAML responses posted to /acs. Parsing,
+        signature verification and decryption run on these threads instead of
+        blocking the hub's event loop.
+        """,
+    )
+
+    acs_max_pending = Integer(
+        0,
+        config=True,
+        help="""
+        Maximum number of SAML responses that may be queued or processing at once.
+        Responses beyond this limit are rejected with a 503. 0 means unlimited.
+        """,
+    )
+
+    acs_prefilter = Bool(
+        True,
+        config=True,
+        help="""
+        Check the size, base64 encoding, Issuer and Destination of responses posted
+        to /acs before their XML is parsed and their signature verified, and reject
+        responses equal to a recently rejected one. Rejected responses get a 400.
+        """,
+    )
+
+    acs_max_response_size = Integer(
+        512 * 1024,
+        config=True,
+        help="""
+        Maximum length of the base64 encoded SAMLResponse posted to /acs, if
+        acs_prefilter is enabled.
+        """,
+    )
+
+    acs_rejected_responses = Integer(
+        1024,
+        config=True,
+        help="""
+        Number of recently rejected responses remembered by acs_prefilter. A response
+        equal to one of them is rejected after hashing it.
+        """,
+    )
+
+    metadata_max_age = Integer(
+        3600,
+        config=True,
+        help="""
+        Seconds IdPs and federation aggregators may cache the SP metadata served at
+        /metadata (the Cache-Control max-age). Changed settings are served once the
+        cached copy expires.
+        """,
+    )
+
+    metadata_gzip = Bool(
+        True,
+        config=True,
+        help="""
+        Keep a gzip compressed copy of the SP metadata, served to clients that accept
+        it.
+        """,
+    )
+
     @validate("saml_settings_path")
     def _valid_saml_settings_path(self, proposed):
         proposed_path = proposed["value"]
@@ -149,18 +375,69 @@ class SAMLAuthenticator(Authenticator):
         return url_path_join(base_url, "saml_login")
 
     def authenticate(self, handler, data):
-        return data["name"]
+        if data.get("auth_state") is None:
+            return data["name"]
+
+        return {"name": data["name"], "auth_state": data["auth_state"]}
+
+    def _tenant_router(self):
+        if not self.tenant_settings_paths:
+            return None
+
+        for path in self.tenant_settings_paths.values():
+            self._saml_settings_path_exists(path)
+            self._settings_files_exist(path)
+        return tenants.TenantRouter(
+            self.tenant_settings_paths,
+            hosts=self.tenant_hosts,
+            query_param=self.tenant_query_param,
+        )
 
     def _configure_handlers(self):
+        tenant_router = self._tenant_router()
+        for handler in (
+            self.login_handler,
+            self.metadata_handler,
+            self.acs_handler,
+            self.logout_handler,
+            self.slo_handler,
+            self.session_revocation_handler,
+        ):
+            handler.tenant_router = tenant_router
+
         self.login_handler.saml_settings_path = self.saml_settings_path
         self.login_handler.https_override = self.https_override
 
         self.metadata_handler.saml_settings_path = self.saml_settings_path
         self.metadata_handler.https_override = self.https_override
+        self.metadata_handler.max_age = self.metadata_max_age
+        self.metadata_handler.compress = self.metadata_gzip
 
         self.acs_handler.saml_settings_path = self.saml_settings_path
         self.acs_handler.extract_username = self.extract_username
+        self.acs_handler.tenant_username_prefix = self.tenant_username_prefix
         self.acs_handler.https_override = self.https_override
+        self.acs_handler.executor = ThreadPoolExecutor(
+            max_workers=self.acs_executor_workers, thread_name_prefix="saml-acs"
+        )
+        self.acs_handler.max_pending = self.acs_max_pending
+        self.acs_handler.cached_attributes = self.cached_attributes
+        self.acs_handler.cached_attribute_limits = self.cached_attribute_limits
+        self.acs_handler.replay_store = idstore.create(self.replay_cache_spec)
+        self.acs_handler.allow_unsolicited = self.allow_unsolicited_responses
+        self.acs_handler.response_prefilter = None
+        if self.acs_prefilter:
+            self.acs_handler.response_prefilter = prefilter.Prefilter(
+                max_size=self.acs_max_response_size,
+                rejected_entries=self.acs_rejected_responses,
+            )
+
+        request_id_store_spec = dict(self.request_id_store_spec)
+        if request_id_store_spec.get("type") == "redis":
+            request_id_store_spec.setdefault("prefix", "jupyterhub_saml_auth:request")
+        request_store = idstore.create(request_id_store_spec)
+        self.login_handler.request_store = request_store
+        self.acs_handler.request_store = request_store
 
         self.logout_handler.saml_settings_path = self.saml_settings_path
         self.logout_handler.logout_kwargs = self.logout_kwargs
@@ -169,7 +446,10 @@ class SAMLAuthenticator(Authenticator):
         self.logout_handler.unencrypted_logout = self.unencrypted_logout
         self.logout_handler.https_override = self.https_override
 
-    def _setup_cache(self):
+        self.slo_handler.saml_settings_path = self.saml_settings_path
+        self.slo_handler.https_override = self.https_override
+
+    def _setup_cache(self, app=None):
         try:
             # test that the cache has been registered
             cache.get()
@@ -179,13 +459,58 @@ class SAMLAuthenticator(Authenticator):
 
             cache.register(created_cache)
 
+            # sessions from a previous run are restored on first use
+            if isinstance(created_cache, cache.InMemoryCache):
+                created_cache.start_snapshots()
+
+        session_cache = cache.get_async()
+        if session_cache.uses_auth_state:
+            if not self.enable_auth_state:
+                raise cache.CacheError(
+                    "cache_spec type = auth-state requires c.Authenticator.enable_auth_state = True"
+                )
+            if app is not None:
+                session_cache.users = app.users
+
+    def _load_settings(self):
+        # parse and validate the saml settings once at startup so that a broken
+        # configuration fails early instead of on the first login
+        settings.get(self.saml_settings_path)
+
+        if self.saml_settings_reload_interval > 0:
+            settings.watch(self.saml_settings_path, self.saml_settings_reload_interval)
+            # tenant settings are loaded lazily, their watchers wait until then
+            for path in self.tenant_settings_paths.values():
+                settings.watch(path, self.saml_settings_reload_interval)
+
+        if self.idp_metadata_url:
+            idp_metadata.watch(
+                self.saml_settings_path,
+                self.idp_metadata_url,
+                self.idp_metadata_refresh_interval,
+                entity_id=self.idp_metadata_entity_id,
+                signing_cert=self.idp_metadata_signing_cert,
+            )
+
     def get_handlers(self, app):
-        self._setup_cache()
+        self._setup_cache(app)
         self._configure_handlers()
+        self._load_settings()
 
-        return [
+        handlers = [
             (r"/saml_login", self.login_handler),
             (r"/metadata", self.metadata_handler),
             (r"/acs", self.acs_handler),
             (r"/logout", self.logout_handler),
+            (r"/slo", self.slo_handler),
+            (r"/api/saml/sessions/revoke", self.session_revocation_handler),
         ]
+        if self.tenant_settings_paths:
+            # the same endpoints per tenant, e.g. /saml/campus-a/acs
+            handlers += [
+                (r"/saml/[^/]+/saml_login", self.login_handler),
+                (r"/saml/[^/]+/metadata", self.metadata_handler),
+                (r"/saml/[^/]+/acs", self.acs_handler),
+                (r"/saml/[^/]+/slo", self.slo_handler),
+            ]
+        return handlers
@@ -1,28 +1,201 @@
 from abc import ABCMeta, abstractmethod, abstractproperty
-from dataclasses import dataclass
-from typing import Any, Dict
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Union
+import asyncio
+import atexit
+import heapq
+import mmap
+import os
+import queue
+import sqlite3
+import struct
+import threading
+import time
+import uuid
 
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.log import app_log
 from redis.commands.json.path import Path as RedisJsonPath
+from redis.exceptions import ResponseError, WatchError
 from redis import Redis
+import redis.asyncio
+
+from . import redis_clients
+from . import serializers
 
 
 __session_cache = None
+__async_session_cache = None
+__namespaced_caches: Dict[str, "NamespacedCache"] = {}
 
 
 class CacheError(Exception):
     pass
 
 
-@dataclass
+def _attribute_values(saml_attrs: Optional[dict], attribute: str) -> tuple:
+    values = (saml_attrs or {}).get(attribute)
+    if values is None:
+        return ()
+    if isinstance(values, (list, tuple)):
+        return tuple(values)
+    return (values,)
+
+
+def _check_indexed(indexed_attributes: tuple, attribute: Optional[str]):
+    if attribute is not None and attribute not in indexed_attributes:
+        raise CacheError(
+            f"sessions can't be searched by attribute = {attribute}. "
+            f"Indexed attributes = {list(indexed_attributes)}"
+        )
+
+
+class InternTable:
+    """Shared table of SAML attribute names and values.
+
+    Many users share attribute values (affiliation, department, group memberships),
+    so every session holding its own copy of those strings wastes memory. Interning
+    maps equal values to a single object. Once the table holds max_size values it is
+    cleared, which drops values only held by sessions that are gone. Entries keep the
+    objects they already reference, and frequent values are quickly shared again.
+    """
+
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self._table = {}
+
+    def __len__(self):
+        return len(self._table)
+
+    def intern(self, value):
+        try:
+            return self._table[value]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable, can't be shared
+            return value
+
+        if len(self._table) >= self.max_size:
+            self._table.clear()
+        return self._table.setdefault(value, value)
+
+    def intern_attrs(self, saml_attrs: Optional[dict]) -> Optional[dict]:
+        """Intern names and values of an attribute map. Multi-valued attributes are
+        stored as tuples, so that identical value lists are shared as well"""
+        if saml_attrs is None:
+            return None
+
+        interned = {}
+        for name, values in saml_attrs.items():
+            if isinstance(values, (list, tuple)):
+                values = self.intern(tuple(self.intern(value) for value in values))
+            else:
+                values = self.intern(values)
+            interned[self.intern(name)] = values
+        return interned
+
+
+attribute_intern_table = InternTable()
+
+
 class SessionEntry:
     """
     Session entry for user.
+
+    Uses __slots__ and interns saml_attrs through attribute_intern_table, since a cache
+    can hold a very large number of them. Multi-valued attributes are stored as tuples.
+    Use to_dict(), or vars(entry), to export an entry with lists as multi-valued
+    attributes.
     """
 
-    name_id: str = None
-    saml_attrs: dict = None
-    session_index: str = None
+    __slots__ = (
+        "name_id",
+        "_saml_attrs",
+        "session_index",
+        "session_expiration",
+        "created_at",
+    )
+
+    fields = (
+        "name_id",
+        "saml_attrs",
+        "session_index",
+        "session_expiration",
+        "created_at",
+    )
+
+    def __init__(
+        self,
+        name_id: str = None,
+        saml_attrs: dict = None,
+        session_index: str = None,
+        session_expiration: int = None,
+        created_at: int = None,
+    ):
+        self.name_id = name_id
+        self.saml_attrs = saml_attrs
+        self.session_index = session_index
+        # unix timestamp of the assertion's SessionNotOnOrAfter, if the IdP sent one
+        self.session_expiration = session_expiration
+        # unix timestamp of the login that created the session
+        self.created_at = created_at
+
+    @property
+    def saml_attrs(self) -> Optional[dict]:
+        return self._saml_attrs
+
+    @saml_attrs.setter
+    def saml_attrs(self, saml_attrs: Optional[dict]):
+        self._saml_attrs = attribute_intern_table.intern_attrs(saml_attrs)
+
+    def to_dict(self) -> dict:
+        entry = {field: getattr(self, field) for field in self.fields}
+        if self.saml_attrs is not None:
+            entry["saml_attrs"] = {
+                name: list(values) if isinstance(values, tuple) else values
+                for name, values in self.saml_attrs.items()
+            }
+        return entry
+
+    @property
+    def __dict__(self) -> dict:
+        # keeps vars(entry) working for code written before entries had __slots__
+        return self.to_dict()
+
+    def __eq__(self, other):
+        if not isinstance(other, SessionEntry):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.fields)
+        return f"SessionEntry({fields})"
+
+    def matches(self, name_id: Optional[str] = None, session_index: Optional[str] = None):
+        """Whether this is a stored session with the given name_id and session_index.
+        Either may be None to match any value"""
+        return (
+            self.name_id is not None
+            and (name_id is None or self.name_id == name_id)
+            and (session_index is None or self.session_index == session_index)
+        )
+
+    def has_attribute(self, attribute: str, value: str) -> bool:
+        """Whether saml_attrs[attribute] is or contains value"""
+        values = (self.saml_attrs or {}).get(attribute)
+        if isinstance(values, (list, tuple)):
+            return value in values
+        return values == value
+
+    def created_before(self, timestamp: Optional[float]) -> bool:
+        """Whether the session was created before timestamp. Sessions without a
+        created_at are older than any timestamp. None matches every session"""
+        return (
+            timestamp is None or self.created_at is None or self.created_at < timestamp
+        )
 
 
 class Cache(metaclass=ABCMeta):
@@ -32,6 +205,15 @@ class Cache(metaclass=ABCMeta):
     via the current_user property on the BaseHandler parent class
     """
 
+    # set to True for caches whose operations do network or disk I/O. When used through
+    # SyncCacheAdapter, their operations run on an executor thread instead of the event loop
+    blocking = False
+
+    async def prepare(self):
+        """Awaited by SyncCacheAdapter before every operation, for caches that have to
+        load state before serving. It must be cheap once the state is loaded."""
+        pass
+
     @abstractmethod
     def upsert(self, username: str, session_entry: SessionEntry):
         pass
@@ -44,6 +226,54 @@ class Cache(metaclass=ABCMeta):
     def remove(self, username: str):
         pass
 
+    def pop(self, username: str, include_attrs: bool = True) -> SessionEntry:
+        """Remove the session entry for username and return it. Caches should override
+        this with an atomic version, the default is a get followed by a remove.
+
+        With include_attrs=False, caches may leave saml_attrs unset and skip fetching
+        them, which is all logout needs.
+        """
+        session_entry = self.get(username)
+        self.remove(username)
+        return session_entry
+
+    def find_username(
+        self, name_id: Optional[str] = None, session_index: Optional[str] = None
+    ) -> Optional[str]:
+        """Username whose session has the given session_index, or the given name_id if
+        session_index is None. Used for IdP initiated logout, which only identifies the
+        session. Caches keep an index for this instead of scanning their sessions.
+
+        Returns None if no session matches. The default is for caches that can't look
+        sessions up by anything but username.
+        """
+        return None
+
+    def find_usernames(
+        self,
+        attribute: Optional[str] = None,
+        value: Optional[str] = None,
+        created_before: Optional[float] = None,
+    ) -> list:
+        """Usernames of the sessions whose saml_attrs[attribute] contains value and that
+        were created before the created_before timestamp. Either predicate may be None.
+        attribute has to be one of the cache's indexed_attributes.
+
+        The default is for caches that can't search their sessions, it finds nothing.
+        """
+        return []
+
+    def remove_many(self, usernames: list) -> list:
+        """Remove the sessions of usernames and return the usernames that had one.
+        Caches should override this with a batched version, the default pops each
+        session in turn.
+        """
+        return [
+            username
+            for username in usernames
+            if self.pop(username, include_attrs=False).name_id is not None
+        ]
+
     @property
     @abstractmethod
     def client_required(self) -> bool:
@@ -51,33 +281,420 @@ class Cache(metaclass=ABCMeta):
 
 
 class InMemoryCache(Cache):
+    """
+    Args:
+        max_entries: Maximum number of sessions kept. Once exceeded, the least recently
+            used session is evicted. None means unbounded
+        ttl: Seconds a session is kept when the IdP didn't send a SessionNotOnOrAfter.
+            None means sessions without SessionNotOnOrAfter never expire
+        snapshot_path: File the sessions are periodically written to, and restored from
+            after a restart. None disables snapshots
+        snapshot_interval: Seconds between snapshots, taken only if sessions changed
+        indexed_attributes: saml_attrs keys sessions can be searched by with
+            find_usernames
+    """
+
     client_required = False
 
-    def __init__(self):
-        self._cache = {}
+    # most expired sessions reclaimed per write, so a sweep never stalls a request
+    sweep_batch = 100
+
+    # file header, bump the version when the record layout changes
+    snapshot_magic = b"JHSAMLSNAP1\n"
+    _record_length = struct.Struct("!I")
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        ttl: Optional[float] = None,
+        snapshot_path: Optional[str] = None,
+        snapshot_interval: float = 300,
+        indexed_attributes: Optional[list] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.indexed_attributes = tuple(indexed_attributes or ())
+
+        # ordered from least to most recently used
+        self._cache = OrderedDict()
+        self._expires_at = {}
+        # (expires_at, username), ordered by expiry. Entries whose expiry changed
+        # since are skipped when they come up
+        self._expiry_heap = []
+
+        # name_id and session_index -> username, for find_username
+        self._by_name_id = {}
+        self._by_session_index = {}
+        # (attribute, value) -> usernames, for find_usernames
+        self._by_attribute = {}
+
+        self.evictions = 0
+        self.expirations = 0
+
+        # the snapshot is restored in the background or on first use, see prepare
+        self._snapshot_loaded = snapshot_path is None
+        self._loading = None
+        self._dirty = False
+        self._periodic = None
+        self._snapshot_lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        if not self._snapshot_loaded:
+            self._snapshot_loaded = True
+            self.load_snapshot()
+
+    def load_snapshot(self) -> int:
+        """Restore sessions from snapshot_path, skipping the ones that expired since.
+
+        The file is memory-mapped and decoded record by record, so it is never copied
+        into memory as a whole. A missing or corrupt snapshot leaves the cache empty.
+        This blocks while the file is decoded, use prepare() on the event loop.
+
+        Returns:
+            int: number of sessions restored
+        """
+        return self._restore(self._decode_snapshot())
+
+    async def prepare(self):
+        """Restore the snapshot once, decoding it on the default executor so that a
+        large snapshot doesn't block the event loop. Concurrent callers wait for the
+        same load."""
+        if self._snapshot_loaded:
+            return
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self._load_in_executor())
+        await self._loading
+
+    async def _load_in_executor(self):
+        records = await IOLoop.current().run_in_executor(None, self._decode_snapshot)
+        # a synchronous caller may have loaded or cleared the cache meanwhile
+        if not self._snapshot_loaded:
+            self._snapshot_loaded = True
+            self._restore(records)
+
+    def _decode_snapshot(self) -> list:
+        try:
+            with open(self.snapshot_path, "rb") as f, mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            ) as data:
+                return list(self._read_records(data))
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError, struct.error) as e:
+            app_log.error(f"could not restore sessions from {self.snapshot_path}. {e}")
+            return []
+
+    def _restore(self, records: list) -> int:
+        # records come most recently used first and are pushed to the front, so
+        # the restored order matches the snapshot
+        now = time.time()
+        restored = 0
+        for username, expires_at, session_entry in records:
+            if expires_at is not None and expires_at <= now:
+                continue
+            # sessions written since startup are newer than the snapshot
+            if username in self._cache:
+                continue
+            self._cache[username] = session_entry
+            self._cache.move_to_end(username, last=False)
+            self._index(username, session_entry)
+            self._set_expiry(username, expires_at)
+            restored += 1
+
+        while self.max_entries is not None and len(self._cache) > self.max_entries:
+            self._evict()
+
+        app_log.info(f"restored {restored} sessions from {self.snapshot_path}")
+        return restored
+
+    def _read_records(self, data):
+        magic = self.snapshot_magic
+        if data[: len(magic)] != magic:
+            raise ValueError("not a session snapshot")
+
+        serializer = serializers.JsonSerializer()
+        offset = len(magic)
+        records = []
+        while offset < len(data):
+            (length,) = self._record_length.unpack_from(data, offset)
+            offset += self._record_length.size
+            records.append((offset, length))
+            offset += length
+            if offset > len(data):
+                raise ValueError("truncated session snapshot")
+
+        # most recently used first, see load_snapshot
+        for offset, length in reversed(records):
+            username, expires_at, entry = serializer.loads(data[offset : offset + length])
+            yield username, expires_at, SessionEntry(*entry)
+
+    def _snapshot_records(self) -> list:
+        # cheap copy of references, taken on the event loop
+        return [
+            (username, self._expires_at.get(username), session_entry)
+            for username, session_entry in self._cache.items()
+        ]
+
+    def _write_snapshot(self, records: list):
+        serializer = serializers.JsonSerializer()
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with self._snapshot_lock:
+            # sessions hold personal data, so only the hub's user may read them
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.snapshot_magic)
+                for username, expires_at, session_entry in records:
+                    entry = [getattr(session_entry, name) for name in SessionEntry.fields]
+                    payload = serializer.dumps([username, expires_at, entry])
+                    f.write(self._record_length.pack(len(payload)))
+                    f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+
+    def write_snapshot(self):
+        """Write all sessions to snapshot_path, atomically replacing the previous one"""
+        if self.snapshot_path is None or not self._snapshot_loaded:
+            return
+        self._dirty = False
+        self._write_snapshot(self._snapshot_records())
+
+    async def _periodic_snapshot(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        records = self._snapshot_records()
+        try:
+            await IOLoop.current().run_in_executor(None, self._write_snapshot, records)
+        except OSError as e:
+            self._dirty = True
+            app_log.error(f"could not write session snapshot to {self.snapshot_path}. {e}")
+
+    def start_snapshots(self):
+        """Restore the previous snapshot in the background, then take a snapshot every
+        snapshot_interval seconds and a final one at exit"""
+        if self.snapshot_path is None or self._periodic is not None:
+            return
+        IOLoop.current().add_callback(self.prepare)
+        if self.snapshot_interval > 0:
+            self._periodic = PeriodicCallback(
+                self._periodic_snapshot, self.snapshot_interval * 1000
+            )
+            self._periodic.start()
+        atexit.register(self.write_snapshot)
+
+    def _expiry(self, session_entry: SessionEntry) -> Optional[float]:
+        if session_entry.session_expiration is not None:
+            return session_entry.session_expiration
+        if self.ttl is not None:
+            return time.time() + self.ttl
+        return None
+
+    def _set_expiry(self, username: str, expires_at: Optional[float]):
+        if expires_at is None:
+            self._expires_at.pop(username, None)
+            return
+
+        self._expires_at[username] = expires_at
+        heapq.heappush(self._expiry_heap, (expires_at, username))
+        # drop the entries of updated and deleted sessions once they dominate
+        if len(self._expiry_heap) > 2 * len(self._expires_at) + self.sweep_batch:
+            self._expiry_heap = [
+                (expiry, name) for name, expiry in self._expires_at.items()
+            ]
+            heapq.heapify(self._expiry_heap)
+
+    def _sweep(self, keep: Optional[str] = None):
+        """Expire up to sweep_batch sessions in expiry order, whatever their position
+        in the LRU. keep is left for the caller to expire"""
+        now = time.time()
+        swept = 0
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now and swept < self.sweep_batch:
+            expires_at, username = heapq.heappop(heap)
+            if username == keep or self._expires_at.get(username) != expires_at:
+                continue
+            self._expire(username)
+            swept += 1
+
+    def _is_expired(self, username: str) -> bool:
+        expires_at = self._expires_at.get(username)
+        return expires_at is not None and expires_at <= time.time()
+
+    def _index(self, username: str, session_entry: SessionEntry):
+        if session_entry.name_id is not None:
+            self._by_name_id[session_entry.name_id] = username
+        if session_entry.session_index is not None:
+            self._by_session_index[session_entry.session_index] = username
+        for attribute in self.indexed_attributes:
+            for value in _attribute_values(session_entry.saml_attrs, attribute):
+                self._by_attribute.setdefault((attribute, value), set()).add(username)
+
+    def _unindex(self, username: str, session_entry: SessionEntry):
+        # another user may have logged in with the same ids since
+        if self._by_name_id.get(session_entry.name_id) == username:
+            del self._by_name_id[session_entry.name_id]
+        if self._by_session_index.get(session_entry.session_index) == username:
+            del self._by_session_index[session_entry.session_index]
+        for attribute in self.indexed_attributes:
+            for value in _attribute_values(session_entry.saml_attrs, attribute):
+                usernames = self._by_attribute.get((attribute, value))
+                if usernames is not None:
+                    usernames.discard(username)
+                    if not usernames:
+                        del self._by_attribute[(attribute, value)]
+
+    def _delete(self, username: str):
+        self._unindex(username, self._cache.pop(username))
+        self._expires_at.pop(username, None)
+        self._dirty = True
+
+    def _expire(self, username: str):
+        app_log.info(f"session info for {username} expired")
+        self._delete(username)
+        self.expirations += 1
+
+    def _evict(self):
+        # drop an expired least recently used entry first, it would be lost anyway
+        oldest = next(iter(self._cache))
+        if self._is_expired(oldest):
+            self._expire(oldest)
+            return
+
+        app_log.info(f"session cache full, evicting session info for {oldest}")
+        self._delete(oldest)
+        self.evictions += 1
 
     def upsert(self, username: str, session_entry: SessionEntry):
+        self._ensure_loaded()
+        self._dirty = True
         if username in self._cache:
             app_log.warning(
                 f"username = {session_entry.name_id} already stored in session cache. Updating session info"
             )
+            self._unindex(username, self._cache[username])
         else:
             app_log.info(f"inserting session info for {username}")
         self._cache[username] = session_entry
+        self._cache.move_to_end(username)
+        self._index(username, session_entry)
 
-    def get(self, username: str) -> SessionEntry:
+        self._set_expiry(username, self._expiry(session_entry))
+
+        # sweep expired sessions so that they don't linger until the cache fills up
+        self._sweep(keep=username)
+
+        while self.max_entries is not None and len(self._cache) > self.max_entries:
+            self._evict()
+
+    def lookup(self, username: str) -> Optional[SessionEntry]:
+        """Like get(), but returns None for a missing or expired session"""
+        self._ensure_loaded()
         if username not in self._cache:
+            return None
+
+        if self._is_expired(username):
+            self._expire(username)
+            return None
+
+        self._cache.move_to_end(username)
+        return self._cache[username]
+
+    def get(self, username: str) -> SessionEntry:
+        session_entry = self.lookup(username)
+        if session_entry is None:
             app_log.error(f"no session information for username = {username}")
             return SessionEntry()
 
-        return self._cache[username]
+        return session_entry
+
+    def find_username(
+        self, name_id: Optional[str] = None, session_index: Optional[str] = None
+    ) -> Optional[str]:
+        if session_index is not None:
+            username = self._by_session_index.get(session_index)
+        else:
+            username = self._by_name_id.get(name_id)
+        if username is None:
+            return None
+
+        session_entry = self.lookup(username)
+        if session_entry is None or not session_entry.matches(name_id, session_index):
+            return None
+        return username
+
+    def find_usernames(
+        self,
+        attribute: Optional[str] = None,
+        value: Optional[str] = None,
+        created_before: Optional[float] = None,
+    ) -> list:
+        _check_indexed(self.indexed_attributes, attribute)
+        self._ensure_loaded()
+
+        if attribute is not None:
+            candidates = list(self._by_attribute.get((attribute, value), ()))
+        else:
+            candidates = list(self._cache)
+
+        return [
+            username
+            for username in candidates
+            if not self._is_expired(username)
+            and self._cache[username].created_before(created_before)
+        ]
+
+    def remove_many(self, usernames: list) -> list:
+        self._ensure_loaded()
+        removed = []
+        for username in usernames:
+            if username in self._cache:
+                self._delete(username)
+                removed.append(username)
+        return removed
+
+    def discard(self, username: str):
+        """Like remove(), but silently ignores a missing session"""
+        self._ensure_loaded()
+        if username in self._cache:
+            self._delete(username)
+
+    def clear(self):
+        self._snapshot_loaded = True
+        self._dirty = True
+        self._cache.clear()
+        self._expires_at.clear()
+        self._expiry_heap.clear()
+        self._by_name_id.clear()
+        self._by_session_index.clear()
+        self._by_attribute.clear()
 
     def remove(self, username: str):
+        self._ensure_loaded()
         if username not in self._cache:
             app_log.error(f"no session information for username = {username}")
             return
 
-        del self._cache[username]
+        self._delete(username)
+
+    def pop(self, username: str, include_attrs: bool = True) -> SessionEntry:
+        self._ensure_loaded()
+        session_entry = self._cache.pop(username, None)
+        expires_at = self._expires_at.pop(username, None)
+        if session_entry is None:
+            app_log.error(f"no session information for username = {username}")
+            return SessionEntry()
+
+        self._unindex(username, session_entry)
+        self._dirty = True
+        if expires_at is not None and expires_at <= time.time():
+            app_log.info(f"session info for {username} expired")
+            self.expirations += 1
+            return SessionEntry()
+
+        return session_entry
 
 
 class DisabledCache(Cache):
@@ -92,56 +709,1455 @@ class DisabledCache(Cache):
     def remove(self, username: str):
         return
 
+    def pop(self, username: str, include_attrs: bool = True) -> SessionEntry:
+        return SessionEntry()
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class RedisCommands:
+    """Builds the commands shared by RedisCache and AsyncRedisCache.
+
+    Commands are queued on a pipeline, so the sync and asyncio caches only differ in
+    how the pipeline is executed. Writes set the key's expiry in the same MULTI/EXEC
+    transaction as the value, so no key is ever left without a TTL.
+
+    By default sessions are stored with RedisJSON. If a serializer is given, they are
+    stored as a plain redis hash instead, which needs no redis module: name_id,
+    session_index and session_expiration are separate fields and only saml_attrs is
+    serialized. Binary payloads require a client created with decode_responses=False.
+    Reads treat a key of the other layout (WRONGTYPE) as a missing session, so the
+    RedisJSON sessions of a deployment that sets a serializer are replaced by the
+    next write instead of failing it.
+
+    Either way, pop(include_attrs=False) reads back only name_id and session_index
+    (a multi-path JSON.GET or an HMGET), so logout never transfers saml_attrs.
+
+    For find_username, every session also writes index keys mapping its name_id and
+    session_index to the username, with the same expiry as the session. Writes and
+    pops read the previous session first and delete its index keys in the same
+    transaction, with the session key WATCHed so that the transaction is retried if
+    the session changes in between. An index key may still outlive its session, e.g.
+    when the session expires, so lookups check the session before returning its
+    username.
 
-class RedisCache(Cache):
+    For find_usernames, a sorted set ranks usernames by login time and, for each
+    value of the indexed_attributes, a set holds the usernames whose session has it.
+    Neither expires, so both are checked against the sessions on lookup, which also
+    prunes members whose session expired, is gone or changed. remove_many deletes any
+    number of sessions, and their index keys, in a single transaction.
+
+    Without a key_prefix, sessions are stored under the bare username and the index
+    keys under jupyterhub_saml_auth, as before key prefixes existed. With one, every
+    key starts with it, so several hubs or apps can share a redis.
+
+    On a redis cluster the keys spread over the shards, and multi-key operations run
+    as a pipeline per shard, which redis-py's cluster pipeline sends concurrently.
+    MULTI/EXEC only works on keys of one slot, so writes are not transactions there.
+    hash_tag puts every key into the slot of the prefix instead, which keeps the
+    transactions but also keeps all sessions on one shard.
+
+    Args:
+        ttl: Seconds a session is kept when the IdP didn't send a SessionNotOnOrAfter.
+            None means such sessions never expire
+        sliding_expiration: Reset the ttl whenever a session is read, so that only
+            active sessions stay in redis. Never extends past SessionNotOnOrAfter
+        serializer: json or msgpack, see serializers.serializer_map. None uses RedisJSON
+        compression: zlib or zstd compression of serialized sessions
+        compression_threshold: minimum serialized size in bytes to compress
+        indexed_attributes: saml_attrs keys sessions can be searched by with
+            find_usernames
+        key_prefix: prefix of every key
+        hash_tag: wrap the prefix in a hash tag, {key_prefix}, so that all keys are in
+            one cluster slot
+    """
+
+    # the small fields stored next to saml_attrs
+    id_fields = ("name_id", "session_index", "session_expiration", "created_at")
+
+    # prefix of the index keys when there is no key_prefix
+    index_prefix = "jupyterhub_saml_auth"
+
+    def __init__(
+        self,
+        ttl: Optional[int] = None,
+        sliding_expiration: bool = False,
+        serializer: Optional[str] = None,
+        compression: Optional[str] = None,
+        compression_threshold: int = 1024,
+        indexed_attributes: Optional[list] = None,
+        key_prefix: Optional[str] = None,
+        hash_tag: bool = False,
+    ):
+        if sliding_expiration and ttl is None:
+            raise CacheError("sliding_expiration requires a ttl")
+        if compression is not None and serializer is None:
+            raise CacheError("compression requires a serializer")
+
+        self.ttl = ttl
+        self.sliding_expiration = sliding_expiration
+        self.indexed_attributes = tuple(indexed_attributes or ())
+        self.serializer = None
+        if serializer is not None:
+            self.serializer = serializers.create(
+                serializer, compression, compression_threshold
+            )
+
+        self.hash_tag = hash_tag
+        self._session_prefix = ""
+        if key_prefix is not None or hash_tag:
+            prefix = key_prefix or self.index_prefix
+            self.index_prefix = f"{{{prefix}}}" if hash_tag else prefix
+            self._session_prefix = f"{self.index_prefix}:session:"
+
+    def _key(self, username: str) -> str:
+        return self._session_prefix + username
+
+    @property
+    def _watchable(self) -> bool:
+        # a cluster only runs WATCH and MULTI/EXEC on keys of one slot
+        return self.hash_tag or not redis_clients.is_cluster(self.client)
+
+    def _pipeline(self, transaction: bool = True):
+        return self.client.pipeline(transaction=transaction and self._watchable)
+
+    def _check_client(self):
+        if not self._watchable:
+            app_log.warning(
+                "redis cluster without hash_tag, session writes are not transactions"
+            )
+
+    def _check_client_kwargs(self, client_kwargs: Optional[Dict[str, Any]]):
+        if self.serializer is not None and (client_kwargs or {}).get(
+            "decode_responses"
+        ):
+            raise CacheError(
+                "serialized sessions are binary, create the client with decode_responses=False"
+            )
+
+    def _queue_expiry(self, pipe, key: str, session_entry: SessionEntry):
+        if session_entry.session_expiration is not None:
+            pipe.expireat(key, int(session_entry.session_expiration))
+        elif self.ttl is not None:
+            pipe.expire(key, int(self.ttl))
+
+    def _index_key(self, field: str, value: str) -> str:
+        return f"{self.index_prefix}:{field}:{value}"
+
+    def _index_keys(self, session_entry: SessionEntry) -> list:
+        return [
+            self._index_key(field, getattr(session_entry, field))
+            for field in ("name_id", "session_index")
+            if getattr(session_entry, field) is not None
+        ]
+
+    def _attribute_key(self, attribute: str, value: str) -> str:
+        return f"{self.index_prefix}:attr:{attribute}:{value}"
+
+    @property
+    def _created_at_key(self) -> str:
+        return f"{self.index_prefix}:created_at"
+
+    def _find_key(
+        self, name_id: Optional[str], session_index: Optional[str]
+    ) -> Optional[str]:
+        if session_index is not None:
+            return self._index_key("session_index", session_index)
+        if name_id is not None:
+            return self._index_key("name_id", name_id)
+        return None
+
+    def _queue_sliding_refresh(self, pipe, username: str, session_entry: SessionEntry):
+        # the session key itself was refreshed along with the read
+        if self._sliding_overshoots(session_entry):
+            for key in [self._key(username), *self._index_keys(session_entry)]:
+                pipe.expireat(key, int(session_entry.session_expiration))
+        else:
+            for key in self._index_keys(session_entry):
+                pipe.expire(key, int(self.ttl))
+
+    def _to_hash(self, session_entry: SessionEntry) -> dict:
+        fields = {"saml_attrs": self.serializer.dumps(session_entry.saml_attrs)}
+        for field in self.id_fields:
+            value = getattr(session_entry, field)
+            if value is not None:
+                fields[field] = value
+        return fields
+
+    def _from_hash(self, fields: Dict[bytes, bytes]) -> SessionEntry:
+        fields = {_decode(field): value for field, value in fields.items()}
+        session_entry = self._from_id_fields([fields.get(f) for f in self.id_fields])
+        if "saml_attrs" in fields:
+            session_entry.saml_attrs = self.serializer.loads(fields["saml_attrs"])
+        return session_entry
+
+    def _from_id_fields(self, values: list) -> SessionEntry:
+        name_id, session_index, session_expiration, created_at = values
+        return SessionEntry(
+            name_id=_decode(name_id),
+            session_index=_decode(session_index),
+            session_expiration=(
+                int(session_expiration) if session_expiration is not None else None
+            ),
+            created_at=int(created_at) if created_at is not None else None,
+        )
+
+    def _queue_remove_index(
+        self, pipe, previous: Optional[SessionEntry], keep: tuple = ()
+    ):
+        """Delete the index keys of the previous session of a user, except keep"""
+        if previous is None:
+            return
+        for key in self._index_keys(previous):
+            # one key per command, index keys may be in different cluster slots
+            if key not in keep:
+                pipe.delete(key)
+
+    def _queue_upsert(
+        self,
+        pipe,
+        username: str,
+        session_entry: SessionEntry,
+        previous: Optional[SessionEntry] = None,
+    ):
+        """previous is the session being replaced, whose index keys are deleted"""
+        key = self._key(username)
+        if self.serializer is not None:
+            # replace the whole hash so no field of a previous session survives
+            pipe.delete(key)
+            pipe.hset(key, mapping=self._to_hash(session_entry))
+        else:
+            pipe.json().set(
+                name=key,
+                path=RedisJsonPath.root_path(),
+                obj=session_entry.to_dict(),
+                decode_keys=True,
+            )
+        self._queue_expiry(pipe, key, session_entry)
+
+        index_keys = self._index_keys(session_entry)
+        self._queue_remove_index(pipe, previous, keep=index_keys)
+        for key in index_keys:
+            pipe.set(key, username)
+            self._queue_expiry(pipe, key, session_entry)
+
+        # sessions without a login time rank as the oldest
+        pipe.zadd(self._created_at_key, {username: session_entry.created_at or 0})
+        for attribute in self.indexed_attributes:
+            for value in _attribute_values(session_entry.saml_attrs, attribute):
+                pipe.sadd(self._attribute_key(attribute, value), username)
+
+    def _queue_read(self, pipe, username: str, include_attrs: bool):
+        key = self._key(username)
+        if self.serializer is not None:
+            if include_attrs:
+                pipe.hgetall(key)
+            else:
+                pipe.hmget(key, self.id_fields)
+        elif include_attrs:
+            pipe.json().get(key, RedisJsonPath.root_path())
+        else:
+            pipe.json().get(key, ".name_id", ".session_index")
+
+    def _queue_read_many(self, pipe, usernames: list, include_attrs: bool):
+        for username in usernames:
+            self._queue_read(pipe, username, include_attrs)
+
+    def _parse_read_many(self, results: list, include_attrs: bool) -> list:
+        """Parse the replies of a read pipeline executed with raise_on_error=False"""
+        for result in results:
+            # a key of the other layout, e.g. a RedisJSON session written before a
+            # serializer was set, reads as missing and the write replaces it
+            if isinstance(result, ResponseError) and not str(result).startswith(
+                "WRONGTYPE"
+            ):
+                raise result
+        return [
+            None
+            if isinstance(result, ResponseError)
+            else self._parse_entry(result, include_attrs)
+            for result in results
+        ]
+
+    def _queue_get(self, pipe, username: str):
+        self._queue_read(pipe, username, include_attrs=True)
+        if self.sliding_expiration:
+            pipe.expire(self._key(username), int(self.ttl))
+
+    def _queue_remove(
+        self, pipe, username: str, previous: Optional[SessionEntry] = None
+    ):
+        """previous is the session being removed, whose index keys are deleted"""
+        key = self._key(username)
+        if self.serializer is not None:
+            pipe.delete(key)
+        else:
+            pipe.json().delete(key, path=RedisJsonPath.root_path())
+        pipe.zrem(self._created_at_key, username)
+        self._queue_remove_index(pipe, previous)
+
+    def _queue_remove_many(self, pipe, usernames: list, previous: list):
+        for username, session_entry in zip(usernames, previous):
+            self._queue_remove(pipe, username, session_entry)
+
+    def _queue_find_candidates(
+        self, pipe, attribute: Optional[str], value: Optional[str], created_before
+    ):
+        _check_indexed(self.indexed_attributes, attribute)
+        if attribute is not None:
+            pipe.smembers(self._attribute_key(attribute, value))
+        else:
+            maximum = f"({created_before}" if created_before is not None else "+inf"
+            pipe.zrangebyscore(self._created_at_key, "-inf", maximum)
+
+    def _parse_candidates(self, results: list) -> list:
+        return sorted(_decode(username) for username in results[0])
+
+    def _queue_verify(self, pipe, candidates: list, attribute: Optional[str]):
+        # the attributes are only needed to check an attribute set
+        self._queue_read_many(pipe, candidates, include_attrs=attribute is not None)
+
+    def _parse_verify(
+        self,
+        candidates: list,
+        results: list,
+        attribute: Optional[str],
+        value: Optional[str],
+        created_before: Optional[float],
+    ):
+        """Split index candidates into the usernames that match and stale index
+        members, whose session expired, was removed or lost the attribute value"""
+        found, stale = [], []
+        include_attrs = attribute is not None
+        for username, result in zip(candidates, results):
+            session_entry = self._parse_entry(result, include_attrs)
+            if session_entry is None or (
+                include_attrs and not session_entry.has_attribute(attribute, value)
+            ):
+                stale.append(username)
+            elif session_entry.created_before(created_before):
+                found.append(username)
+        return found, stale
+
+    def _prune(self, client, attribute: Optional[str], value: Optional[str], stale):
+        """Remove stale members from the index the candidates came from"""
+        if attribute is None:
+            return client.zrem(self._created_at_key, *stale)
+        return client.srem(self._attribute_key(attribute, value), *stale)
+
+    def _parse_entry(
+        self, result, include_attrs: bool = True
+    ) -> Optional[SessionEntry]:
+        if self.serializer is not None:
+            # missing hashes come back as {} from HGETALL and all None from HMGET
+            if include_attrs and result:
+                return self._from_hash(result)
+            if not include_attrs and result[0] is not None:
+                return self._from_id_fields(result)
+        elif result is not None:
+            if include_attrs:
+                return SessionEntry(**result)
+            return SessionEntry(
+                name_id=result[".name_id"], session_index=result[".session_index"]
+            )
+        return None
+
+    def _parse_get(
+        self, username: str, results: list, include_attrs: bool = True
+    ) -> SessionEntry:
+        session_entry = self._parse_read_many(results[:1], include_attrs)[0]
+        return self._or_empty(username, session_entry)
+
+    def _or_empty(
+        self, username: str, session_entry: Optional[SessionEntry]
+    ) -> SessionEntry:
+        if session_entry is None:
+            app_log.error(f"no session information for username = {username}")
+            return SessionEntry()
+        return session_entry
+
+    def _sliding_overshoots(self, session_entry: SessionEntry) -> bool:
+        """Whether a sliding refresh pushed the expiry past SessionNotOnOrAfter, in which
+        case the expiry has to be set back to it"""
+        return (
+            self.sliding_expiration
+            and session_entry.session_expiration is not None
+            and session_entry.session_expiration < time.time() + self.ttl
+        )
+
+
+class RedisCache(RedisCommands, Cache):
     """
     Args:
-        client: The Redis client.
+        client: The Redis client class, or redis, cluster or sentinel. See
+            redis_clients.create
+        client_kwargs: keyword arguments for the client
+        retries: see redis_clients.create
+        retry_backoff: see redis_clients.create
+        options: ttl, sliding_expiration, serializer, compression,
+            compression_threshold, indexed_attributes, key_prefix and hash_tag, see
+            RedisCommands
     """
 
     client_required = True
+    blocking = True
+
+    def __init__(
+        self,
+        client: Union[Redis, str],
+        client_kwargs: Dict[str, Any],
+        retries: Optional[int] = None,
+        retry_backoff: float = 1,
+        **options,
+    ):
+        super().__init__(**options)
+        self._check_client_kwargs(client_kwargs)
+        self.client = redis_clients.create(
+            client, client_kwargs, retries=retries, retry_backoff=retry_backoff
+        )
+        self._check_client()
+
+    def _transaction(self, usernames: list, include_attrs: bool, queue_write) -> list:
+        """Read the sessions of usernames, then run the commands queue_write(pipe,
+        session_entries) queues in a transaction. The session keys are WATCHed, so the
+        transaction is retried if one of them is written in between.
 
-    def __init__(self, client: Redis, client_kwargs: Dict[str, Any]):
-        self.client = client(**client_kwargs)
+        Returns:
+            list: the sessions read, None for the missing ones
+        """
+        pipe = self._pipeline()
+        try:
+            while True:
+                if self._watchable:
+                    pipe.watch(*[self._key(username) for username in usernames])
+                read = self._pipeline(transaction=False)
+                self._queue_read_many(read, usernames, include_attrs)
+                session_entries = self._parse_read_many(
+                    read.execute(raise_on_error=False), include_attrs
+                )
+
+                if self._watchable:
+                    pipe.multi()
+                queue_write(pipe, session_entries)
+                try:
+                    pipe.execute()
+                    return session_entries
+                except WatchError:
+                    continue
+        finally:
+            pipe.reset()
 
     def upsert(self, username: str, session_entry: SessionEntry):
-        session_entry: dict = vars(session_entry)
-        self.client.json().set(
-            name=username,
-            path=RedisJsonPath.root_path(),
-            obj=session_entry,
-            decode_keys=True,
+        self._transaction(
+            [username],
+            False,
+            lambda pipe, previous: self._queue_upsert(
+                pipe, username, session_entry, previous[0]
+            ),
         )
 
     def get(self, username: str) -> SessionEntry:
-        session_entry: str = self.client.json().get(username, RedisJsonPath.root_path())
-        session_entry: SessionEntry = SessionEntry(**session_entry)
-        if not isinstance(session_entry, SessionEntry):
-            raise TypeError(f"session entry for {username} is not of type SessionEntry")
+        pipe = self._pipeline()
+        self._queue_get(pipe, username)
+        session_entry = self._parse_get(username, pipe.execute(raise_on_error=False))
+
+        if self.sliding_expiration and session_entry.name_id is not None:
+            pipe = self._pipeline(transaction=False)
+            self._queue_sliding_refresh(pipe, username, session_entry)
+            pipe.execute()
         return session_entry
 
     def remove(self, username: str):
-        self.client.json().delete(username, path=RedisJsonPath.root_path())
+        self.pop(username, include_attrs=False)
 
+    def pop(self, username: str, include_attrs: bool = True) -> SessionEntry:
+        session_entries = self._transaction(
+            [username],
+            include_attrs,
+            lambda pipe, previous: self._queue_remove(pipe, username, previous[0]),
+        )
+        return self._or_empty(username, session_entries[0])
 
-cache_map = {"redis": RedisCache, "in-memory": InMemoryCache, "disabled": DisabledCache}
+    def find_username(
+        self, name_id: Optional[str] = None, session_index: Optional[str] = None
+    ) -> Optional[str]:
+        key = self._find_key(name_id, session_index)
+        username = _decode(self.client.get(key)) if key is not None else None
+        if username is None:
+            return None
 
+        pipe = self._pipeline()
+        self._queue_read(pipe, username, include_attrs=False)
+        session_entry = self._parse_get(
+            username, pipe.execute(raise_on_error=False), include_attrs=False
+        )
+        return username if session_entry.matches(name_id, session_index) else None
+
+    def find_usernames(
+        self,
+        attribute: Optional[str] = None,
+        value: Optional[str] = None,
+        created_before: Optional[float] = None,
+    ) -> list:
+        pipe = self._pipeline(transaction=False)
+        self._queue_find_candidates(pipe, attribute, value, created_before)
+        candidates = self._parse_candidates(pipe.execute())
+        if not candidates:
+            return candidates
+
+        pipe = self._pipeline(transaction=False)
+        self._queue_verify(pipe, candidates, attribute)
+        found, stale = self._parse_verify(
+            candidates, pipe.execute(), attribute, value, created_before
+        )
+        if stale:
+            self._prune(self.client, attribute, value, stale)
+        return found
+
+    def remove_many(self, usernames: list) -> list:
+        if not usernames:
+            return []
+        session_entries = self._transaction(
+            usernames,
+            False,
+            lambda pipe, previous: self._queue_remove_many(pipe, usernames, previous),
+        )
+        return [
+            username
+            for username, session_entry in zip(usernames, session_entries)
+            if session_entry is not None
+        ]
 
-def create(cache_spec: dict) -> Cache:
+
+class SQLiteCache(Cache):
+    """Durable session cache in a local SQLite file, for single node hubs.
+
+    The database runs in WAL mode. Writes are queued and committed in batches by a
+    background thread, so callers never wait on fsync. Queued writes are visible to
+    reads right away. Reads use one connection per thread and fixed SQL statements,
+    which sqlite3 keeps prepared in its statement cache. Expired sessions are swept
+    periodically through an index on their expiry. Values of the indexed_attributes
+    are kept in an indexed table of their own for find_usernames.
+
+    Args:
+        path: location of the database file
+        ttl: Seconds a session is kept when the IdP didn't send a SessionNotOnOrAfter.
+            None means such sessions never expire
+        flush_interval: seconds the writer waits to collect a batch of writes
+        sweep_interval: seconds between sweeps of expired sessions
+        indexed_attributes: saml_attrs keys sessions can be searched by with
+            find_usernames
+    """
+
+    client_required = False
+    blocking = True
+
+    # the order of values in a row tuple
+    _columns = (
+        "username",
+        "name_id",
+        "session_index",
+        "session_expiration",
+        "saml_attrs",
+        "created_at",
+        "expires_at",
+    )
+    _tables = (
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            username TEXT PRIMARY KEY,
+            name_id TEXT,
+            session_index TEXT,
+            session_expiration INTEGER,
+            saml_attrs BLOB,
+            created_at INTEGER,
+            expires_at REAL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS session_attributes (
+            username TEXT NOT NULL,
+            name TEXT NOT NULL,
+            value TEXT NOT NULL
+        )
+        """,
+    )
+    _indexes = (
+        "CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)",
+        "CREATE INDEX IF NOT EXISTS sessions_name_id ON sessions (name_id)",
+        "CREATE INDEX IF NOT EXISTS sessions_session_index ON sessions (session_index)",
+        "CREATE INDEX IF NOT EXISTS sessions_created_at ON sessions (created_at)",
+        "CREATE INDEX IF NOT EXISTS session_attributes_value "
+        "ON session_attributes (name, value)",
+        "CREATE INDEX IF NOT EXISTS session_attributes_username "
+        "ON session_attributes (username)",
+    )
+    _select = (
+        "SELECT name_id, session_index, session_expiration, saml_attrs, created_at "
+        "FROM sessions WHERE username = ? AND (expires_at IS NULL OR expires_at > ?)"
+    )
+    _find = {
+        field: f"SELECT username FROM sessions WHERE {field} = ?"
+        for field in ("name_id", "session_index")
+    }
+    _find_created_before = (
+        "SELECT username FROM sessions WHERE (expires_at IS NULL OR expires_at > ?) "
+        "AND (created_at IS NULL OR created_at < ?)"
+    )
+    _find_attribute = (
+        "SELECT s.username FROM session_attributes a "
+        "JOIN sessions s ON s.username = a.username "
+        "WHERE a.name = ? AND a.value = ? "
+        "AND (s.expires_at IS NULL OR s.expires_at > ?) "
+        "AND (s.created_at IS NULL OR s.created_at < ?)"
+    )
+    _upsert = (
+        f"INSERT OR REPLACE INTO sessions ({', '.join(_columns)}) "
+        f"VALUES ({', '.join('?' for _ in _columns)})"
+    )
+    _delete = "DELETE FROM sessions WHERE username = ?"
+    _delete_attributes = "DELETE FROM session_attributes WHERE username = ?"
+    _insert_attribute = "INSERT INTO session_attributes VALUES (?, ?, ?)"
+    _sweep = (
+        "DELETE FROM sessions WHERE expires_at <= ?",
+        "DELETE FROM session_attributes "
+        "WHERE username NOT IN (SELECT username FROM sessions)",
+    )
+
+    # marks a queued delete in _pending
+    _DELETED = object()
+
+    def __init__(
+        self,
+        path: str = "jupyterhub-saml-sessions.sqlite",
+        ttl: Optional[float] = None,
+        flush_interval: float = 0.05,
+        sweep_interval: float = 60,
+        indexed_attributes: Optional[list] = None,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval
+        self.indexed_attributes = tuple(indexed_attributes or ())
+        self.serializer = serializers.JsonSerializer()
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # username -> row tuple or _DELETED, for writes not committed yet
+        self._pending = {}
+        self._queue = queue.Queue()
+
+        self._create_schema(self._connect())
+
+        self._writer = threading.Thread(
+            target=self._write_loop, name="saml-sqlite-writer", daemon=True
+        )
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.isolation_level = "DEFERRED"
+            self._local.connection = connection
+        return connection
+
+    def _create_schema(self, connection: sqlite3.Connection):
+        with connection:
+            for statement in self._tables:
+                connection.execute(statement)
+            for statement in self._indexes:
+                connection.execute(statement)
+
+    def _to_row(self, username: str, session_entry: SessionEntry) -> tuple:
+        if session_entry.session_expiration is not None:
+            expires_at = session_entry.session_expiration
+        elif self.ttl is not None:
+            expires_at = time.time() + self.ttl
+        else:
+            expires_at = None
+
+        saml_attrs = None
+        if session_entry.saml_attrs is not None:
+            saml_attrs = self.serializer.dumps(session_entry.saml_attrs)
+        return (
+            username,
+            session_entry.name_id,
+            session_entry.session_index,
+            session_entry.session_expiration,
+            saml_attrs,
+            session_entry.created_at,
+            expires_at,
+        )
+
+    def _from_row(self, row: tuple) -> SessionEntry:
+        """Entry from the name_id to created_at columns of a row"""
+        name_id, session_index, session_expiration, saml_attrs, created_at = row
+        return SessionEntry(
+            name_id=name_id,
+            saml_attrs=self.serializer.loads(saml_attrs) if saml_attrs else None,
+            session_index=session_index,
+            session_expiration=session_expiration,
+            created_at=created_at,
+        )
+
+    def _pending_entry(self, row, now: float) -> Optional[SessionEntry]:
+        if row is self._DELETED:
+            return None
+        expires_at = row[6]
+        if expires_at is not None and expires_at <= now:
+            return None
+        return self._from_row(row[1:6])
+
+    def _attribute_rows(self, row: tuple) -> list:
+        saml_attrs = self.serializer.loads(row[4]) if row[4] else None
+        return [
+            (row[0], attribute, str(value))
+            for attribute in self.indexed_attributes
+            for value in _attribute_values(saml_attrs, attribute)
+        ]
+
+    def _enqueue(self, username: str, row):
+        self._pending[username] = row
+        self._queue.put((username, row))
+
+    def _write_loop(self):
+        connection = self._connect()
+        last_sweep = time.monotonic()
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.sweep_interval)]
+            except queue.Empty:
+                batch = []
+
+            # collect whatever else arrives within flush_interval into one transaction
+            deadline = time.monotonic() + self.flush_interval
+            while batch and isinstance(batch[-1], tuple):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                writes = [item for item in batch if isinstance(item, tuple)]
+                self._commit(connection, writes)
+                if time.monotonic() - last_sweep >= self.sweep_interval:
+                    with connection:
+                        connection.execute(self._sweep[0], (time.time(),))
+                        connection.execute(self._sweep[1])
+                    last_sweep = time.monotonic()
+            except sqlite3.Error as e:
+                app_log.error(f"could not write sessions to {self.path}. Error = {e}")
+
+            # flush() waits on an event, close() sends None
+            marker = batch[-1] if batch else ()
+            if isinstance(marker, threading.Event):
+                marker.set()
+            elif marker is None:
+                connection.close()
+                return
+
+    def _commit(self, connection: sqlite3.Connection, writes: list):
+        if not writes:
+            return
+
+        # only the last write per user matters
+        latest = dict(writes)
+        upserts = [row for row in latest.values() if row is not self._DELETED]
+        deletes = [(username,) for username, row in latest.items() if row is self._DELETED]
+        attribute_rows = [
+            attribute_row
+            for row in upserts
+            for attribute_row in self._attribute_rows(row)
+        ]
+
+        try:
+            with connection:
+                connection.executemany(
+                    self._delete_attributes, [(username,) for username in latest]
+                )
+                if deletes:
+                    connection.executemany(self._delete, deletes)
+                if upserts:
+                    connection.executemany(self._upsert, upserts)
+                if attribute_rows:
+                    connection.executemany(self._insert_attribute, attribute_rows)
+        except sqlite3.Error:
+            app_log.error(f"dropping {len(latest)} session writes, the commit failed")
+            raise
+        finally:
+            # a failed batch is rolled back, so reads must not see it either
+            with self._lock:
+                for username, row in latest.items():
+                    # keep the overlay if a newer write was queued meanwhile
+                    if self._pending.get(username) is row:
+                        del self._pending[username]
+
+    def _read(self, username: str) -> Optional[SessionEntry]:
+        with self._lock:
+            row = self._pending.get(username)
+        if row is not None:
+            return self._pending_entry(row, time.time())
+
+        row = self._connect().execute(self._select, (username, time.time())).fetchone()
+        return self._from_row(row) if row is not None else None
+
+    def upsert(self, username: str, session_entry: SessionEntry):
+        app_log.info(f"inserting session info for {username}")
+        with self._lock:
+            self._enqueue(username, self._to_row(username, session_entry))
+
+    def get(self, username: str) -> SessionEntry:
+        session_entry = self._read(username)
+        if session_entry is None:
+            app_log.error(f"no session information for username = {username}")
+            return SessionEntry()
+        return session_entry
+
+    def remove(self, username: str):
+        with self._lock:
+            self._enqueue(username, self._DELETED)
+
+    def find_username(
+        self, name_id: Optional[str] = None, session_index: Optional[str] = None
+    ) -> Optional[str]:
+        if session_index is not None:
+            field, value = "session_index", session_index
+        elif name_id is not None:
+            field, value = "name_id", name_id
+        else:
+            return None
+
+        # queued writes aren't in the table yet
+        column = 1 if field == "name_id" else 2
+        with self._lock:
+            candidates = [
+                username
+                for username, row in self._pending.items()
+                if row is not self._DELETED and row[column] == value
+            ]
+        rows = self._connect().execute(self._find[field], (value,)).fetchall()
+        candidates.extend(username for (username,) in rows)
+
+        # _read applies queued writes and expiry to what the table returned
+        for username in candidates:
+            session_entry = self._read(username)
+            if session_entry is not None and session_entry.matches(name_id, session_index):
+                return username
+        return None
+
+    def find_usernames(
+        self,
+        attribute: Optional[str] = None,
+        value: Optional[str] = None,
+        created_before: Optional[float] = None,
+    ) -> list:
+        _check_indexed(self.indexed_attributes, attribute)
+        now = time.time()
+        before = created_before if created_before is not None else float("inf")
+
+        with self._lock:
+            pending = dict(self._pending)
+        if attribute is not None:
+            rows = self._connect().execute(
+                self._find_attribute, (attribute, str(value), now, before)
+            )
+        else:
+            rows = self._connect().execute(self._find_created_before, (now, before))
+
+        # queued writes replace what the table holds for their user
+        usernames = [username for (username,) in rows if username not in pending]
+        for username, row in pending.items():
+            session_entry = self._pending_entry(row, now)
+            if (
+                session_entry is not None
+                and (attribute is None or session_entry.has_attribute(attribute, value))
+                and session_entry.created_before(created_before)
+            ):
+                usernames.append(username)
+        return usernames
+
+    def remove_many(self, usernames: list) -> list:
+        removed = [
+            username for username in usernames if self._read(username) is not None
+        ]
+        with self._lock:
+            for username in removed:
+                self._enqueue(username, self._DELETED)
+        return removed
+
+    def flush(self):
+        """Block until every write queued so far has been committed"""
+        if not self._writer.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        """Commit queued writes and stop the writer thread"""
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+
+class AsyncCache(metaclass=ABCMeta):
+    """Asyncio interface for a cache. Same contract as Cache, but every operation is a
+    coroutine so that caches backed by network services don't block the event loop
+    """
+
+    # set to True for caches that keep sessions in JupyterHub's auth_state. The ACS
+    # handler then passes the session to login_user as auth_state
+    uses_auth_state = False
+
+    @abstractmethod
+    async def upsert(self, username: str, session_entry: SessionEntry):
+        pass
+
+    @abstractmethod
+    async def get(self, username: str) -> SessionEntry:
+        pass
+
+    @abstractmethod
+    async def remove(self, username: str):
+        pass
+
+    async def pop(self, username: str, include_attrs: bool = True) -> SessionEntry:
+        """Remove the session entry for username and return it. See Cache.pop"""
+        session_entry = await self.get(username)
+        await self.remove(username)
+        return session_entry
+
+    async def find_username(
+        self, name_id: Optional[str] = None, session_index: Optional[str] = None
+    ) -> Optional[str]:
+        """See Cache.find_username"""
+        return None
+
+    async def find_usernames(
+        self,
+        attribute: Optional[str] = None,
+        value: Optional[str] = None,
+        created_before: Optional[float] = None,
+    ) -> list:
+        """See Cache.find_usernames"""
+        return []
+
+    async def remove_many(self, usernames: list) -> list:
+        """See Cache.remove_many"""
+        removed = []
+        for username in usernames:
+            if (await self.pop(username, include_attrs=False)).name_id is not None:
+                removed.append(username)
+        return removed
+
+    @property
+    @abstractmethod
+    def client_required(self) -> bool:
+        pass
+
+
+class SyncCacheAdapter(AsyncCache):
+    """Exposes a synchronous Cache through the AsyncCache interface.
+
+    Operations of blocking caches run on the default executor, the others are called
+    directly since they never wait on I/O.
+
+    Args:
+        cache: the synchronous cache to adapt
+    """
+
+    client_required = False
+
+    def __init__(self, cache: Cache):
+        self.cache = cache
+
+    async def _call(self, method, *args):
+        await self.cache.prepare()
+        if self.cache.blocking:
+            return await IOLoop.current().run_in_executor(None, method, *args)
+        return method(*args)
+
+    async def upsert(self, username: str, session_entry: SessionEntry):
+        return await self._call(self.cache.upsert, username, session_entry)
+
+    async def get(self, username: str) -> SessionEntry:
+        return await self._call(self.cache.get, username)
+
+    async def remove(self, username: str):
+        return await self._call(self.cache.remove, username)
+
+    async def pop(self, username: str, include_attrs: bool = True) -> SessionEntry:
+        return await self._call(self.cache.pop, username, include_attrs)
+
+    async def find_username(
+        self, name_id: Optional[str] = None, session_index: Optional[str] = None
+    ) -> Optional[str]:
+        return await self._call(self.cache.find_username, name_id, session_index)
+
+    async def find_usernames(
+        self,
+        attribute: Optional[str] = None,
+        value: Optional[str] = None,
+        created_before: Optional[float] = None,
+    ) -> list:
+        return await self._call(
+            self.cache.find_usernames, attribute, value, created_before
+        )
+
+    async def remove_many(self, usernames: list) -> list:
+        return await self._call(self.cache.remove_many, usernames)
+
+
+class NamespacedCache(AsyncCache):
+    """Keeps the sessions of one tenant apart from the other tenants' in a shared
+    cache. Usernames are stored as "<namespace>/<username>", and lookups only find
+    usernames of the namespace, returned without the prefix. Hub usernames can't
+    contain "/", so the keys of the shared cache's own users never look namespaced.
+
+    name_id and session_index are only unique per IdP, so they are stored with the
+    same prefix, which keeps the shared cache's indexes of them apart as well.
+
+    Args:
+        cache: the shared cache
+        namespace: the tenant, which mustn't contain "/"
+    """
+
+    client_required = False
+
+    def __init__(self, cache: AsyncCache, namespace: str):
+        self.cache = cache
+        self.namespace = namespace
+        self._prefix = f"{namespace}/"
+
+    def _key(self, username: str) -> str:
+        return self._prefix + username
+
+    def _strip(self, usernames: list) -> list:
+        return [
+            username[len(self._prefix) :]
+            for username in usernames
+            if username.startswith(self._prefix)
+        ]
+
+    def _scoped(self, value: Optional[str]) -> Optional[str]:
+        return None if value is None else self._prefix + value
+
+    def _unscoped(self, value: Optional[str]) -> Optional[str]:
+        return None if value is None else value[len(self._prefix) :]
+
+    @staticmethod
+    def _with_ids(session_entry: SessionEntry, ids) -> SessionEntry:
+        # a copy, the entries of an in-memory cache are shared with the caller
+        if session_entry is None:
+            return None
+        copy = SessionEntry(**session_entry.to_dict())
+        copy.name_id = ids(session_entry.name_id)
+        copy.session_index = ids(session_entry.session_index)
+        return copy
+
+    async def upsert(self, username: str, session_entry: SessionEntry):
+        return await self.cache.upsert(
+            self._key(username), self._with_ids(session_entry, self._scoped)
+        )
+
+    async def get(self, username: str) -> SessionEntry:
+        session_entry = await self.cache.get(self._key(username))
+        return self._with_ids(session_entry, self._unscoped)
+
+    async def remove(self, username: str):
+        return await self.cache.remove(self._key(username))
+
+    async def pop(self, username: str, include_attrs: bool = True) -> SessionEntry:
+        session_entry = await self.cache.pop(self._key(username), include_attrs)
+        return self._with_ids(session_entry, self._unscoped)
+
+    async def find_username(
+        self, name_id: Optional[str] = None, session_index: Optional[str] = None
+    ) -> Optional[str]:
+        username = await self.cache.find_username(
+            self._scoped(name_id), self._scoped(session_index)
+        )
+        if username is None:
+            return None
+        return next(iter(self._strip([username])), None)
+
+    async def find_usernames(
+        self,
+        attribute: Optional[str] = None,
+        value: Optional[str] = None,
+        created_before: Optional[float] = None,
+    ) -> list:
+        return self._strip(
+            await self.cache.find_usernames(attribute, value, created_before)
+        )
+
+    async def remove_many(self, usernames: list) -> list:
+        keys = [self._key(username) for username in usernames]
+        return self._strip(await self.cache.remove_many(keys))
+
+
+class AsyncRedisCache(RedisCommands, AsyncCache):
+    """RedisCache built on redis.asyncio. Commands are awaited instead of blocking the
+    event loop for a network round trip.
+
+    client_kwargs are passed to the client, so the connection pool
+    (max_connections or connection_pool), timeouts and health checks are configured
+    there. Unset timeouts and health check interval fall back to default_client_kwargs
+
+    Args:
+        client: The asyncio Redis client class, or redis, cluster or sentinel.
+            Defaults to redis.asyncio.Redis
+        client_kwargs: keyword arguments for the client
+        retries: see redis_clients.create
+        retry_backoff: see redis_clients.create
+        options: see RedisCache
+    """
+
+    client_required = True
+
+    default_client_kwargs = {
+        "max_connections": 50,
+        "socket_timeout": 5,
+        "socket_connect_timeout": 5,
+        "health_check_interval": 30,
+    }
+
+    def __init__(
+        self,
+        client: Union[redis.asyncio.Redis, str],
+        client_kwargs: Dict[str, Any],
+        retries: Optional[int] = None,
+        retry_backoff: float = 1,
+        **options,
+    ):
+        super().__init__(**options)
+        self._check_client_kwargs(client_kwargs)
+        client_kwargs = {**self.default_client_kwargs, **(client_kwargs or {})}
+        self.client = redis_clients.create(
+            client,
+            client_kwargs,
+            use_asyncio=True,
+            retries=retries,
+            retry_backoff=retry_backoff,
+        )
+        self._check_client()
+
+    async def _transaction(
+        self, usernames: list, include_attrs: bool, queue_write
+    ) -> list:
+        """See RedisCache._transaction"""
+        pipe = self._pipeline()
+        try:
+            while True:
+                if self._watchable:
+                    await pipe.watch(*[self._key(username) for username in usernames])
+                read = self._pipeline(transaction=False)
+                self._queue_read_many(read, usernames, include_attrs)
+                session_entries = self._parse_read_many(
+                    await read.execute(raise_on_error=False), include_attrs
+                )
+
+                if self._watchable:
+                    pipe.multi()
+                queue_write(pipe, session_entries)
+                try:
+                    await pipe.execute()
+                    return session_entries
+                except WatchError:
+                    continue
+        finally:
+            await pipe.reset()
+
+    async def upsert(self, username: str, session_entry: SessionEntry):
+        await self._transaction(
+            [username],
+            False,
+            lambda pipe, previous: self._queue_upsert(
+                pipe, username, session_entry, previous[0]
+            ),
+        )
+
+    async def get(self, username: str) -> SessionEntry:
+        pipe = self._pipeline()
+        self._queue_get(pipe, username)
+        session_entry = self._parse_get(
+            username, await pipe.execute(raise_on_error=False)
+        )
+
+        if self.sliding_expiration and session_entry.name_id is not None:
+            pipe = self._pipeline(transaction=False)
+            self._queue_sliding_refresh(pipe, username, session_entry)
+            await pipe.execute()
+        return session_entry
+
+    async def remove(self, username: str):
+        await self.pop(username, include_attrs=False)
+
+    async def pop(self, username: str, include_attrs: bool = True) -> SessionEntry:
+        session_entries = await self._transaction(
+            [username],
+            include_attrs,
+            lambda pipe, previous: self._queue_remove(pipe, username, previous[0]),
+        )
+        return self._or_empty(username, session_entries[0])
+
+    async def find_username(
+        self, name_id: Optional[str] = None, session_index: Optional[str] = None
+    ) -> Optional[str]:
+        key = self._find_key(name_id, session_index)
+        username = _decode(await self.client.get(key)) if key is not None else None
+        if username is None:
+            return None
+
+        pipe = self._pipeline()
+        self._queue_read(pipe, username, include_attrs=False)
+        session_entry = self._parse_get(
+            username, await pipe.execute(raise_on_error=False), include_attrs=False
+        )
+        return username if session_entry.matches(name_id, session_index) else None
+
+    async def find_usernames(
+        self,
+        attribute: Optional[str] = None,
+        value: Optional[str] = None,
+        created_before: Optional[float] = None,
+    ) -> list:
+        pipe = self._pipeline(transaction=False)
+        self._queue_find_candidates(pipe, attribute, value, created_before)
+        candidates = self._parse_candidates(await pipe.execute())
+        if not candidates:
+            return candidates
+
+        pipe = self._pipeline(transaction=False)
+        self._queue_verify(pipe, candidates, attribute)
+        found, stale = self._parse_verify(
+            candidates, await pipe.execute(), attribute, value, created_before
+        )
+        if stale:
+            await self._prune(self.client, attribute, value, stale)
+        return found
+
+    async def remove_many(self, usernames: list) -> list:
+        if not usernames:
+            return []
+        session_entries = await self._transaction(
+            usernames,
+            False,
+            lambda pipe, previous: self._queue_remove_many(pipe, usernames, previous),
+        )
+        return [
+            username
+            for username, session_entry in zip(usernames, session_entries)
+            if session_entry is not None
+        ]
+
+
+class AuthStateCache(AsyncCache):
+    """Keeps sessions in JupyterHub's encrypted auth_state instead of a separate store.
+
+    Sessions survive hub restarts without redis or any extra network round trip. The
+    ACS handler hands the session to login_user as auth_state, which writes it to the
+    hub database along with the user, so upsert has nothing left to do. Requires
+    c.Authenticator.enable_auth_state = True and JUPYTERHUB_CRYPT_KEY.
+
+    users is set to the hub's UserDict by SAMLAuthenticator.
+
+    auth_state is encrypted per user, so it can't be indexed by name_id or
+    session_index and find_username never finds a session. IdP initiated logout
+    needs one of the other caches.
+    """
+
+    client_required = False
+    uses_auth_state = True
+
+    def __init__(self):
+        self.users = None
+
+    def _get_user(self, username: str):
+        if self.users is None:
+            raise CacheError("the auth-state cache has not been attached to the hub's users")
+        return self.users.get(username)
+
+    async def upsert(self, username: str, session_entry: SessionEntry):
+        return
+
+    async def get(self, username: str) -> SessionEntry:
+        user = self._get_user(username)
+        auth_state = await user.get_auth_state() if user is not None else None
+        if not auth_state:
+            app_log.error(f"no session information for username = {username}")
+            return SessionEntry()
+
+        return SessionEntry(**{field: auth_state.get(field) for field in SessionEntry.fields})
+
+    async def remove(self, username: str):
+        user = self._get_user(username)
+        if user is not None:
+            await user.save_auth_state(None)
+
+
+class _LocalCache(InMemoryCache):
+    """The local LRU of TieredCache. Its ttl bounds every entry, also those with a
+    later SessionNotOnOrAfter, since a missed invalidation is only corrected once the
+    entry is read from redis again"""
+
+    def _expiry(self, session_entry: SessionEntry) -> Optional[float]:
+        expires_at = super()._expiry(session_entry)
+        if self.ttl is None or session_entry.session_expiration is None:
+            return expires_at
+        return min(expires_at, time.time() + self.ttl)
+
+
+class TieredCache(AsyncRedisCache):
+    """AsyncRedisCache with a bounded local LRU of session entries in front of it.
+
+    Reads are served from the local cache without a network round trip. Every write
+    publishes the username on a pub/sub channel, in the same pipeline as the write,
+    and every process subscribed to it drops its local copy. If the subscription is
+    lost, invalidations may have been missed, so the local cache is cleared whenever
+    the subscription is (re-)established.
+
+    A sliding expiration is only refreshed when a read reaches redis.
+
+    Args:
+        client, client_kwargs, options: see AsyncRedisCache
+        local_max_entries: size of the local LRU
+        local_ttl: seconds a local entry is served without going back to redis, unless
+            the IdP's SessionNotOnOrAfter is earlier. None keeps it until invalidated
+        channel: pub/sub channel for invalidation messages. Defaults to
+            <key prefix>:invalidate, so that hubs sharing a redis with different
+            key_prefix don't evict each other's entries
+    """
+
+    def __init__(
+        self,
+        client: redis.asyncio.Redis,
+        client_kwargs: Dict[str, Any],
+        local_max_entries: int = 10000,
+        local_ttl: Optional[float] = 300,
+        channel: Optional[str] = None,
+        **options,
+    ):
+        super().__init__(client, client_kwargs, **options)
+        self.local = _LocalCache(max_entries=local_max_entries, ttl=local_ttl)
+        self.channel = channel or f"{self.index_prefix}:invalidate"
+
+        # identifies this process' own messages, which don't need to be acted upon
+        self._origin = uuid.uuid4().hex
+        self._listener = None
+
+    def _ensure_listener(self):
+        # started lazily since there may be no running event loop at creation time
+        if self._listener is None:
+            self._listener = asyncio.ensure_future(self._listen())
+
+    async def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub()
+                await pubsub.subscribe(self.channel)
+                self.local.clear()
+                async for message in pubsub.listen():
+                    self._handle_message(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                app_log.warning(
+                    f"lost subscription to {self.channel}, retrying. Error = {e}"
+                )
+                self.local.clear()
+                await asyncio.sleep(1)
+
+    def _handle_message(self, message: dict):
+        if message.get("type") != "message":
+            return
+
+        data = message["data"]
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        origin, _, username = data.partition(":")
+        if origin != self._origin:
+            self.local.discard(username)
+
+    def _queue_invalidate(self, pipe, username: str):
+        pipe.publish(self.channel, f"{self._origin}:{username}")
+
+    def _queue_upsert(
+        self,
+        pipe,
+        username: str,
+        session_entry: SessionEntry,
+        previous: Optional[SessionEntry] = None,
+    ):
+        super()._queue_upsert(pipe, username, session_entry, previous)
+        self._queue_invalidate(pipe, username)
+
+    def _queue_remove(
+        self, pipe, username: str, previous: Optional[SessionEntry] = None
+    ):
+        self.local.discard(username)
+        super()._queue_remove(pipe, username, previous)
+        self._queue_invalidate(pipe, username)
+
+    async def upsert(self, username: str, session_entry: SessionEntry):
+        self._ensure_listener()
+        await super().upsert(username, session_entry)
+        self.local.upsert(username, session_entry)
+
+    async def get(self, username: str) -> SessionEntry:
+        self._ensure_listener()
+        session_entry = self.local.lookup(username)
+        if session_entry is not None:
+            return session_entry
+
+        session_entry = await super().get(username)
+        if session_entry.name_id is not None:
+            self.local.upsert(username, session_entry)
+        return session_entry
+
+    async def pop(self, username: str, include_attrs: bool = True) -> SessionEntry:
+        self._ensure_listener()
+        self.local.discard(username)
+        return await super().pop(username, include_attrs)
+
+
+cache_map = {
+    "redis": RedisCache,
+    "async-redis": AsyncRedisCache,
+    "tiered": TieredCache,
+    "auth-state": AuthStateCache,
+    "sqlite": SQLiteCache,
+    "in-memory": InMemoryCache,
+    "disabled": DisabledCache,
+}
+
+
+def create(cache_spec: dict) -> Union[Cache, AsyncCache]:
     """Factory for creating a cache
 
     Args:
-        cache_spec (dict): SPecifications for a cache
+        cache_spec (dict): SPecifications for a cache. Keys other than type, client and
+            client_kwargs are passed to the cache as keyword arguments
 
     Raises:
         CacheError: undefined cache type
 
     Returns:
-        Cache: an instance of a cache
+        Union[Cache, AsyncCache]: an instance of a cache
     """
     # check cache_spec keys
     if "type" not in cache_spec:
-        raise AttributeError(f"you must specify key = 'type' in cache_spec")
+        raise AttributeError("you must specify key = 'type' in cache_spec")
 
     # check cache type
     cache_type = cache_spec["type"]
@@ -150,6 +2166,12 @@ def create(cache_spec: dict) -> Cache:
             f"couldn't create the cache. cache_type = {cache_type} is not allowed. Allowed values = {cache_map.keys()}"
         )
 
+    options = {
+        key: value
+        for key, value in cache_spec.items()
+        if key not in ("type", "client", "client_kwargs")
+    }
+
     cache_to_created = cache_map[cache_type]
     app_log.info(f"Creating cache['type'] = {cache_type}")
     if cache_to_created.client_required:
@@ -159,25 +2181,49 @@ def create(cache_spec: dict) -> Cache:
                 f"specify either client or client_kwargs in cache_spec. Its required for type = {cache_type}"
             )
 
-        return cache_map[cache_type](cache_spec["client"], cache_spec["client_kwargs"])
+        return cache_map[cache_type](
+            cache_spec.get("client"), cache_spec.get("client_kwargs"), **options
+        )
 
-    return cache_map[cache_type]()
+    return cache_map[cache_type](**options)
 
 
-def register(cache: Cache):
+def register(cache: Union[Cache, AsyncCache]):
     """Singleton function for registering a cache"""
-    if not isinstance(cache, Cache):
+    if not isinstance(cache, (Cache, AsyncCache)):
         raise AttributeError(f"You must specify a Cache object, not = {type(cache)}")
 
-    global __session_cache
+    global __session_cache, __async_session_cache
     __session_cache = cache
+    __async_session_cache = (
+        cache if isinstance(cache, AsyncCache) else SyncCacheAdapter(cache)
+    )
+    __namespaced_caches.clear()
 
 
 def get():
     """Singleton function for getting a registered cache. You must register a cache before calling
     this function"""
-    global __session_cache
     if not __session_cache:
         raise CacheError("you must register a cache first with register(cache)")
 
     return __session_cache
+
+
+def get_async(namespace: Optional[str] = None) -> AsyncCache:
+    """Like get(), but always returns the AsyncCache interface. Synchronous caches are
+    wrapped in a SyncCacheAdapter.
+
+    With a namespace the sessions of that tenant are returned, see NamespacedCache.
+    auth_state belongs to the hub user, so the auth-state cache isn't namespaced"""
+    if not __async_session_cache:
+        raise CacheError("you must register a cache first with register(cache)")
+
+    if namespace is None or __async_session_cache.uses_auth_state:
+        return __async_session_cache
+
+    namespaced = __namespaced_caches.get(namespace)
+    if namespaced is None:
+        namespaced = NamespacedCache(__async_session_cache, namespace)
+        __namespaced_caches[namespace] = namespaced
+    return namespaced
@@ -1,12 +1,50 @@
+from jupyterhub import orm
+from jupyterhub.apihandlers import APIHandler
 from jupyterhub.handlers import LoginHandler, BaseHandler, LogoutHandler
+from jupyterhub.scopes import needs_scope
+from jupyterhub.utils import new_token
 from onelogin.saml2.auth import OneLogin_Saml2_Auth
+from onelogin.saml2.constants import OneLogin_Saml2_Constants
+from onelogin.saml2.errors import OneLogin_Saml2_Error
+from onelogin.saml2.logout_request import OneLogin_Saml2_Logout_Request
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Optional
+import gzip
+import hashlib
+import json
+import time
 import tornado
+from tornado.ioloop import IOLoop
 from tornado.log import app_log
 import tornado.web
 import os
 from . import cache
-
-__all__ = ["MetadataHandler", "SamlLoginHandler", "SamlLogoutHandler", "ACSHandler"]
+from . import keys
+from . import prefilter
+from . import settings
+from . import tenants
+
+__all__ = [
+    "MetadataHandler",
+    "SamlLoginHandler",
+    "SamlLogoutHandler",
+    "SamlSLOHandler",
+    "SessionRevocationHandler",
+    "ACSHandler",
+]
+
+
+def is_https(request, https_override=False) -> bool:
+    # the request may use https, however, request.protocol may interpret it
+    # as http. Have an environment variable to override this at
+    # the app level in case this happens
+    return bool(
+        os.environ.get("SAML_HTTPS_OVERRIDE")
+        or request.protocol == "https"
+        or https_override
+    )
 
 
 def format_request(request, https_override=False):
@@ -14,15 +52,8 @@ def format_request(request, https_override=False):
     for key in request.arguments:
         dataDict[key] = request.arguments[key][0].decode("utf-8")
 
-    # the request may use https, however, request.protocol may interpret it
-    # as http. Have an environment variable to override this at
-    # the app level in case this happens
     https = "off"
-    if (
-        os.environ.get("SAML_HTTPS_OVERRIDE")
-        or request.protocol == "https"
-        or https_override
-    ):
+    if is_https(request, https_override):
         https = "on"
 
     result = {
@@ -38,7 +69,53 @@ def format_request(request, https_override=False):
     return result
 
 
+def project_attributes(attributes: dict, names=None, limits=None) -> dict:
+    """Keep only the SAML attributes in names (all of them if names is None) and at most
+    limits[name] values of each attribute"""
+    limits = limits or {}
+    if names is not None:
+        attributes = {name: attributes[name] for name in names if name in attributes}
+
+    projected = {}
+    for name, values in attributes.items():
+        limit = limits.get(name)
+        if limit is not None and isinstance(values, (list, tuple)):
+            values = values[:limit]
+        projected[name] = values
+    return projected
+
+
+def revoke_hub_logins(
+    db, usernames: list, kept_token_client_id: str = "jupyterhub"
+) -> int:
+    """Log users out of the hub everywhere. Rotating their cookie_id invalidates every
+    hub login cookie, and the OAuth tokens issued to their servers and services are
+    deleted. Tokens with kept_token_client_id, which users create themselves, are kept.
+
+    Returns:
+        int: number of users found in the hub database
+    """
+    revoked = 0
+    # keep the IN lists well below the database's bound parameter limit
+    for start in range(0, len(usernames), 500):
+        batch = usernames[start : start + 500]
+        orm_users = db.query(orm.User).filter(orm.User.name.in_(batch)).all()
+        for orm_user in orm_users:
+            orm_user.cookie_id = new_token()
+        db.query(orm.APIToken).filter(
+            orm.APIToken.user_id.in_([orm_user.id for orm_user in orm_users]),
+            orm.APIToken.client_id != kept_token_client_id,
+        ).delete(synchronize_session=False)
+        revoked += len(orm_users)
+
+    db.commit()
+    return revoked
+
+
 class BaseHandlerMixin:
+    # tenants.TenantRouter, None serves every request with saml_settings_path
+    tenant_router = None
+
     @property
     def saml_settings_path(self):
         return self._saml_settings_path
@@ -51,12 +128,43 @@ class BaseHandlerMixin:
         self._saml_settings_path = path
 
     @property
-    def session_cache(self):
+    def tenant(self) -> Optional[str]:
+        """The tenant of the request, None without a tenant_router or if the request
+        doesn't name one. An unknown tenant is a 404"""
         try:
-            return self._session_cache.get()
+            return self._tenant
         except AttributeError:
-            self._session_cache = cache
-            return self._session_cache.get()
+            pass
+
+        tenant = None
+        if self.tenant_router is not None:
+            try:
+                tenant = self.tenant_router.resolve(self)
+            except tenants.TenantError as e:
+                app_log.warning(f"Could not route SAML request. Error = {e}")
+                raise tornado.web.HTTPError(404)
+        self._tenant = tenant
+        return tenant
+
+    @property
+    def settings_path(self) -> str:
+        """The settings directory of the request's tenant"""
+        tenant = self.tenant
+        if tenant is None:
+            return self.saml_settings_path
+        return self.tenant_router.settings_path(tenant)
+
+    @property
+    def session_cache(self) -> cache.AsyncCache:
+        try:
+            session_cache = self._session_cache
+        except AttributeError:
+            self._session_cache = session_cache = cache
+
+        tenant = self.tenant
+        if tenant is None:
+            return session_cache.get_async()
+        return session_cache.get_async(namespace=tenant)
 
     @session_cache.setter
     def session_cache(self, session_cache):
@@ -91,10 +199,10 @@ class BaseHandlerMixin:
                     = {dir_contents}"
                 )
 
-    def setup_auth(self) -> OneLogin_Saml2_Auth:
-        request = format_request(self.request, self.https_override)
-        onelogin_auth = OneLogin_Saml2_Auth(
-            request, custom_base_path=self.saml_settings_path
+    def setup_auth(self, request: Optional[dict] = None) -> OneLogin_Saml2_Auth:
+        request = request or format_request(self.request, self.https_override)
+        onelogin_auth = keys.IndexedAuth(
+            request, old_settings=settings.get(self.settings_path)
         )
         return onelogin_auth
 
@@ -103,26 +211,127 @@ class BaseHandlerMixin:
         return
 
 
+@dataclass(frozen=True)
+class RenderedMetadata:
+    """SP metadata rendered and validated once per settings snapshot"""
+
+    body: bytes
+    errors: list
+    etag: str
+    last_modified: float
+    gzipped: Optional[bytes] = None
+
+    @property
+    def gzip_etag(self) -> str:
+        return f'{self.etag[:-1]}-gzip"'
+
+
+def render_metadata(
+    saml_settings, loaded_at: float, compress: bool = True
+) -> RenderedMetadata:
+    metadata = saml_settings.get_sp_metadata()
+    errors = saml_settings.validate_metadata(metadata)
+    if errors:
+        app_log.error(f"Could not serve metadata. Errors = {errors}")
+
+    body = metadata.encode("utf-8") if isinstance(metadata, str) else metadata
+    return RenderedMetadata(
+        body=body,
+        errors=errors,
+        etag=f'"{hashlib.sha256(body).hexdigest()[:32]}"',
+        last_modified=loaded_at,
+        gzipped=gzip.compress(body, mtime=0) if compress else None,
+    )
+
+
 class MetadataHandler(BaseHandlerMixin, BaseHandler):
+    """Serves the SP metadata. It is rendered and validated once per settings snapshot
+    and served with an ETag, Last-Modified and Cache-Control, so polling IdPs and
+    federation aggregators mostly get a 304.
+    """
+
+    max_age = 3600
+    compress = True
+
+    # settings path -> (settings snapshot, RenderedMetadata)
+    _rendered = {}
+
+    def rendered_metadata(self) -> RenderedMetadata:
+        settings_path = self.settings_path
+        snapshot = settings.snapshot(settings_path)
+        cached = MetadataHandler._rendered.get(settings_path)
+        if cached is None or cached[0] is not snapshot:
+            rendered = render_metadata(
+                snapshot.settings, snapshot.loaded_at, self.compress
+            )
+            cached = (snapshot, rendered)
+            MetadataHandler._rendered[settings_path] = cached
+
+        return cached[1]
+
+    def not_modified(self, etag: str, last_modified: float) -> bool:
+        if_none_match = self.request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = {tag.strip() for tag in if_none_match.split(",")}
+            tags |= {tag[2:] for tag in tags if tag.startswith("W/")}
+            return "*" in tags or etag in tags
+
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        if if_modified_since is None:
+            return False
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(last_modified) <= since
+
     def get(self):
-        auth = self.setup_auth()
-        saml_settings = auth.get_settings()
-        metadata = saml_settings.get_sp_metadata()
-        errors = saml_settings.validate_metadata(metadata)
+        rendered = self.rendered_metadata()
+
+        if rendered.errors:
+            self.write(", ".join(rendered.errors))
+            return
+
+        use_gzip = rendered.gzipped is not None and "gzip" in self.request.headers.get(
+            "Accept-Encoding", ""
+        )
+        etag = rendered.gzip_etag if use_gzip else rendered.etag
+
+        self.set_header("Content-Type", "text/xml")
+        self.set_header("ETag", etag)
+        self.set_header(
+            "Last-Modified", tornado.httputil.format_timestamp(rendered.last_modified)
+        )
+        self.set_header("Cache-Control", f"public, max-age={self.max_age}")
+        if rendered.gzipped is not None:
+            self.set_header("Vary", "Accept-Encoding")
+
+        if self.not_modified(etag, rendered.last_modified):
+            self.set_status(304)
+            return
 
-        if len(errors) == 0:
-            self.set_header("Content-Type", "text/xml")
-            self.write(metadata)
+        if use_gzip:
+            self.set_header("Content-Encoding", "gzip")
+            self.write(rendered.gzipped)
         else:
-            app_log.error(f"Could not serve metadata. Errors = {errors}")
-            self.write(", ".join(errors))
+            self.write(rendered.body)
 
 
 class SamlLoginHandler(BaseHandlerMixin, LoginHandler):
+    # idstore.IdStore of outstanding AuthnRequest IDs, None disables tracking
+    request_store = None
+
     async def get(self):
         auth = self.setup_auth()
         return_to = f"{self.request.host}/acs"
-        return self.redirect(auth.login(return_to))
+        login_url = auth.login(return_to)
+        if self.request_store is not None:
+            await self.request_store.add(auth.get_last_request_id())
+        if self.tenant_router is not None:
+            self.tenant_router.remember(
+                self, self.tenant, is_https(self.request, self.https_override)
+            )
+        return self.redirect(login_url)
 
 
 class SamlLogoutHandler(BaseHandlerMixin, LogoutHandler):
@@ -207,8 +416,7 @@ class SamlLogoutHandler(BaseHandlerMixin, LogoutHandler):
         for cookie in self.session_cookie_names:
             self.clear_cookie(cookie)
 
-        user_entry = self.session_cache.get(username)
-        self.session_cache.remove(username)
+        user_entry = await self.session_cache.pop(username, include_attrs=False)
 
         if self.idp_logout:
             if not self.unencrypted_logout:
@@ -226,39 +434,356 @@ class SamlLogoutHandler(BaseHandlerMixin, LogoutHandler):
                 self.redirect(url, status=307)
 
 
+class SamlSLOHandler(BaseHandlerMixin, BaseHandler):
+    """Single logout service handler for logout started by the IdP.
+
+    The IdP's LogoutRequest only names the SAML session, so once python3-saml has
+    validated it the user is looked up by session index (or NameID) in the session
+    cache. That user is logged out of the hub everywhere, see revoke_hub_logins. The
+    IdP is then redirected to with a LogoutResponse.
+
+    LogoutResponses to a logout started by the hub are validated and redirected to the
+    hub.
+    """
+
+    async def get(self):
+        auth = self.setup_auth()
+        try:
+            url = auth.process_slo(keep_local_session=True)
+        except OneLogin_Saml2_Error as e:
+            app_log.error(f"no SAML logout message found. Error = {e}")
+            raise tornado.web.HTTPError(400)
+
+        errors = auth.get_errors()
+        if len(errors) != 0:
+            app_log.error(
+                f"SAML single logout error. Errors = {errors}, "
+                f"reason = {auth.get_last_error_reason()}"
+            )
+            raise tornado.web.HTTPError(400)
+
+        if url is None:
+            # a LogoutResponse, the user was logged out before going to the IdP
+            return self.redirect(self.get_next_url())
+
+        username = await self.find_logout_user(auth)
+        if username is None:
+            app_log.warning("no session found for SAML LogoutRequest")
+        else:
+            await self.revoke_user(username)
+        return self.redirect(url)
+
+    async def find_logout_user(self, auth: OneLogin_Saml2_Auth) -> Optional[str]:
+        request_xml = auth.get_last_request_xml()
+        name_id = OneLogin_Saml2_Logout_Request.get_nameid(
+            request_xml, auth.get_settings().get_sp_key()
+        )
+        session_indexes = OneLogin_Saml2_Logout_Request.get_session_indexes(request_xml)
+
+        for session_index in session_indexes or [None]:
+            username = await self.session_cache.find_username(name_id, session_index)
+            if username is not None:
+                return username
+        return None
+
+    async def revoke_user(self, username: str):
+        await self.session_cache.pop(username, include_attrs=False)
+        revoke_hub_logins(self.db, [username])
+        app_log.info(f"IdP initiated logout of {username}")
+
+
+class SessionRevocationHandler(APIHandler):
+    """Admin only API for revoking SAML sessions in bulk.
+
+    POST a JSON object with any of
+    - usernames: users whose sessions are revoked
+    - attribute and value: sessions whose SAML attribute has the value. attribute has
+      to be one of the session cache's indexed_attributes
+    - older_than: sessions that logged in more than this many seconds ago
+    Given together, these all have to match. The sessions are removed from the
+    session cache in one batch and the users are logged out of the hub, see
+    revoke_hub_logins. Responds with the revoked usernames.
+
+    With a tenant_router, the sessions of every tenant are revoked.
+    """
+
+    # tenants.TenantRouter, whose tenants' session cache namespaces are searched
+    tenant_router = None
+
+    def session_caches(self) -> list:
+        """The session cache of requests without a tenant and that of every tenant"""
+        session_caches = [cache.get_async()]
+        if self.tenant_router is not None:
+            for tenant in self.tenant_router.settings_paths:
+                session_cache = cache.get_async(namespace=tenant)
+                if session_cache not in session_caches:
+                    session_caches.append(session_cache)
+        return session_caches
+
+    @needs_scope("admin:users")
+    async def post(self):
+        body = self.get_json_body() or {}
+        usernames = body.get("usernames")
+        attribute = body.get("attribute")
+        value = body.get("value")
+        older_than = body.get("older_than")
+
+        if usernames is None and attribute is None and older_than is None:
+            raise tornado.web.HTTPError(
+                400, "one of usernames, attribute or older_than is required"
+            )
+        if usernames is not None and not (
+            isinstance(usernames, list) and all(isinstance(u, str) for u in usernames)
+        ):
+            raise tornado.web.HTTPError(400, "usernames must be a list of usernames")
+        if (attribute is None) != (value is None):
+            raise tornado.web.HTTPError(400, "attribute and value go together")
+        if older_than is not None and not isinstance(older_than, (int, float)):
+            raise tornado.web.HTTPError(400, "older_than must be a number of seconds")
+
+        session_caches = self.session_caches()
+        if attribute is not None or older_than is not None:
+            created_before = None
+            if older_than is not None:
+                created_before = time.time() - older_than
+            found = []
+            try:
+                for session_cache in session_caches:
+                    found += await session_cache.find_usernames(
+                        attribute, value, created_before
+                    )
+            except cache.CacheError as e:
+                raise tornado.web.HTTPError(400, str(e))
+
+            # without a namespace, the shared cache also finds the tenants' keys
+            if self.tenant_router is not None:
+                found = [u for u in found if not self.tenant_router.namespaced(u)]
+            # a user may have logged in through several tenants
+            found = list(dict.fromkeys(found))
+            if usernames is not None:
+                found = set(found)
+                found = [username for username in usernames if username in found]
+            usernames = found
+
+        removed = set()
+        for session_cache in session_caches:
+            removed.update(await session_cache.remove_many(usernames))
+        revoke_hub_logins(self.db, usernames)
+        app_log.info(
+            f"revoked SAML sessions of {len(usernames)} users, "
+            f"{len(removed)} were cached"
+        )
+
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"revoked": usernames}))
+
+
 class ACSHandler(BaseHandlerMixin, BaseHandler):
     """Assertion consumer service (ACS) handler.  This handler checks the data
     received via a POST request from a SAML server within the SAML workflow.
     https://goteleport.com/blog/how-saml-authentication-works/
+
+    Response processing (decoding, XML parsing, signature verification and
+    decryption) is CPU bound, so it runs on the executor instead of the event loop.
+    At most max_pending responses are queued or running at once; anything beyond
+    that is rejected with a 503 instead of piling up.
     """
 
+    executor = None
+    max_pending = 0
+
+    cached_attributes = None
+    cached_attribute_limits = {}
+
+    # prefix of tenants' usernames, formatted with {tenant}
+    tenant_username_prefix = ""
+
+    # idstore.IdStore of consumed assertion IDs, None disables replay protection
+    replay_store = None
+
+    # idstore.IdStore of outstanding AuthnRequest IDs, shared with SamlLoginHandler
+    request_store = None
+    allow_unsolicited = True
+
+    # prefilter.Prefilter, None disables the checks before process_response
+    response_prefilter = None
+
+    # number of responses queued or running on the executor. Only touched from
+    # the event loop thread
+    _pending = 0
+
+    def check_pending(self):
+        """Reject a response with a 503 while max_pending responses are pending. Done
+        before the AuthnRequest ID is consumed, so that the response can be retried"""
+        if self.max_pending and ACSHandler._pending >= self.max_pending:
+            app_log.warning(
+                f"rejecting SAML response, {ACSHandler._pending} responses already pending"
+            )
+            raise tornado.web.HTTPError(503)
+
+    async def process_response(
+        self, auth: OneLogin_Saml2_Auth, request_id: Optional[str] = None
+    ):
+        self.check_pending()
+        ACSHandler._pending += 1
+        try:
+            await IOLoop.current().run_in_executor(
+                self.executor, auth.process_response, request_id
+            )
+        finally:
+            ACSHandler._pending -= 1
+
+    def prefilter_response(self, request: dict) -> prefilter.ResponseHeader:
+        """Reject a malformed or unexpected SAMLResponse with a 400 before it is
+        parsed and its signature verified"""
+        saml_response = request["post_data"].get("SAMLResponse")
+        if self.response_prefilter is None:
+            try:
+                return prefilter.scan(prefilter.decode(saml_response or ""))
+            except prefilter.PrefilterError:
+                return prefilter.ResponseHeader()
+
+        saml_settings = settings.get(self.settings_path)
+        try:
+            return self.response_prefilter.check(
+                saml_response,
+                saml_settings.get_idp_data()["entityId"],
+                OneLogin_Saml2_Utils.get_self_url_no_query(request),
+                saml_settings.is_strict(),
+            )
+        except prefilter.PrefilterError as e:
+            app_log.warning(f"Rejecting SAML response. Error = {e}")
+            raise tornado.web.HTTPError(400)
+
+    def reject_response(self, request: dict):
+        if self.response_prefilter is not None:
+            self.response_prefilter.reject(request["post_data"].get("SAMLResponse", ""))
+
+    async def consume_request_id(
+        self, header: prefilter.ResponseHeader
+    ) -> Optional[str]:
+        """Consume the outstanding AuthnRequest ID the posted response answers.
+        Unsolicited responses (IdP initiated logins) have no InResponseTo and are only
+        accepted if allow_unsolicited is set.
+
+        The ID comes from prefilter.scan of the unverified XML, which a crafted
+        response can mislead, so check_in_response_to compares it with the validated
+        response afterwards.
+        """
+        if self.request_store is None:
+            return None
+
+        request_id = header.in_response_to
+        if request_id is None:
+            if self.allow_unsolicited:
+                return None
+            app_log.error("Rejecting unsolicited SAML response")
+            raise tornado.web.HTTPError(403)
+
+        if not await self.request_store.take(request_id):
+            app_log.error(
+                f"SAML response to an unknown or expired AuthnRequest. "
+                f"InResponseTo = {request_id}"
+            )
+            raise tornado.web.HTTPError(403)
+        return request_id
+
+    def check_in_response_to(
+        self, auth: OneLogin_Saml2_Auth, request_id: Optional[str]
+    ):
+        """Reject a validated response whose InResponseTo isn't the consumed request ID.
+
+        python3-saml only compares the two if the response has an InResponseTo, so
+        this also rejects a response made to look solicited, e.g. by a comment that
+        misleads the scan, when it actually is unsolicited.
+        """
+        if self.request_store is None:
+            return
+
+        in_response_to = auth._last_response.get("InResponseTo")
+        if in_response_to != request_id:
+            app_log.error(
+                f"SAML response doesn't answer the consumed AuthnRequest. "
+                f"InResponseTo = {in_response_to}, request ID = {request_id}"
+            )
+            raise tornado.web.HTTPError(403)
+
+    async def check_replay(self, auth: OneLogin_Saml2_Auth):
+        """Reject a response whose assertion was already consumed. The ID is kept
+        until the assertion's NotOnOrAfter, after which python3-saml rejects it anyway.
+        """
+        if self.replay_store is None:
+            return
+
+        assertion_id = auth.get_last_assertion_id() or auth.get_last_message_id()
+        if assertion_id is None:
+            return
+
+        expires_at = auth.get_last_assertion_not_on_or_after()
+        if expires_at is not None:
+            expires_at += OneLogin_Saml2_Constants.ALLOWED_CLOCK_DRIFT
+
+        if not await self.replay_store.add(assertion_id, expires_at):
+            app_log.error(f"SAML assertion replayed. Assertion ID = {assertion_id}")
+            raise tornado.web.HTTPError(403)
+
+    def tenant_username(self, username: str) -> str:
+        """The hub username of a user of the request's tenant, which is prefixed with
+        tenant_username_prefix so that IdPs can't log in each other's users"""
+        if self.tenant is None:
+            return username
+        return self.tenant_username_prefix.format(tenant=self.tenant) + username
+
     async def post(self):
-        auth = self.setup_auth()
-        auth.process_response()
+        request = format_request(self.request, self.https_override)
+        header = self.prefilter_response(request)
+        auth = self.setup_auth(request)
+        self.check_pending()
+        request_id = await self.consume_request_id(header)
+        try:
+            await self.process_response(auth, request_id)
+        except tornado.web.HTTPError as e:
+            # other responses took the last slots meanwhile, keep the ID for the retry
+            if e.status_code == 503 and request_id is not None:
+                await self.request_store.add(request_id)
+            raise
 
         errors = auth.get_errors()
 
         if len(errors) != 0:
             app_log.error(f"SAML authentication error. Errors = {errors}")
+            self.reject_response(request)
             raise tornado.web.HTTPError(500)
 
         if not auth.is_authenticated():
             app_log.error("SAML User is not authenticated!")
+            self.reject_response(request)
             raise tornado.web.HTTPError(401)
 
+        self.check_in_response_to(auth, request_id)
+        await self.check_replay(auth)
+
         user_data = auth.get_attributes()
-        username = self.extract_username(user_data)
+        username = self.tenant_username(self.extract_username(user_data))
 
         # add the user to the cache
         session_entry = cache.SessionEntry(
             name_id=auth.get_nameid(),
-            saml_attrs=auth.get_attributes(),
+            saml_attrs=project_attributes(
+                user_data, self.cached_attributes, self.cached_attribute_limits
+            ),
             session_index=auth.get_session_index(),
+            session_expiration=auth.get_session_expiration(),
+            created_at=int(time.time()),
         )
 
-        self.session_cache.upsert(username, session_entry)
+        await self.session_cache.upsert(username, session_entry)
+
+        login_data = {"name": username}
+        if self.session_cache.uses_auth_state:
+            login_data["auth_state"] = session_entry.to_dict()
 
-        user = await self.login_user({"name": username})
+        user = await self.login_user(login_data)
         if user is None:
             app_log.error(
                 f"Could not log in user via jupyterhub. \
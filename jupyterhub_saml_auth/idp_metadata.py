@@ -0,0 +1,230 @@
+import hashlib
+import os
+import time
+from typing import Dict, Optional
+
+from onelogin.saml2.idp_metadata_parser import OneLogin_Saml2_IdPMetadataParser
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+from onelogin.saml2.xml_utils import OneLogin_Saml2_XML
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.log import app_log
+
+from . import settings
+
+__fetchers: Dict[str, "IdPMetadataFetcher"] = {}
+
+
+class IdPMetadataError(Exception):
+    pass
+
+
+def parse(
+    xml: bytes, entity_id: Optional[str] = None, signing_cert: Optional[str] = None
+) -> dict:
+    """Validate IdP metadata and extract the IdP settings from it
+
+    Args:
+        xml (bytes): the metadata
+        entity_id (str): the EntityDescriptor to use if there are several
+        signing_cert (str): if set, the metadata must be signed with this certificate
+
+    Raises:
+        IdPMetadataError: the metadata is expired, isn't signed by signing_cert or
+            doesn't describe an IdP
+
+    Returns:
+        dict: settings to merge with OneLogin_Saml2_IdPMetadataParser.merge_settings
+    """
+    try:
+        dom = OneLogin_Saml2_XML.to_etree(xml)
+    except Exception as e:
+        raise IdPMetadataError(f"could not parse IdP metadata. Error = {e}") from e
+
+    valid_until = dom.get("validUntil")
+    if (
+        valid_until
+        and OneLogin_Saml2_Utils.parse_SAML_to_time(valid_until) <= time.time()
+    ):
+        raise IdPMetadataError(f"IdP metadata expired at {valid_until}")
+
+    if signing_cert:
+        try:
+            OneLogin_Saml2_Utils.validate_metadata_sign(
+                xml,
+                OneLogin_Saml2_Utils.format_cert(signing_cert),
+                raise_exceptions=True,
+            )
+        except Exception as e:
+            raise IdPMetadataError(
+                f"invalid IdP metadata signature. Error = {e}"
+            ) from e
+
+    idp_metadata = OneLogin_Saml2_IdPMetadataParser.parse(xml, entity_id=entity_id)
+    if not idp_metadata.get("idp"):
+        raise IdPMetadataError("no IDPSSODescriptor found in the IdP metadata")
+    return idp_metadata
+
+
+class IdPMetadataFetcher:
+    """Periodically pulls IdP metadata from a URL or a local file and merges it into
+    the settings snapshot of a settings directory.
+
+    URLs are fetched with conditional GETs (If-None-Match/If-Modified-Since) and files
+    are only read when their size or modification time changes. Parsing and swapping
+    in the settings happen on an executor thread. If the metadata can't be fetched or
+    is invalid, the last good copy keeps serving.
+
+    Args:
+        settings_path (str): settings directory the metadata is merged into
+        source (str): http(s) URL or file path of the metadata
+        interval (float): seconds between checks
+        entity_id (str): see parse
+        signing_cert (str): see parse
+        timeout (float): seconds before a fetch is abandoned
+    """
+
+    def __init__(
+        self,
+        settings_path: str,
+        source: str,
+        interval: float,
+        entity_id: Optional[str] = None,
+        signing_cert: Optional[str] = None,
+        timeout: float = 30,
+    ):
+        self.settings_path = settings_path
+        self.source = source
+        self.interval = interval
+        self.entity_id = entity_id
+        self.signing_cert = signing_cert
+        self.timeout = timeout
+
+        # validators of the last metadata that was merged successfully
+        self._etag = None
+        self._last_modified = None
+        self._file_signature = None
+        self._digest = None
+        self._periodic = PeriodicCallback(self.check, interval * 1000)
+
+    @property
+    def is_url(self) -> bool:
+        return self.source.startswith(("http://", "https://"))
+
+    def start(self):
+        self._periodic.start()
+        IOLoop.current().add_callback(self.check)
+
+    def stop(self):
+        self._periodic.stop()
+
+    async def _fetch_url(self) -> Optional[tuple]:
+        headers = {}
+        if self._etag:
+            headers["If-None-Match"] = self._etag
+        if self._last_modified:
+            headers["If-Modified-Since"] = self._last_modified
+
+        try:
+            response = await AsyncHTTPClient().fetch(
+                self.source,
+                headers=headers,
+                request_timeout=self.timeout,
+                raise_error=False,
+            )
+        except (OSError, HTTPClientError) as e:
+            raise IdPMetadataError(f"could not fetch {self.source}. Error = {e}") from e
+        if response.code == 304:
+            return None
+        if response.error is not None:
+            raise IdPMetadataError(
+                f"could not fetch {self.source}. Error = {response.error}"
+            )
+
+        validators = (
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+        )
+        return response.body, validators
+
+    def _read_file(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.source)
+            file_signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            if file_signature == self._file_signature:
+                return None
+            with open(self.source, "rb") as f:
+                return f.read(), file_signature
+        except OSError as e:
+            raise IdPMetadataError(f"could not read {self.source}. Error = {e}") from e
+
+    def _merge(self, xml: bytes):
+        idp_metadata = parse(xml, self.entity_id, self.signing_cert)
+        try:
+            settings.update_idp_metadata(self.settings_path, idp_metadata)
+        except settings.SettingsError as e:
+            raise IdPMetadataError(str(e)) from e
+
+    async def check(self) -> bool:
+        """Merge the metadata if it changed since the last successful check.
+
+        Returns:
+            bool: whether new settings were swapped in
+        """
+        loop = IOLoop.current()
+        try:
+            if self.is_url:
+                fetched = await self._fetch_url()
+            else:
+                fetched = await loop.run_in_executor(None, self._read_file)
+            if fetched is None:
+                return False
+
+            xml, validators = fetched
+            digest = hashlib.sha256(xml).digest()
+            # servers without validators send the same metadata every time
+            if digest != self._digest:
+                await loop.run_in_executor(None, self._merge, xml)
+        except IdPMetadataError as e:
+            app_log.error(
+                f"keeping previous IdP metadata for {self.settings_path}. {e}"
+            )
+            return False
+
+        # only remember the validators once the metadata is in use, so a copy that
+        # failed is fetched again on the next check
+        if self.is_url:
+            self._etag, self._last_modified = validators
+        else:
+            self._file_signature = validators
+        if digest == self._digest:
+            return False
+
+        self._digest = digest
+        app_log.info(
+            f"merged IdP metadata from {self.source} into {self.settings_path}"
+        )
+        return True
+
+
+def watch(
+    settings_path: str, source: str, interval: float, **kwargs
+) -> IdPMetadataFetcher:
+    """Start fetching IdP metadata for settings_path. Only one fetcher is kept per
+    settings directory. kwargs are passed to IdPMetadataFetcher"""
+    fetcher = __fetchers.get(settings_path)
+    if fetcher is None:
+        fetcher = IdPMetadataFetcher(settings_path, source, interval, **kwargs)
+        fetcher.start()
+        __fetchers[settings_path] = fetcher
+
+    return fetcher
+
+
+def unwatch(settings_path: Optional[str] = None):
+    """Stop the fetcher for settings_path, or every fetcher if settings_path is None"""
+    paths = list(__fetchers) if settings_path is None else [settings_path]
+    for path in paths:
+        fetcher = __fetchers.pop(path, None)
+        if fetcher is not None:
+            fetcher.stop()
@@ -0,0 +1,235 @@
+from abc import ABCMeta, abstractmethod
+from typing import Any, Dict, Optional, Union
+import heapq
+import time
+
+from tornado.log import app_log
+import redis.asyncio
+
+from . import redis_clients
+
+
+class IdStoreError(Exception):
+    pass
+
+
+class IdStore(metaclass=ABCMeta):
+    """Interface for a store of one-time IDs, e.g. the IDs of consumed assertions.
+
+    Every ID is kept until its expiry, after which it may be added again.
+
+    Args:
+        default_ttl: seconds an ID is kept when add() isn't given an expiry
+    """
+
+    client_required = False
+
+    def __init__(self, default_ttl: float = 3600):
+        self.default_ttl = default_ttl
+
+    def _expiry(self, expires_at: Optional[float]) -> float:
+        if expires_at is None:
+            return time.time() + self.default_ttl
+        return expires_at
+
+    @abstractmethod
+    async def add(self, id: str, expires_at: Optional[float] = None) -> bool:
+        """Record id until the expires_at unix timestamp.
+
+        Returns:
+            bool: False if id was already recorded and hasn't expired yet
+        """
+        pass
+
+    @abstractmethod
+    async def take(self, id: str) -> bool:
+        """Atomically remove id, so that only one caller can consume it.
+
+        Returns:
+            bool: True if id was recorded and hadn't expired
+        """
+        pass
+
+
+class InMemoryIdStore(IdStore):
+    """IdStore for a single hub process.
+
+    IDs are kept in a dict for O(1) lookups and grouped into buckets of
+    bucket_seconds by expiry. Expired IDs are dropped a bucket at a time, so expiry
+    never walks IDs that are still valid. If max_entries is reached, the buckets that
+    expire first are dropped early, which is logged since those IDs could then be
+    replayed.
+
+    Args:
+        max_entries: maximum number of IDs kept
+        bucket_seconds: width of an expiry bucket
+        default_ttl: see IdStore
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000000,
+        bucket_seconds: float = 60,
+        default_ttl: float = 3600,
+    ):
+        super().__init__(default_ttl)
+        self.max_entries = max_entries
+        self.bucket_seconds = bucket_seconds
+
+        # id -> expires_at
+        self._ids = {}
+        # bucket number -> ids expiring in it, and a heap of the bucket numbers
+        self._buckets = {}
+        self._bucket_heap = []
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _bucket(self, timestamp: float) -> int:
+        return int(timestamp // self.bucket_seconds)
+
+    def _discard(self, id: str) -> Optional[float]:
+        expires_at = self._ids.pop(id, None)
+        if expires_at is not None:
+            self._buckets[self._bucket(expires_at)].discard(id)
+        return expires_at
+
+    def _drop_bucket(self):
+        bucket = heapq.heappop(self._bucket_heap)
+        for id in self._buckets.pop(bucket):
+            self._ids.pop(id, None)
+
+    def _expire(self, now: float):
+        # a bucket is only complete once its whole interval has passed
+        current = self._bucket(now)
+        while self._bucket_heap and self._bucket_heap[0] < current:
+            self._drop_bucket()
+
+    def _contains(self, id: str, now: float) -> bool:
+        expires_at = self._ids.get(id)
+        return expires_at is not None and expires_at > now
+
+    def _insert(self, id: str, expires_at: float):
+        while len(self._ids) >= self.max_entries and self._bucket_heap:
+            app_log.warning(
+                f"{len(self._ids)} IDs stored, dropping IDs that haven't expired yet"
+            )
+            self._drop_bucket()
+
+        # an expired copy of id may still be in an older bucket
+        self._discard(id)
+        self._ids[id] = expires_at
+        bucket = self._bucket(expires_at)
+        if bucket not in self._buckets:
+            self._buckets[bucket] = set()
+            heapq.heappush(self._bucket_heap, bucket)
+        self._buckets[bucket].add(id)
+
+    async def add(self, id: str, expires_at: Optional[float] = None) -> bool:
+        now = time.time()
+        self._expire(now)
+        if self._contains(id, now):
+            return False
+
+        self._insert(id, self._expiry(expires_at))
+        return True
+
+    async def take(self, id: str) -> bool:
+        now = time.time()
+        self._expire(now)
+        expires_at = self._discard(id)
+        return expires_at is not None and expires_at > now
+
+
+class RedisIdStore(IdStore):
+    """IdStore shared by every hub replica connected to the same redis.
+
+    Each ID is a key written with SET NX PX, so checking and recording an ID is a
+    single atomic round trip and redis expires it. take() is a DEL, which only one
+    replica can win.
+
+    Args:
+        client: The asyncio Redis client class, or redis, cluster or sentinel. See
+            redis_clients.create. Defaults to redis.asyncio.Redis
+        client_kwargs: keyword arguments for the client
+        prefix: prefix of the keys
+        default_ttl: see IdStore
+        retries: see redis_clients.create
+        retry_backoff: see redis_clients.create
+    """
+
+    client_required = True
+
+    def __init__(
+        self,
+        client: Union[redis.asyncio.Redis, str],
+        client_kwargs: Dict[str, Any],
+        prefix: str = "jupyterhub_saml_auth:id",
+        default_ttl: float = 3600,
+        retries: Optional[int] = None,
+        retry_backoff: float = 1,
+    ):
+        super().__init__(default_ttl)
+        self.client = redis_clients.create(
+            client,
+            client_kwargs,
+            use_asyncio=True,
+            retries=retries,
+            retry_backoff=retry_backoff,
+        )
+        self.prefix = prefix
+
+    def _key(self, id: str) -> str:
+        return f"{self.prefix}:{id}"
+
+    def _ttl_ms(self, expires_at: Optional[float]) -> int:
+        return max(1, int((self._expiry(expires_at) - time.time()) * 1000))
+
+    async def add(self, id: str, expires_at: Optional[float] = None) -> bool:
+        added = await self.client.set(
+            self._key(id), 1, nx=True, px=self._ttl_ms(expires_at)
+        )
+        return bool(added)
+
+    async def take(self, id: str) -> bool:
+        return await self.client.delete(self._key(id)) == 1
+
+
+idstore_map = {"in-memory": InMemoryIdStore, "redis": RedisIdStore}
+
+
+def create(idstore_spec: Optional[dict]) -> Optional[IdStore]:
+    """Factory for creating an IdStore
+
+    Args:
+        idstore_spec (dict): type is one of idstore_map or disabled. For redis, client
+            and client_kwargs configure the client. Other keys are passed to the store
+            as keyword arguments
+
+    Raises:
+        IdStoreError: undefined type
+
+    Returns:
+        IdStore: an instance of a store, or None if it is disabled
+    """
+    idstore_spec = idstore_spec or {"type": "disabled"}
+    store_type = idstore_spec.get("type")
+    if store_type == "disabled":
+        return None
+    if store_type not in idstore_map:
+        raise IdStoreError(
+            f"unknown id store type = {store_type}. "
+            f"Allowed values = {[*idstore_map, 'disabled']}"
+        )
+
+    options = {
+        key: value
+        for key, value in idstore_spec.items()
+        if key not in ("type", "client", "client_kwargs")
+    }
+    store_cls = idstore_map[store_type]
+    if store_cls.client_required:
+        return store_cls(
+            idstore_spec.get("client"), idstore_spec.get("client_kwargs"), **options
+        )
+    return store_cls(**options)
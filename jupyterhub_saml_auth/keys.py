@@ -0,0 +1,143 @@
+from copy import copy
+from typing import Dict, List, Optional
+import base64
+import binascii
+import hashlib
+import weakref
+
+from onelogin.saml2.auth import OneLogin_Saml2_Auth
+from onelogin.saml2.response import OneLogin_Saml2_Response
+from onelogin.saml2.settings import OneLogin_Saml2_Settings
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+from onelogin.saml2.xml_utils import OneLogin_Saml2_XML
+import xmlsec
+
+__indexes = weakref.WeakKeyDictionary()
+
+_KEYINFO_CERT = "/ds:KeyInfo/ds:X509Data/ds:X509Certificate"
+_SIGNATURE_CERT_XPATHS = (
+    OneLogin_Saml2_Utils.RESPONSE_SIGNATURE_XPATH + _KEYINFO_CERT,
+    OneLogin_Saml2_Utils.ASSERTION_SIGNATURE_XPATH + _KEYINFO_CERT,
+)
+
+
+class KeyIndexError(Exception):
+    pass
+
+
+def fingerprint(cert: str) -> Optional[bytes]:
+    """SHA-256 of the DER encoding of a PEM or bare base64 certificate"""
+    body = "".join(
+        line for line in cert.splitlines() if line and not line.startswith("-----")
+    )
+    try:
+        return hashlib.sha256(base64.b64decode("".join(body.split()))).digest()
+    except (binascii.Error, ValueError):
+        return None
+
+
+class KeyIndex:
+    """The IdP signing certificates of a settings object, indexed by fingerprint.
+
+    Every certificate and the SP private key are parsed with xmlsec once, when the
+    index is built, so an unusable one is reported on load instead of on login. For
+    each certificate a copy of the settings that trusts only that certificate is kept,
+    so a response whose signature names its certificate in KeyInfo is verified once,
+    instead of once per x509certMulti certificate until one matches.
+
+    Args:
+        saml_settings: settings as returned by settings.load
+
+    Raises:
+        KeyIndexError: a certificate or the SP private key can't be loaded
+    """
+
+    def __init__(self, saml_settings: OneLogin_Saml2_Settings):
+        idp_data = saml_settings.get_idp_data()
+        certs = [idp_data.get("x509cert")]
+        certs += idp_data.get("x509certMulti", {}).get("signing", [])
+
+        self._settings: Dict[bytes, OneLogin_Saml2_Settings] = {}
+        for cert in certs:
+            if not cert:
+                continue
+            cert = OneLogin_Saml2_Utils.format_cert(cert)
+            self._load(cert, xmlsec.KeyFormat.CERT_PEM)
+            self._settings[fingerprint(cert)] = self._trusting(saml_settings, cert)
+
+        sp_key = saml_settings.get_sp_key()
+        if sp_key:
+            self._load(sp_key, xmlsec.KeyFormat.PEM)
+
+    def __len__(self):
+        return len(self._settings)
+
+    @staticmethod
+    def _load(data: str, key_format) -> xmlsec.Key:
+        try:
+            return xmlsec.Key.from_memory(data, key_format, None)
+        except xmlsec.Error as e:
+            raise KeyIndexError(
+                f"could not load key or certificate. Error = {e}"
+            ) from e
+
+    @staticmethod
+    def _trusting(
+        saml_settings: OneLogin_Saml2_Settings, cert: str
+    ) -> OneLogin_Saml2_Settings:
+        idp_data = dict(saml_settings.get_idp_data())
+        idp_data.pop("x509certMulti", None)
+        idp_data["x509cert"] = cert
+
+        trusting = copy(saml_settings)
+        trusting._idp = idp_data
+        return trusting
+
+    def find(self, certs: List[str]) -> Optional[OneLogin_Saml2_Settings]:
+        """Settings trusting only the certificate named by every KeyInfo in certs, or
+        None if there are none or they don't name the same known certificate"""
+        found = {self._settings.get(fingerprint(cert)) for cert in certs}
+        if len(found) != 1:
+            return None
+        return found.pop()
+
+
+def index(saml_settings: OneLogin_Saml2_Settings) -> KeyIndex:
+    """Get the KeyIndex of saml_settings, building it on first use. It is dropped
+    together with the settings object"""
+    key_index = __indexes.get(saml_settings)
+    if key_index is None:
+        key_index = KeyIndex(saml_settings)
+        __indexes[saml_settings] = key_index
+
+    return key_index
+
+
+class IndexedResponse(OneLogin_Saml2_Response):
+    """OneLogin_Saml2_Response that verifies signatures only with the IdP certificate
+    their KeyInfo names, if it is one of the trusted certificates"""
+
+    def __init__(self, settings, response):
+        super().__init__(settings, response)
+
+        key_index = index(settings)
+        if len(key_index) < 2:
+            return
+
+        certs = []
+        for document in (self.document, self.decrypted_document):
+            if document is None:
+                continue
+            for xpath in _SIGNATURE_CERT_XPATHS:
+                for node in OneLogin_Saml2_XML.query(document, xpath):
+                    cert = OneLogin_Saml2_XML.element_text(node)
+                    if cert:
+                        certs.append(cert)
+
+        trusting = key_index.find(certs)
+        if trusting is not None:
+            self._settings = trusting
+
+
+class IndexedAuth(OneLogin_Saml2_Auth):
+    response_class = IndexedResponse
@@ -0,0 +1,197 @@
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+import base64
+import binascii
+import hashlib
+import html
+import re
+
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+
+
+class PrefilterError(Exception):
+    pass
+
+
+class ResponseHeader(NamedTuple):
+    """Fields of a SAML response found by scan(), None if they are missing"""
+
+    destination: Optional[str] = None
+    in_response_to: Optional[str] = None
+    issuer: Optional[str] = None
+
+
+_base64_alphabet = (
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+)
+_whitespace = b" \t\r\n"
+# whitespace, comments and processing instructions, which may precede an element
+_misc = re.compile(rb"(?:\s+|<!--.*?-->|<\?.*?\?>)*", re.S)
+# the same before the root element, plus a byte order mark and a DOCTYPE
+_prolog = re.compile(
+    rb"(?:\xef\xbb\xbf)?(?:\s+|<!--.*?-->|<\?.*?\?>|<!DOCTYPE[^>]*>)*", re.S
+)
+_response_tag = re.compile(rb"<(?:[\w.-]+:)?Response\b([^>]*)>")
+_attribute = re.compile(rb"([\w:.-]+)\s*=\s*([\"'])(.*?)\2", re.S)
+_issuer = re.compile(rb"<(?:[\w.-]+:)?Issuer\b[^>]*>([^<]*)</")
+
+
+def _text(value: bytes) -> str:
+    return html.unescape(value.decode("utf-8", "replace"))
+
+
+def decode(saml_response: str, limit: Optional[int] = None) -> bytes:
+    """Decode a base64 encoded SAMLResponse, ignoring line breaks. With limit only the
+    first limit bytes or so are decoded, though every character is checked to be base64
+
+    Raises:
+        PrefilterError: saml_response isn't valid base64
+    """
+    try:
+        data = saml_response.encode("ascii")
+    except UnicodeEncodeError as e:
+        raise PrefilterError(f"SAMLResponse isn't valid base64. Error = {e}") from e
+    if data.translate(None, _base64_alphabet + _whitespace):
+        raise PrefilterError("SAMLResponse isn't valid base64")
+
+    if limit is not None:
+        # 4 characters encode 3 bytes. Take twice that to make up for line breaks
+        length = (limit // 3 + 1) * 4
+        head = data[: length * 2].translate(None, _whitespace)
+        if len(head) > length:
+            data = head[:length]
+    try:
+        return base64.b64decode(data.translate(None, _whitespace), validate=True)
+    except binascii.Error as e:
+        raise PrefilterError(f"SAMLResponse isn't valid base64. Error = {e}") from e
+
+
+def scan(xml: bytes, limit: int = 8192) -> ResponseHeader:
+    """Find Destination, InResponseTo and the Issuer of a SAML response with regular
+    expressions over its first limit bytes, without parsing the XML. They precede
+    the signature and assertion, so the rest of the document isn't read.
+
+    Comments and processing instructions are skipped, and the Response has to be the
+    root element and the Issuer its first child, so that a commented out or nested
+    decoy isn't picked up. Still, the XML is neither parsed nor verified, so the
+    results are advisory only: they let junk be rejected early, and security
+    decisions must be made on the values python3-saml validated.
+    """
+    head = xml[:limit]
+    match = _response_tag.match(head, _prolog.match(head).end())
+    if match is None:
+        return ResponseHeader()
+
+    attributes = {
+        name: _text(value) for name, _, value in _attribute.findall(match.group(1))
+    }
+    issuer = _issuer.match(head, _misc.match(head, match.end()).end())
+    return ResponseHeader(
+        destination=attributes.get(b"Destination"),
+        in_response_to=attributes.get(b"InResponseTo"),
+        issuer=_text(issuer.group(1)) if issuer else None,
+    )
+
+
+class Prefilter:
+    """Cheap checks of a posted SAMLResponse, done before python3-saml parses the XML
+    and verifies its signature so junk costs little CPU.
+
+    A response is rejected if it is larger than max_size characters, isn't valid
+    base64, or, with strict settings, its Issuer or Destination don't match the ones
+    python3-saml would expect. Digests of the last rejected_entries rejected
+    responses are kept, so a repeated post is rejected after hashing it.
+
+    Args:
+        max_size: maximum length of the base64 encoded SAMLResponse
+        rejected_entries: number of digests of rejected responses kept
+        scan_limit: number of decoded bytes scanned for Issuer and Destination
+    """
+
+    def __init__(
+        self,
+        max_size: int = 512 * 1024,
+        rejected_entries: int = 1024,
+        scan_limit: int = 8192,
+    ):
+        self.max_size = max_size
+        self.rejected_entries = rejected_entries
+        self.scan_limit = scan_limit
+        self._rejected = OrderedDict()
+
+    @staticmethod
+    def _digest(saml_response: str) -> bytes:
+        return hashlib.sha256(saml_response.encode()).digest()
+
+    def _remember(self, digest: bytes):
+        if self.rejected_entries <= 0:
+            return
+
+        self._rejected[digest] = None
+        while len(self._rejected) > self.rejected_entries:
+            self._rejected.popitem(last=False)
+
+    def reject(self, saml_response: str):
+        """Remember a response rejected later on, e.g. by python3-saml"""
+        self._remember(self._digest(saml_response))
+
+    def _check(
+        self, saml_response: str, idp_entity_id: str, current_url: str, strict: bool
+    ) -> ResponseHeader:
+        header = scan(decode(saml_response, self.scan_limit), self.scan_limit)
+        if not strict:
+            return header
+
+        # the same checks as OneLogin_Saml2_Response.is_valid in strict mode
+        if header.destination is not None and not OneLogin_Saml2_Utils.normalize_url(
+            header.destination
+        ).startswith(OneLogin_Saml2_Utils.normalize_url(current_url)):
+            raise PrefilterError(
+                f"SAMLResponse was sent to {header.destination} instead of {current_url}"
+            )
+        if header.issuer is not None and header.issuer != idp_entity_id:
+            raise PrefilterError(
+                f"SAMLResponse issuer is {header.issuer}, expected {idp_entity_id}"
+            )
+        return header
+
+    def check(
+        self,
+        saml_response: Optional[str],
+        idp_entity_id: str,
+        current_url: str,
+        strict: bool = True,
+    ) -> ResponseHeader:
+        """Check a posted SAMLResponse
+
+        Args:
+            saml_response: the base64 encoded SAMLResponse form field
+            idp_entity_id: the expected Issuer
+            current_url: URL the response was posted to, without the query
+            strict: whether the settings are strict. python3-saml only checks the
+                Issuer and Destination in strict mode, so they aren't checked otherwise
+
+        Raises:
+            PrefilterError: the response is rejected
+
+        Returns:
+            ResponseHeader: fields found by scan()
+        """
+        if not saml_response:
+            raise PrefilterError("SAMLResponse is missing")
+        if len(saml_response) > self.max_size:
+            raise PrefilterError(
+                f"SAMLResponse is {len(saml_response)} characters, "
+                f"the maximum is {self.max_size}"
+            )
+
+        digest = self._digest(saml_response)
+        if digest in self._rejected:
+            self._rejected.move_to_end(digest)
+            raise PrefilterError("SAMLResponse was already rejected")
+
+        try:
+            return self._check(saml_response, idp_entity_id, current_url, strict)
+        except PrefilterError:
+            self._remember(digest)
+            raise
@@ -0,0 +1,105 @@
+from typing import Any, Dict, Optional, Union
+
+from redis.backoff import ExponentialWithJitterBackoff
+import redis
+import redis.asyncio
+import redis.asyncio.cluster
+import redis.asyncio.retry
+import redis.asyncio.sentinel
+import redis.cluster
+import redis.retry
+import redis.sentinel
+
+
+class RedisClientError(Exception):
+    pass
+
+
+# client name -> (client class, asyncio client class)
+client_map = {
+    "redis": (redis.Redis, redis.asyncio.Redis),
+    "cluster": (redis.cluster.RedisCluster, redis.asyncio.cluster.RedisCluster),
+    "sentinel": (redis.sentinel.Sentinel, redis.asyncio.sentinel.Sentinel),
+}
+
+_cluster_classes = (redis.cluster.RedisCluster, redis.asyncio.cluster.RedisCluster)
+_sentinel_classes = (redis.sentinel.Sentinel, redis.asyncio.sentinel.Sentinel)
+
+
+def is_cluster(client) -> bool:
+    return isinstance(client, _cluster_classes)
+
+
+def _is_subclass(client, classes: tuple) -> bool:
+    return isinstance(client, type) and issubclass(client, classes)
+
+
+def create(
+    client: Union[str, type, None],
+    client_kwargs: Optional[Dict[str, Any]],
+    use_asyncio: bool = False,
+    retries: Optional[int] = None,
+    retry_backoff: float = 1,
+):
+    """Factory for creating a redis client
+
+    Args:
+        client: a client class or one of client_map. Defaults to redis
+        client_kwargs: keyword arguments for the client, which also size its
+            connection pool (max_connections). For a cluster, startup_nodes may be given
+            as [host, port] pairs. For sentinel, sentinels lists the [host, port] of
+            the sentinels, service_name names the monitored primary and
+            sentinel_kwargs configure the connections to the sentinels. The other keys
+            configure the connections to the primary, see Sentinel.master_for
+        use_asyncio: whether client is, or should be, a redis.asyncio client
+        retries: times a command is retried after a connection error or timeout, e.g.
+            while a sentinel or the cluster fails over to a replica. None keeps the
+            client's default
+        retry_backoff: maximum seconds between retries, which back off exponentially
+            with jitter
+
+    Raises:
+        RedisClientError: unknown client name, or sentinel settings are missing
+
+    Returns:
+        a redis client. For sentinel, the client of the current primary, which follows
+        failovers
+    """
+    client = client or "redis"
+    client_kwargs = dict(client_kwargs or {})
+    if isinstance(client, str):
+        if client not in client_map:
+            raise RedisClientError(
+                f"unknown redis client = {client}. Allowed values = {list(client_map)}"
+            )
+        client = client_map[client][1 if use_asyncio else 0]
+
+    if retries is not None and "retry" not in client_kwargs:
+        retry = redis.asyncio.retry.Retry if use_asyncio else redis.retry.Retry
+        client_kwargs["retry"] = retry(
+            ExponentialWithJitterBackoff(base=0.05, cap=retry_backoff), retries
+        )
+
+    if _is_subclass(client, _cluster_classes) and "startup_nodes" in client_kwargs:
+        node_cls = (
+            redis.asyncio.cluster.ClusterNode
+            if issubclass(client, redis.asyncio.cluster.RedisCluster)
+            else redis.cluster.ClusterNode
+        )
+        client_kwargs["startup_nodes"] = [
+            node if isinstance(node, node_cls) else node_cls(*node)
+            for node in client_kwargs["startup_nodes"]
+        ]
+
+    if _is_subclass(client, _sentinel_classes):
+        try:
+            sentinels = [tuple(sentinel) for sentinel in client_kwargs.pop("sentinels")]
+            service_name = client_kwargs.pop("service_name")
+        except KeyError as e:
+            raise RedisClientError(f"sentinel requires {e} in client_kwargs") from e
+        sentinel = client(
+            sentinels, sentinel_kwargs=client_kwargs.pop("sentinel_kwargs", None)
+        )
+        return sentinel.master_for(service_name, **client_kwargs)
+
+    return client(**client_kwargs)
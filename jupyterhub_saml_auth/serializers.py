@@ -0,0 +1,144 @@
+from abc import ABCMeta, abstractmethod
+from typing import Optional
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class SerializerError(Exception):
+    pass
+
+
+class Serializer(metaclass=ABCMeta):
+    """Interface for turning a session entry, as a dict, into bytes and back"""
+
+    @abstractmethod
+    def dumps(self, obj: dict) -> bytes:
+        pass
+
+    @abstractmethod
+    def loads(self, data: bytes) -> dict:
+        pass
+
+
+class JsonSerializer(Serializer):
+    def dumps(self, obj: dict) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data: bytes) -> dict:
+        return json.loads(data)
+
+
+class MsgpackSerializer(Serializer):
+    """Requires the msgpack package (pip install jupyterhub_saml_auth[msgpack])"""
+
+    def __init__(self):
+        if msgpack is None:
+            raise SerializerError(
+                "the msgpack serializer requires the msgpack package to be installed"
+            )
+
+    def dumps(self, obj: dict) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data: bytes) -> dict:
+        return msgpack.unpackb(data, raw=False)
+
+
+class CompressedSerializer(Serializer):
+    """Compresses the output of another serializer once it reaches threshold bytes.
+
+    Every payload starts with a one byte header naming the codec it was written with,
+    so the codec and threshold can be changed without breaking existing payloads.
+    Payloads written before compression was enabled have no header. The headers are
+    bytes neither JSON nor a msgpack map starts with, so anything else is read with
+    the wrapped serializer.
+
+    Args:
+        serializer: the serializer whose output is compressed
+        codec: zlib, or zstd (requires the zstandard package)
+        threshold: payloads smaller than this many bytes are stored uncompressed
+    """
+
+    RAW = b"\x00"
+    ZLIB = b"\x01"
+    ZSTD = b"\x02"
+
+    def __init__(self, serializer: Serializer, codec: str = "zlib", threshold: int = 1024):
+        if codec not in ("zlib", "zstd"):
+            raise SerializerError(
+                f"unknown compression = {codec}. Allowed values = ['zlib', 'zstd']"
+            )
+        if codec == "zstd" and zstandard is None:
+            raise SerializerError(
+                "zstd compression requires the zstandard package to be installed"
+            )
+
+        self.serializer = serializer
+        self.codec = codec
+        self.threshold = threshold
+
+    def dumps(self, obj: dict) -> bytes:
+        data = self.serializer.dumps(obj)
+        if len(data) < self.threshold:
+            return self.RAW + data
+
+        if self.codec == "zstd":
+            return self.ZSTD + zstandard.ZstdCompressor().compress(data)
+        return self.ZLIB + zlib.compress(data)
+
+    def loads(self, data: bytes) -> dict:
+        header, payload = data[:1], data[1:]
+        if header == self.ZLIB:
+            payload = zlib.decompress(payload)
+        elif header == self.ZSTD:
+            if zstandard is None:
+                raise SerializerError(
+                    "found a zstd compressed payload but zstandard is not installed"
+                )
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+        elif header != self.RAW:
+            # written by the plain serializer, before compression was enabled
+            payload = data
+
+        return self.serializer.loads(payload)
+
+
+serializer_map = {"json": JsonSerializer, "msgpack": MsgpackSerializer}
+
+
+def create(
+    name: str, compression: Optional[str] = None, compression_threshold: int = 1024
+) -> Serializer:
+    """Factory for creating a serializer
+
+    Args:
+        name (str): serializer name, one of serializer_map
+        compression (str, optional): zlib or zstd. Defaults to no compression
+        compression_threshold (int): minimum payload size in bytes to compress
+
+    Raises:
+        SerializerError: undefined serializer or compression
+
+    Returns:
+        Serializer: an instance of a serializer
+    """
+    if name not in serializer_map:
+        raise SerializerError(
+            f"unknown serializer = {name}. Allowed values = {list(serializer_map)}"
+        )
+
+    serializer = serializer_map[name]()
+    if compression is None:
+        return serializer
+
+    return CompressedSerializer(serializer, compression, compression_threshold)
@@ -0,0 +1,287 @@
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from onelogin.saml2.idp_metadata_parser import OneLogin_Saml2_IdPMetadataParser
+from onelogin.saml2.settings import OneLogin_Saml2_Settings
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.log import app_log
+
+from . import keys
+
+
+__settings_cache: Dict[str, "SettingsSnapshot"] = {}
+__watchers: Dict[str, "SettingsWatcher"] = {}
+# IdP settings parsed from fetched metadata, merged over settings.json
+__idp_metadata: Dict[str, dict] = {}
+
+
+class SettingsError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class SettingsSnapshot:
+    """
+    Parsed settings together with the state of the settings directory they were read from.
+    """
+
+    settings: OneLogin_Saml2_Settings
+    signature: tuple
+    loaded_at: float
+
+
+def signature(path: str) -> Tuple[tuple, ...]:
+    """Cheap fingerprint of the settings directory. Changes whenever a settings file or
+    anything under certs/ is modified, replaced or removed"""
+    entries = []
+    for directory in (path, os.path.join(path, "certs")):
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    entries.append(
+                        (entry.path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                    )
+        except FileNotFoundError:
+            continue
+
+    return tuple(sorted(entries))
+
+
+def read(path: str) -> dict:
+    """settings.json merged with advanced_settings.json, as python3-saml does it"""
+    with open(os.path.join(path, "settings.json")) as f:
+        settings_dict = json.load(f)
+
+    advanced_path = os.path.join(path, "advanced_settings.json")
+    if os.path.exists(advanced_path):
+        with open(advanced_path) as f:
+            settings_dict.update(json.load(f))
+
+    return settings_dict
+
+
+def load(path: str, idp_metadata: Optional[dict] = None) -> OneLogin_Saml2_Settings:
+    """Read, validate and fully materialize the python3-saml settings stored at path
+
+    settings.json and advanced_settings.json are merged and validated by python3-saml.
+    Certificates and keys that live in the certs/ directory are read once and inlined
+    so that the resulting object never has to touch the filesystem again.
+
+    Args:
+        path (str): directory containing settings.json, advanced_settings.json and certs/
+        idp_metadata (dict): settings parsed from IdP metadata by
+            OneLogin_Saml2_IdPMetadataParser, which take precedence over the files
+
+    Raises:
+        SettingsError: the settings could not be read or are invalid
+
+    Returns:
+        OneLogin_Saml2_Settings: validated settings
+    """
+    try:
+        if idp_metadata is None:
+            saml_settings = OneLogin_Saml2_Settings(custom_base_path=path)
+        else:
+            saml_settings = OneLogin_Saml2_Settings(
+                OneLogin_Saml2_IdPMetadataParser.merge_settings(read(path), idp_metadata),
+                custom_base_path=path,
+            )
+    except Exception as e:
+        raise SettingsError(f"could not load saml settings from {path}. Error = {e}") from e
+
+    # python3-saml falls back to reading certs/*.crt and certs/sp.key on every call
+    # when they are not inlined in settings.json. Inline them once here.
+    sp_data = saml_settings.get_sp_data()
+    sp_data["x509cert"] = saml_settings.get_sp_cert() or ""
+    sp_data["privateKey"] = saml_settings.get_sp_key() or ""
+    if saml_settings.get_sp_cert_new():
+        sp_data["x509certNew"] = saml_settings.get_sp_cert_new()
+
+    idp_data = saml_settings.get_idp_data()
+    idp_data["x509cert"] = saml_settings.get_idp_cert() or ""
+
+    saml_settings.format_sp_cert()
+    saml_settings.format_sp_key()
+    saml_settings.format_idp_cert()
+    if "x509certNew" in sp_data:
+        saml_settings.format_sp_cert_new()
+
+    # parse the certificates and keys once, and index the IdP certificates
+    try:
+        keys.index(saml_settings)
+    except keys.KeyIndexError as e:
+        raise SettingsError(f"invalid saml settings in {path}. {e}") from e
+
+    return saml_settings
+
+
+def load_snapshot(path: str) -> SettingsSnapshot:
+    """Load the settings at path along with the directory signature they were read at"""
+    # take the signature first so a write that races the load is picked up on the
+    # next check instead of being missed
+    settings_signature = signature(path)
+    return SettingsSnapshot(
+        settings=load(path, __idp_metadata.get(path)),
+        signature=settings_signature,
+        loaded_at=time.time(),
+    )
+
+
+def _store(path: str, settings_snapshot: SettingsSnapshot):
+    # a single dict assignment, so readers see either the old or the new snapshot
+    __settings_cache[path] = settings_snapshot
+
+
+def update_idp_metadata(path: str, idp_metadata: dict) -> SettingsSnapshot:
+    """Merge settings parsed from IdP metadata into the settings at path and swap in
+    the result. They are also merged into every later reload.
+
+    Raises:
+        SettingsError: the merged settings are invalid. The previous snapshot and
+            metadata stay in use
+    """
+    settings_signature = signature(path)
+    settings_snapshot = SettingsSnapshot(
+        settings=load(path, idp_metadata),
+        signature=settings_signature,
+        loaded_at=time.time(),
+    )
+    __idp_metadata[path] = idp_metadata
+    _store(path, settings_snapshot)
+    return settings_snapshot
+
+
+def snapshot(path: str) -> SettingsSnapshot:
+    """Get the current settings snapshot for path, loading it on first use"""
+    settings_snapshot = __settings_cache.get(path)
+    if settings_snapshot is None:
+        app_log.info(f"loading saml settings from {path}")
+        settings_snapshot = load_snapshot(path)
+        _store(path, settings_snapshot)
+
+    return settings_snapshot
+
+
+def loaded(path: str) -> bool:
+    """Whether the settings for path are loaded. Settings of tenants are only loaded
+    once a request needs them"""
+    return path in __settings_cache
+
+
+def get(path: str) -> OneLogin_Saml2_Settings:
+    """Get the parsed settings for path, loading them on first use.
+
+    The same settings object is shared by every handler and request until it is
+    replaced by a SettingsWatcher or explicitly dropped with invalidate()
+    """
+    return snapshot(path).settings
+
+
+def invalidate(path: Optional[str] = None):
+    """Drop the cached settings for path, or every cached settings object if path is None.
+    The next get() reloads them from disk"""
+    if path is None:
+        __settings_cache.clear()
+        return
+
+    __settings_cache.pop(path, None)
+
+
+def clear_idp_metadata(path: Optional[str] = None):
+    """Stop merging IdP metadata into the settings at path, or into every settings if
+    path is None. Takes effect on the next load"""
+    if path is None:
+        __idp_metadata.clear()
+        return
+
+    __idp_metadata.pop(path, None)
+
+
+class SettingsWatcher:
+    """Polls a settings directory and swaps in freshly parsed settings when it changes.
+
+    Reading the directory and parsing the settings happen on an executor thread, so
+    request handlers only ever read the in-memory snapshot. If the new settings fail
+    validation, the last good snapshot keeps serving until the files change again.
+
+    Args:
+        path (str): settings directory to watch
+        interval (float): seconds between checks
+    """
+
+    def __init__(self, path: str, interval: float):
+        self.path = path
+        self.interval = interval
+        self._last_seen = None
+        self._periodic = PeriodicCallback(self.check, interval * 1000)
+
+    def start(self):
+        self._periodic.start()
+
+    def stop(self):
+        self._periodic.stop()
+
+    async def check(self) -> bool:
+        """Reload the settings if the directory changed since the last check.
+
+        Returns:
+            bool: whether a new snapshot was swapped in
+        """
+        # settings that haven't been used yet are read fresh on first use
+        if not loaded(self.path):
+            self._last_seen = None
+            return False
+
+        loop = IOLoop.current()
+        current_signature = await loop.run_in_executor(None, signature, self.path)
+
+        if self._last_seen is None:
+            # the settings may have been dropped since, don't load them on the loop
+            try:
+                current_snapshot = await loop.run_in_executor(None, snapshot, self.path)
+            except SettingsError as e:
+                app_log.error(f"could not load saml settings from {self.path}. {e}")
+                return False
+            self._last_seen = current_snapshot.signature
+        if current_signature == self._last_seen:
+            return False
+
+        # remember the signature even if loading fails so a broken config is
+        # reported once rather than on every tick
+        self._last_seen = current_signature
+
+        try:
+            new_snapshot = await loop.run_in_executor(None, load_snapshot, self.path)
+        except SettingsError as e:
+            app_log.error(f"keeping previous saml settings for {self.path}. {e}")
+            return False
+
+        _store(self.path, new_snapshot)
+        app_log.info(f"reloaded saml settings from {self.path}")
+        return True
+
+
+def watch(path: str, interval: float) -> SettingsWatcher:
+    """Start watching path for changes. Only one watcher is kept per path"""
+    watcher = __watchers.get(path)
+    if watcher is None:
+        watcher = SettingsWatcher(path, interval)
+        watcher.start()
+        __watchers[path] = watcher
+
+    return watcher
+
+
+def unwatch(path: Optional[str] = None):
+    """Stop the watcher for path, or every watcher if path is None"""
+    paths = list(__watchers) if path is None else [path]
+    for watched_path in paths:
+        watcher = __watchers.pop(watched_path, None)
+        if watcher is not None:
+            watcher.stop()
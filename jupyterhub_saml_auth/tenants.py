@@ -0,0 +1,128 @@
+from typing import Dict, Optional
+import re
+
+import tornado.httputil
+import tornado.web
+
+_tenant_name = re.compile(r"[\w.-]+")
+# /saml/<tenant>/<endpoint> at the end of the request path
+_path_tenant = re.compile(r"/saml/([^/]+)/(?:saml_login|metadata|acs|slo)$")
+# endpoints that choose a tenant rather than follow the remembered one
+_choosing_path = re.compile(r"/(?:saml_login|metadata)$")
+
+
+class TenantError(Exception):
+    pass
+
+
+class TenantRouter:
+    """Picks the tenant of a request, i.e. the IdP and the settings directory it is
+    served with.
+
+    A request belongs to, in this order
+    - the tenant of its host, see hosts
+    - the tenant named by a /saml/<tenant>/ prefix of its endpoint, e.g.
+      /hub/saml/<tenant>/acs
+    - the tenant named by its query_param argument, the IdP discovery parameter of
+      /saml_login
+    - the tenant it logged in with last, which remember() keeps in a cookie. Not
+      for /saml_login and /metadata, which would otherwise never reach the default
+      IdP again
+    Each step is a dict lookup, so routing costs the same for any number of tenants.
+    Requests that match none of them have no tenant, None.
+
+    Args:
+        settings_paths: tenant -> settings directory
+        hosts: host name -> tenant
+        query_param: name of the IdP discovery argument
+        cookie_name: name of the cookie remembering the tenant
+
+    Raises:
+        TenantError: a tenant name isn't made of letters, digits, ".", "-" and "_",
+            or hosts names an unknown tenant
+    """
+
+    def __init__(
+        self,
+        settings_paths: Dict[str, str],
+        hosts: Optional[Dict[str, str]] = None,
+        query_param: str = "idp",
+        cookie_name: str = "jupyterhub-saml-tenant",
+    ):
+        for tenant in settings_paths:
+            if not _tenant_name.fullmatch(tenant):
+                raise TenantError(f"invalid tenant name = {tenant}")
+        hosts = {host.lower(): tenant for host, tenant in (hosts or {}).items()}
+        unknown = set(hosts.values()) - set(settings_paths)
+        if unknown:
+            raise TenantError(f"hosts of unknown tenants = {sorted(unknown)}")
+
+        self.settings_paths = dict(settings_paths)
+        self.hosts = hosts
+        self.query_param = query_param
+        self.cookie_name = cookie_name
+        self._prefixes = tuple(f"{tenant}/" for tenant in settings_paths)
+
+    def resolve(self, handler: tornado.web.RequestHandler) -> Optional[str]:
+        """The tenant of the request handler is serving
+
+        Raises:
+            TenantError: the path prefix or query argument names an unknown tenant
+        """
+        request = handler.request
+        host = tornado.httputil.split_host_and_port(request.host.lower())[0]
+        tenant = self.hosts.get(host)
+        if tenant is not None:
+            return tenant
+
+        match = _path_tenant.search(request.path)
+        if match is not None:
+            return self._known(match.group(1))
+
+        tenant = handler.get_query_argument(self.query_param, None)
+        if tenant is not None:
+            return self._known(tenant)
+
+        if _choosing_path.search(request.path):
+            return None
+
+        tenant = handler.get_cookie(self.cookie_name)
+        # the tenant may have been removed from the configuration since
+        return tenant if tenant in self.settings_paths else None
+
+    def _known(self, tenant: str) -> str:
+        if tenant not in self.settings_paths:
+            raise TenantError(f"unknown tenant = {tenant}")
+        return tenant
+
+    def remember(
+        self, handler: tornado.web.RequestHandler, tenant: Optional[str], secure: bool
+    ):
+        """Keep the tenant a user logs in with in a cookie, so that the responses and
+        logout of routes without a tenant prefix go to the same IdP. Over https the
+        cookie is SameSite=None, since the IdP posts the response from another site.
+        A login with the default IdP, tenant None, clears the cookie
+        """
+        remembered = handler.get_cookie(self.cookie_name)
+        if tenant is None:
+            if remembered is not None:
+                handler.clear_cookie(self.cookie_name)
+            return
+        if remembered == tenant:
+            return
+
+        handler.set_cookie(
+            self.cookie_name,
+            tenant,
+            httponly=True,
+            secure=secure,
+            samesite="None" if secure else "Lax",
+        )
+
+    def settings_path(self, tenant: str) -> str:
+        return self.settings_paths[tenant]
+
+    def namespaced(self, key: str) -> bool:
+        """Whether a session cache key belongs to a tenant's namespace, see
+        cache.NamespacedCache"""
+        return key.startswith(self._prefixes)
@@ -49,6 +49,12 @@ setup(name='jupyterhub_saml_auth',
         'kubernetes': [
             'kubernetes',
         ],
+        'msgpack': [
+            'msgpack',
+        ],
+        'zstd': [
+            'zstandard',
+        ],
         'dev': [
             'python-dotenv',
             'black',
@@ -13,3 +13,13 @@ def test_login_url_sets(mock_saml_authenticator):
 
 def test_login_service_sets(mock_saml_authenticator):
     assert mock_saml_authenticator.login_service == "SSO"
+
+
+def test_authenticate(mock_saml_authenticator):
+    assert mock_saml_authenticator.authenticate(None, {"name": "user1"}) == "user1"
+
+    auth_state = {"name_id": "mynameid", "session_index": "sessionindex"}
+    authenticated = mock_saml_authenticator.authenticate(
+        None, {"name": "user1", "auth_state": auth_state}
+    )
+    assert authenticated == {"name": "user1", "auth_state": auth_state}
@@ -1,7 +1,13 @@
+import asyncio
+import os
+import time
 import pytest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, AsyncMock
 from jupyterhub_saml_auth.cache import *
+from jupyterhub_saml_auth import serializers
 from redis.commands.json.path import Path as RedisJsonPath
+from redis.exceptions import ResponseError, WatchError
+import redis.cluster
 
 test_username = "user1"
 test_session_entry = SessionEntry(
@@ -11,6 +17,39 @@ test_session_entry = SessionEntry(
 )
 
 
+class TestSessionEntry:
+    def test_interning(self):
+        first = SessionEntry(saml_attrs={"memberOf": ["group1", "group2"]})
+        # build equal values from fresh string objects, like separate logins would
+        second = SessionEntry(
+            saml_attrs={"".join(["member", "Of"]): ["".join(["group", "1"]), "group2"]}
+        )
+
+        assert first == second
+        assert first.saml_attrs["memberOf"] == ("group1", "group2")
+        assert first.saml_attrs["memberOf"] is second.saml_attrs["memberOf"]
+
+    def test_slots(self):
+        with pytest.raises(AttributeError):
+            test_session_entry.unknown = "value"
+
+    def test_to_dict(self):
+        assert SessionEntry(**test_session_entry.to_dict()) == test_session_entry
+        assert set(test_session_entry.to_dict()) == set(SessionEntry.fields)
+
+        entry = SessionEntry(saml_attrs={"memberOf": ["group1", "group2"]})
+        assert entry.to_dict()["saml_attrs"] == {"memberOf": ["group1", "group2"]}
+        assert vars(entry) == entry.to_dict()
+
+    def test_intern_table_max_size(self):
+        table = InternTable(max_size=2)
+        table.intern("a")
+        table.intern("b")
+        assert table.intern("c") == "c"
+        assert len(table) == 1
+        assert table.intern(["unhashable"]) == ["unhashable"]
+
+
 class TestInMemoryCache:
     @pytest.fixture
     def in_memory_cache(self):
@@ -34,6 +73,217 @@ class TestInMemoryCache:
 
         in_memory_cache.remove("none")
 
+    def test_pop(self, in_memory_cache):
+        assert in_memory_cache.pop(test_username) == test_session_entry
+        assert not in_memory_cache._cache
+        assert in_memory_cache.pop(test_username) == SessionEntry()
+
+    def test_lru_eviction(self):
+        in_memory_cache = InMemoryCache(max_entries=2)
+        in_memory_cache.upsert("user1", test_session_entry)
+        in_memory_cache.upsert("user2", test_session_entry)
+
+        # touch user1 so user2 becomes the least recently used
+        in_memory_cache.get("user1")
+        in_memory_cache.upsert("user3", test_session_entry)
+
+        assert list(in_memory_cache._cache) == ["user1", "user3"]
+        assert in_memory_cache.evictions == 1
+
+    def test_ttl(self, monkeypatch):
+        now = 1000.0
+        monkeypatch.setattr(time, "time", lambda: now)
+        in_memory_cache = InMemoryCache(ttl=60)
+        in_memory_cache.upsert(test_username, test_session_entry)
+
+        now += 59
+        assert in_memory_cache.get(test_username) == test_session_entry
+
+        now += 1
+        assert in_memory_cache.get(test_username) == SessionEntry()
+        assert in_memory_cache.expirations == 1
+        assert not in_memory_cache._expires_at
+
+    def test_session_expiration(self, monkeypatch):
+        monkeypatch.setattr(time, "time", lambda: 1000.0)
+        in_memory_cache = InMemoryCache(ttl=60)
+        in_memory_cache.upsert(
+            test_username, SessionEntry(name_id="mynameid", session_expiration=1010)
+        )
+
+        assert in_memory_cache._expires_at[test_username] == 1010
+
+    def test_expired_swept_on_upsert(self, monkeypatch):
+        now = 1000.0
+        monkeypatch.setattr(time, "time", lambda: now)
+        in_memory_cache = InMemoryCache(ttl=60)
+        in_memory_cache.upsert("user1", test_session_entry)
+
+        now += 60
+        in_memory_cache.upsert("user2", test_session_entry)
+        assert list(in_memory_cache._cache) == ["user2"]
+        assert in_memory_cache.expirations == 1
+
+    def test_expired_swept_behind_live_head(self, monkeypatch):
+        now = 1000.0
+        monkeypatch.setattr(time, "time", lambda: now)
+        in_memory_cache = InMemoryCache()
+        in_memory_cache.upsert("user1", SessionEntry(session_expiration=5000))
+        in_memory_cache.upsert("user2", SessionEntry(session_expiration=1010))
+        in_memory_cache.upsert("user3", SessionEntry(session_expiration=1020))
+
+        now += 30
+        in_memory_cache.upsert("user4", test_session_entry)
+        assert list(in_memory_cache._cache) == ["user1", "user4"]
+        assert in_memory_cache.expirations == 2
+
+    def test_expiry_heap_is_compacted(self, monkeypatch):
+        monkeypatch.setattr(time, "time", lambda: 1000.0)
+        in_memory_cache = InMemoryCache(ttl=60)
+        for _ in range(1000):
+            in_memory_cache.upsert(test_username, test_session_entry)
+        assert len(in_memory_cache._expiry_heap) <= 2 + in_memory_cache.sweep_batch
+
+    def test_find_usernames(self):
+        in_memory_cache = InMemoryCache(indexed_attributes=["memberOf"])
+        in_memory_cache.upsert(
+            "user1",
+            SessionEntry(
+                name_id="user1", saml_attrs={"memberOf": ["a", "b"]}, created_at=100
+            ),
+        )
+        in_memory_cache.upsert(
+            "user2",
+            SessionEntry(
+                name_id="user2", saml_attrs={"memberOf": ["b"]}, created_at=200
+            ),
+        )
+
+        assert sorted(in_memory_cache.find_usernames("memberOf", "b")) == [
+            "user1",
+            "user2",
+        ]
+        assert in_memory_cache.find_usernames("memberOf", "b", created_before=150) == [
+            "user1"
+        ]
+        assert in_memory_cache.find_usernames(created_before=250) == ["user1", "user2"]
+        with pytest.raises(CacheError):
+            in_memory_cache.find_usernames("email", "user1@example.com")
+
+        # re-login without the group
+        in_memory_cache.upsert("user1", SessionEntry(name_id="user1", saml_attrs={}))
+        assert in_memory_cache.find_usernames("memberOf", "a") == []
+
+    def test_remove_many(self, in_memory_cache):
+        assert in_memory_cache.remove_many([test_username, "nobody"]) == [test_username]
+        assert not in_memory_cache._cache
+
+    def test_find_username(self, in_memory_cache):
+        assert in_memory_cache.find_username(name_id="mynameid") == test_username
+        assert in_memory_cache.find_username(session_index="sessionindex") == test_username
+        assert in_memory_cache.find_username("mynameid", "sessionindex") == test_username
+        assert in_memory_cache.find_username("othernameid", "sessionindex") is None
+        assert in_memory_cache.find_username(session_index="unknown") is None
+
+        # a new login replaces the previous session's index entries
+        in_memory_cache.upsert(
+            test_username, SessionEntry(name_id="mynameid", session_index="newindex")
+        )
+        assert in_memory_cache.find_username(session_index="sessionindex") is None
+        assert in_memory_cache.find_username(session_index="newindex") == test_username
+
+        in_memory_cache.pop(test_username)
+        assert in_memory_cache.find_username(name_id="mynameid") is None
+        assert not in_memory_cache._by_name_id
+        assert not in_memory_cache._by_session_index
+
+
+class TestInMemoryCacheSnapshot:
+    @pytest.fixture
+    def snapshot_path(self, tmp_path):
+        return str(tmp_path / "sessions.snapshot")
+
+    def test_restore(self, snapshot_path):
+        in_memory_cache = InMemoryCache(snapshot_path=snapshot_path)
+        in_memory_cache.upsert("user1", test_session_entry)
+        in_memory_cache.upsert("user2", SessionEntry(name_id="user2", session_index="2"))
+        in_memory_cache.get("user1")
+        in_memory_cache.write_snapshot()
+
+        restored = InMemoryCache(snapshot_path=snapshot_path)
+        # nothing is read until the cache is used
+        assert not restored._cache
+        assert restored.lookup("nobody") is None
+        assert list(restored._cache) == ["user2", "user1"]
+        assert restored.get("user1") == test_session_entry
+        assert restored.get("user2").session_index == "2"
+
+    def test_restore_off_the_loop(self, snapshot_path, monkeypatch):
+        in_memory_cache = InMemoryCache(snapshot_path=snapshot_path)
+        in_memory_cache.upsert(test_username, test_session_entry)
+        in_memory_cache.write_snapshot()
+        assert os.stat(snapshot_path).st_mode & 0o777 == 0o600
+
+        restored = InMemoryCache(snapshot_path=snapshot_path)
+        monkeypatch.setattr(restored, "load_snapshot", MagicMock())
+        adapter = SyncCacheAdapter(restored)
+
+        async def get_twice():
+            return await asyncio.gather(
+                adapter.get(test_username), adapter.get(test_username)
+            )
+
+        assert asyncio.run(get_twice()) == [test_session_entry] * 2
+        restored.load_snapshot.assert_not_called()
+
+    def test_restore_skips_expired(self, snapshot_path, monkeypatch):
+        now = 1000.0
+        monkeypatch.setattr(time, "time", lambda: now)
+        in_memory_cache = InMemoryCache(ttl=60, snapshot_path=snapshot_path)
+        in_memory_cache.upsert("user1", test_session_entry)
+        in_memory_cache.upsert("user2", SessionEntry(name_id="user2", session_expiration=2000))
+        in_memory_cache.write_snapshot()
+
+        now += 60
+        restored = InMemoryCache(ttl=60, snapshot_path=snapshot_path)
+        assert restored.load_snapshot() == 1
+        assert list(restored._cache) == ["user2"]
+        assert restored._expires_at["user2"] == 2000
+
+    def test_newer_sessions_win(self, snapshot_path):
+        in_memory_cache = InMemoryCache(snapshot_path=snapshot_path)
+        in_memory_cache.upsert(test_username, test_session_entry)
+        in_memory_cache.write_snapshot()
+
+        restored = InMemoryCache(snapshot_path=snapshot_path)
+        restored.upsert(test_username, SessionEntry(name_id="newer"))
+        assert restored.get(test_username).name_id == "newer"
+
+    def test_missing_or_corrupt(self, snapshot_path):
+        assert InMemoryCache(snapshot_path=snapshot_path).get(test_username) == SessionEntry()
+
+        with open(snapshot_path, "wb") as f:
+            f.write(InMemoryCache.snapshot_magic + b"\x00\x00\x00\xffgarbage")
+        restored = InMemoryCache(snapshot_path=snapshot_path)
+        assert restored.load_snapshot() == 0
+
+    def test_unloaded_cache_not_written(self, snapshot_path):
+        in_memory_cache = InMemoryCache(snapshot_path=snapshot_path)
+        in_memory_cache.upsert(test_username, test_session_entry)
+        in_memory_cache.write_snapshot()
+
+        # a snapshot written before restoring would drop every session
+        InMemoryCache(snapshot_path=snapshot_path).write_snapshot()
+        assert InMemoryCache(snapshot_path=snapshot_path).load_snapshot() == 1
+
+    def test_periodic_snapshot(self, snapshot_path):
+        in_memory_cache = InMemoryCache(snapshot_path=snapshot_path)
+        in_memory_cache.upsert(test_username, test_session_entry)
+
+        asyncio.run(in_memory_cache._periodic_snapshot())
+        assert not in_memory_cache._dirty
+        assert InMemoryCache(snapshot_path=snapshot_path).load_snapshot() == 1
+
 
 class TestDisabledCache:
     @pytest.fixture
@@ -53,53 +303,793 @@ class TestDisabledCache:
     def test_remove(self, disabled_cache):
         disabled_cache.remove(test_username)
 
+    def test_pop(self, disabled_cache):
+        assert disabled_cache.pop(test_username) == SessionEntry()
+
 
 class TestRedisCache:
     @pytest.fixture
     def setup_redis_cache(self):
-        client = MagicMock
-        json = MagicMock
-        set = MagicMock()
-        get = MagicMock(return_value=vars(test_session_entry))
-        delete = MagicMock()
-
-        json.set = set
-        json.get = get
-        json.delete = delete
-        client.json = json
+        client = MagicMock()
+        pipe = client.return_value.pipeline.return_value
+        pipe.execute.return_value = [test_session_entry.to_dict()]
 
         redis_cache = RedisCache(client, {})
-        return (redis_cache, client, json, set, get, delete)
+        return redis_cache, client.return_value, pipe
 
     def test_upsert(self, setup_redis_cache):
-        redis_cache, _, _, set, _, _ = setup_redis_cache
+        redis_cache, _, pipe = setup_redis_cache
+        pipe.execute.return_value = [None]
         redis_cache.upsert(test_username, test_session_entry)
-        set.assert_called_with(
+        pipe.json.return_value.set.assert_called_with(
             name=test_username,
             path=RedisJsonPath.root_path(),
-            obj=vars(test_session_entry),
+            obj=test_session_entry.to_dict(),
             decode_keys=True,
         )
+        pipe.expire.assert_not_called()
+        pipe.delete.assert_not_called()
+        # the previous session is read with the session key watched
+        pipe.watch.assert_called_once_with(test_username)
+        pipe.json.return_value.get.assert_called_with(
+            test_username, ".name_id", ".session_index"
+        )
+        pipe.multi.assert_called_once()
+        pipe.reset.assert_called_once()
 
-    def test_get(self, setup_redis_cache):
-        redis_cache, _, _, _, get, _ = setup_redis_cache
+    def test_upsert_replaces_index(self, setup_redis_cache):
+        redis_cache, _, pipe = setup_redis_cache
+        pipe.execute.side_effect = [
+            [{".name_id": "mynameid", ".session_index": "old"}],
+            WatchError(),
+            [{".name_id": "mynameid", ".session_index": "older"}],
+            [],
+        ]
+        redis_cache.upsert(test_username, test_session_entry)
+
+        # retried after a concurrent write, with the session read again
+        assert pipe.watch.call_count == 2
+        pipe.delete.assert_called_with("jupyterhub_saml_auth:session_index:older")
+        # the name_id index key is rewritten, not deleted
+        assert "jupyterhub_saml_auth:name_id:mynameid" not in {
+            c.args[0] for c in pipe.delete.call_args_list
+        }
+        pipe.set.assert_any_call("jupyterhub_saml_auth:name_id:mynameid", test_username)
+
+    def test_key_prefix(self):
+        redis_cache = RedisCache(MagicMock(), {}, key_prefix="hub1", ttl=60)
+        pipe = redis_cache.client.pipeline.return_value
+        pipe.execute.return_value = [None]
+        redis_cache.upsert(test_username, test_session_entry)
+
+        json_set = pipe.json.return_value.set
+        assert json_set.call_args.kwargs["name"] == "hub1:session:user1"
+        pipe.expire.assert_any_call("hub1:session:user1", 60)
+        pipe.set.assert_any_call("hub1:name_id:mynameid", test_username)
+        pipe.zadd.assert_called_with("hub1:created_at", {test_username: 0})
+
+        redis_cache = RedisCache(MagicMock(), {}, key_prefix="hub1", hash_tag=True)
+        assert redis_cache._key(test_username) == "{hub1}:session:user1"
+        assert redis_cache._created_at_key == "{hub1}:created_at"
+
+    def test_cluster_pipelines(self, caplog):
+        client = MagicMock(return_value=MagicMock(spec=redis.cluster.RedisCluster))
+        pipe = client.return_value.pipeline.return_value
+        pipe.execute.return_value = [None]
+        redis_cache = RedisCache(client, {})
+        assert "cluster without hash_tag" in caplog.text
+        redis_cache.upsert(test_username, test_session_entry)
+        # WATCH and MULTI/EXEC can't span the slots of a cluster
+        redis_cache.client.pipeline.assert_called_with(transaction=False)
+        pipe.watch.assert_not_called()
+        pipe.multi.assert_not_called()
+
+        redis_cache = RedisCache(client, {}, key_prefix="hub1", hash_tag=True)
+        redis_cache.upsert(test_username, test_session_entry)
+        redis_cache.client.pipeline.assert_any_call(transaction=True)
+        pipe.watch.assert_called_once_with("{hub1}:session:user1")
+
+    def test_upsert_ttl(self, setup_redis_cache):
+        redis_cache, _, pipe = setup_redis_cache
+        pipe.execute.return_value = [None]
+        redis_cache.ttl = 60
         redis_cache.upsert(test_username, test_session_entry)
+        pipe.expire.assert_any_call(test_username, 60)
+
+        redis_cache.upsert(
+            test_username, SessionEntry(name_id="mynameid", session_expiration=1010)
+        )
+        pipe.expireat.assert_any_call(test_username, 1010)
+
+    def test_upsert_index(self, setup_redis_cache):
+        redis_cache, _, pipe = setup_redis_cache
+        pipe.execute.return_value = [None]
+        redis_cache.upsert(
+            test_username,
+            SessionEntry(name_id="mynameid", session_index="idx", session_expiration=1010),
+        )
+        pipe.set.assert_any_call("jupyterhub_saml_auth:name_id:mynameid", test_username)
+        pipe.set.assert_any_call("jupyterhub_saml_auth:session_index:idx", test_username)
+        pipe.expireat.assert_any_call("jupyterhub_saml_auth:session_index:idx", 1010)
+
+    def test_find_username(self, setup_redis_cache):
+        redis_cache, client, pipe = setup_redis_cache
+        client.get.return_value = test_username.encode()
+        pipe.execute.return_value = [
+            {".name_id": "mynameid", ".session_index": "sessionindex"}
+        ]
+
+        assert redis_cache.find_username(session_index="sessionindex") == test_username
+        client.get.assert_called_with("jupyterhub_saml_auth:session_index:sessionindex")
+        assert redis_cache.find_username(name_id="mynameid") == test_username
+
+        # the index key outlived the session it was written for
+        assert redis_cache.find_username(session_index="stale") is None
+
+        client.get.return_value = None
+        assert redis_cache.find_username(name_id="unknown") is None
+
+    def test_get(self, setup_redis_cache):
+        redis_cache, _, pipe = setup_redis_cache
         got = redis_cache.get(test_username)
         assert got == test_session_entry
+        pipe.expire.assert_not_called()
+
+        pipe.execute.return_value = [None]
+        assert redis_cache.get(test_username) == SessionEntry()
+
+    def test_get_sliding(self, setup_redis_cache, monkeypatch):
+        monkeypatch.setattr(time, "time", lambda: 1000.0)
+        redis_cache, client, pipe = setup_redis_cache
+        redis_cache.ttl = 60
+        redis_cache.sliding_expiration = True
+
+        redis_cache.get(test_username)
+        pipe.expire.assert_any_call(test_username, 60)
+        pipe.expire.assert_any_call("jupyterhub_saml_auth:name_id:mynameid", 60)
+        pipe.expireat.assert_not_called()
+
+        # never slide past SessionNotOnOrAfter
+        pipe.execute.return_value = [
+            SessionEntry(name_id="mynameid", session_expiration=1010).to_dict(),
+            True,
+        ]
+        redis_cache.get(test_username)
+        pipe.expireat.assert_any_call(test_username, 1010)
+        pipe.expireat.assert_any_call("jupyterhub_saml_auth:name_id:mynameid", 1010)
+
+    def test_serializer(self, setup_redis_cache):
+        redis_cache, _, pipe = setup_redis_cache
+        redis_cache.serializer = serializers.create("json", "zlib", 0)
+        session_entry = SessionEntry(
+            name_id="mynameid",
+            saml_attrs={"attr1": ["attr1_val"]},
+            session_index="sessionindex",
+            session_expiration=1010,
+        )
+        attrs = redis_cache.serializer.dumps(session_entry.saml_attrs)
+
+        pipe.execute.return_value = [[None, None, None, None]]
+        redis_cache.upsert(test_username, session_entry)
+        pipe.hmget.assert_called_with(test_username, RedisCache.id_fields)
+        pipe.delete.assert_called_with(test_username)
+        pipe.hset.assert_called_with(
+            test_username,
+            mapping={
+                "saml_attrs": attrs,
+                "name_id": "mynameid",
+                "session_index": "sessionindex",
+                "session_expiration": 1010,
+            },
+        )
+        pipe.json.return_value.set.assert_not_called()
+
+        pipe.execute.return_value = [
+            {
+                b"saml_attrs": attrs,
+                b"name_id": b"mynameid",
+                b"session_index": b"sessionindex",
+                b"session_expiration": b"1010",
+            }
+        ]
+        assert redis_cache.get(test_username) == session_entry
+
+        pipe.execute.return_value = [{}]
+        assert redis_cache.get(test_username) == SessionEntry()
+
+    def test_serializer_pop_without_attrs(self, setup_redis_cache):
+        redis_cache, _, pipe = setup_redis_cache
+        redis_cache.serializer = serializers.create("json")
+        pipe.execute.return_value = [[b"mynameid", b"sessionindex", None, b"900"]]
+
+        got = redis_cache.pop(test_username, include_attrs=False)
+        assert got == SessionEntry(
+            name_id="mynameid", session_index="sessionindex", created_at=900
+        )
+        pipe.hmget.assert_called_with(test_username, RedisCache.id_fields)
+        pipe.hgetall.assert_not_called()
+        pipe.delete.assert_any_call(test_username)
+
+        pipe.execute.return_value = [[None, None, None, None]]
+        assert redis_cache.pop(test_username, include_attrs=False) == SessionEntry()
+
+    def test_pop_without_attrs(self, setup_redis_cache):
+        redis_cache, _, pipe = setup_redis_cache
+        pipe.execute.return_value = [
+            {".name_id": "mynameid", ".session_index": "sessionindex"}
+        ]
+
+        got = redis_cache.pop(test_username, include_attrs=False)
+        assert got == SessionEntry(name_id="mynameid", session_index="sessionindex")
+        pipe.json.return_value.get.assert_called_with(
+            test_username, ".name_id", ".session_index"
+        )
+
+    def test_upsert_attribute_index(self, setup_redis_cache):
+        redis_cache, _, pipe = setup_redis_cache
+        redis_cache.indexed_attributes = ("memberOf",)
+        pipe.execute.return_value = [None]
+        redis_cache.upsert(
+            test_username,
+            SessionEntry(
+                name_id="mynameid", saml_attrs={"memberOf": ["a", "b"]}, created_at=100
+            ),
+        )
+        pipe.zadd.assert_called_with(
+            "jupyterhub_saml_auth:created_at", {test_username: 100}
+        )
+        pipe.sadd.assert_any_call("jupyterhub_saml_auth:attr:memberOf:a", test_username)
+        pipe.sadd.assert_any_call("jupyterhub_saml_auth:attr:memberOf:b", test_username)
+
+    def test_find_usernames(self, setup_redis_cache):
+        redis_cache, client, pipe = setup_redis_cache
+        redis_cache.indexed_attributes = ("memberOf",)
+        pipe.execute.side_effect = [
+            [{b"user1", b"user2", b"user3"}],
+            [
+                SessionEntry(name_id="user1", saml_attrs={"memberOf": ["a"]}).to_dict(),
+                None,
+                SessionEntry(name_id="user3", saml_attrs={"memberOf": ["b"]}).to_dict(),
+            ],
+        ]
+
+        assert redis_cache.find_usernames("memberOf", "a") == ["user1"]
+        pipe.smembers.assert_called_with("jupyterhub_saml_auth:attr:memberOf:a")
+        # members whose session is gone or no longer has the value are pruned
+        client.srem.assert_called_with(
+            "jupyterhub_saml_auth:attr:memberOf:a", "user2", "user3"
+        )
+
+        with pytest.raises(CacheError):
+            redis_cache.find_usernames("email", "user1@example.com")
+
+    def test_find_usernames_created_before(self, setup_redis_cache):
+        redis_cache, client, pipe = setup_redis_cache
+        pipe.execute.side_effect = [
+            [[b"user1", b"user2"]],
+            [{".name_id": "user1", ".session_index": "1"}, None],
+        ]
+
+        assert redis_cache.find_usernames(created_before=100) == ["user1"]
+        pipe.zrangebyscore.assert_called_with(
+            "jupyterhub_saml_auth:created_at", "-inf", "(100"
+        )
+        # the session of user2 expired, so it is dropped from the sorted set
+        pipe.json.return_value.get.assert_called_with(
+            "user2", ".name_id", ".session_index"
+        )
+        client.zrem.assert_called_once_with("jupyterhub_saml_auth:created_at", "user2")
+
+    def test_remove_many(self, setup_redis_cache):
+        redis_cache, client, pipe = setup_redis_cache
+        redis_cache.serializer = serializers.create("json")
+        pipe.execute.return_value = [
+            [b"mynameid", b"sessionindex", None, None],
+            [None, None, None, None],
+        ]
+
+        assert redis_cache.remove_many(["user1", "user2"]) == ["user1"]
+        pipe.watch.assert_called_once_with("user1", "user2")
+        pipe.delete.assert_any_call("user1")
+        pipe.delete.assert_any_call("user2")
+        pipe.delete.assert_any_call("jupyterhub_saml_auth:name_id:mynameid")
+        pipe.zrem.assert_any_call("jupyterhub_saml_auth:created_at", "user2")
+        pipe.multi.assert_called_once()
+
+    def test_serializer_replaces_json_session(self, setup_redis_cache):
+        redis_cache, _, pipe = setup_redis_cache
+        redis_cache.serializer = serializers.create("json")
+        wrong_type = ResponseError(
+            "WRONGTYPE Operation against a key holding the wrong kind of value"
+        )
+        # a RedisJSON session written before the serializer was set
+        pipe.execute.side_effect = [[wrong_type], []]
+        redis_cache.upsert(test_username, test_session_entry)
+
+        pipe.execute.assert_any_call(raise_on_error=False)
+        pipe.delete.assert_called_with(test_username)
+        pipe.hset.assert_called_once()
+
+        pipe.execute.side_effect = [[wrong_type]]
+        assert redis_cache.get(test_username) == SessionEntry()
+        pipe.execute.side_effect = [[wrong_type], []]
+        assert redis_cache.pop(test_username) == SessionEntry()
+        pipe.delete.assert_called_with(test_username)
+
+        pipe.execute.side_effect = [[ResponseError("NOPERM")]]
+        with pytest.raises(ResponseError):
+            redis_cache.upsert(test_username, test_session_entry)
+
+    def test_serializer_requires_binary_client(self):
+        with pytest.raises(CacheError):
+            RedisCache(MagicMock(), {"decode_responses": True}, serializer="json")
+
+    def test_sliding_requires_ttl(self):
+        with pytest.raises(CacheError):
+            RedisCache(MagicMock(), {}, sliding_expiration=True)
 
     def test_remove(self, setup_redis_cache):
-        redis_cache, _, _, _, _, delete = setup_redis_cache
+        redis_cache, _, pipe = setup_redis_cache
+        pipe.execute.return_value = [None]
         redis_cache.remove(test_username)
-        delete.assert_called_with(test_username, path=RedisJsonPath.root_path())
+        pipe.json.return_value.delete.assert_called_with(
+            test_username, path=RedisJsonPath.root_path()
+        )
+        pipe.multi.assert_called_once()
+
+    def test_pop(self, setup_redis_cache):
+        redis_cache, client, pipe = setup_redis_cache
+
+        assert redis_cache.pop(test_username) == test_session_entry
+        client.pipeline.assert_any_call(transaction=True)
+        pipe.watch.assert_called_once_with(test_username)
+        pipe.json.return_value.get.assert_called_with(
+            test_username, RedisJsonPath.root_path()
+        )
+        pipe.json.return_value.delete.assert_called_with(
+            test_username, path=RedisJsonPath.root_path()
+        )
+        # the index keys are deleted in the same transaction
+        pipe.delete.assert_any_call("jupyterhub_saml_auth:name_id:mynameid")
+        pipe.delete.assert_any_call("jupyterhub_saml_auth:session_index:sessionindex")
+        pipe.multi.assert_called_once()
+        client.delete.assert_not_called()
+
+
+class TestSyncCacheAdapter:
+    def test_in_memory(self):
+        adapted = SyncCacheAdapter(InMemoryCache())
+
+        async def roundtrip():
+            await adapted.upsert(test_username, test_session_entry)
+            got = await adapted.get(test_username)
+            await adapted.remove(test_username)
+            return got, await adapted.get(test_username)
+
+        got, removed = asyncio.run(roundtrip())
+        assert got == test_session_entry
+        assert removed == SessionEntry()
+
+    def test_pop(self):
+        in_memory_cache = InMemoryCache()
+        in_memory_cache.upsert(test_username, test_session_entry)
+        adapted = SyncCacheAdapter(in_memory_cache)
+
+        assert asyncio.run(adapted.pop(test_username)) == test_session_entry
+        assert not in_memory_cache._cache
+
+    def test_find_username(self):
+        in_memory_cache = InMemoryCache()
+        in_memory_cache.upsert(test_username, test_session_entry)
+        adapted = SyncCacheAdapter(in_memory_cache)
+
+        got = asyncio.run(adapted.find_username(session_index="sessionindex"))
+        assert got == test_username
+
+    def test_blocking_runs_in_executor(self):
+        sync_cache = MagicMock(spec=Cache, blocking=True)
+        sync_cache.get.return_value = test_session_entry
+        adapted = SyncCacheAdapter(sync_cache)
+
+        assert asyncio.run(adapted.get(test_username)) == test_session_entry
+        sync_cache.get.assert_called_with(test_username)
+
+
+class TestNamespacedCache:
+    @pytest.fixture
+    def shared_cache(self):
+        in_memory_cache = InMemoryCache(indexed_attributes=["attr1"])
+        in_memory_cache.upsert(test_username, test_session_entry)
+        return in_memory_cache
+
+    def test_keeps_tenants_apart(self, shared_cache):
+        adapted = SyncCacheAdapter(shared_cache)
+        campus_a = NamespacedCache(adapted, "campus-a")
+        campus_b = NamespacedCache(adapted, "campus-b")
+        asyncio.run(campus_a.upsert(test_username, test_session_entry))
+
+        assert set(shared_cache._cache) == {test_username, f"campus-a/{test_username}"}
+        assert asyncio.run(campus_a.get(test_username)) == test_session_entry
+        assert asyncio.run(campus_b.get(test_username)) == SessionEntry()
+
+        assert asyncio.run(campus_a.pop(test_username)) == test_session_entry
+        assert list(shared_cache._cache) == [test_username]
+
+    def test_lookups(self, shared_cache):
+        adapted = SyncCacheAdapter(shared_cache)
+        campus_a = NamespacedCache(adapted, "campus-a")
+        campus_b = NamespacedCache(adapted, "campus-b")
+        session_entry = SessionEntry(
+            name_id="user2", saml_attrs={"attr1": "attr1_val"}, session_index="index2"
+        )
+        asyncio.run(campus_a.upsert("user2", session_entry))
+
+        assert asyncio.run(campus_a.find_username(session_index="index2")) == "user2"
+        assert asyncio.run(campus_b.find_username(session_index="index2")) is None
+        assert asyncio.run(campus_a.find_username(session_index="sessionindex")) is None
+        found = asyncio.run(campus_a.find_usernames("attr1", "attr1_val"))
+        assert found == ["user2"]
+        assert asyncio.run(campus_a.remove_many(["user1", "user2"])) == ["user2"]
+        assert list(shared_cache._cache) == [test_username]
+
+    def test_shared_name_id(self, shared_cache):
+        adapted = SyncCacheAdapter(shared_cache)
+        campus_a = NamespacedCache(adapted, "campus-a")
+        campus_b = NamespacedCache(adapted, "campus-b")
+        asyncio.run(campus_a.upsert("alice", SessionEntry(name_id="nid")))
+        asyncio.run(campus_b.upsert("bob", SessionEntry(name_id="nid")))
+
+        assert asyncio.run(campus_a.find_username(name_id="nid")) == "alice"
+        assert asyncio.run(campus_b.find_username(name_id="nid")) == "bob"
+        assert asyncio.run(campus_a.get("alice")).name_id == "nid"
+        assert shared_cache.get("campus-a/alice").name_id == "campus-a/nid"
+
+
+class TestAsyncRedisCache:
+    @pytest.fixture
+    def setup_async_redis_cache(self):
+        client = MagicMock()
+        instance = client.return_value
+        instance.delete = AsyncMock()
+        instance.get = AsyncMock(return_value=None)
+        pipe = instance.pipeline.return_value
+        pipe.execute = AsyncMock(return_value=[test_session_entry.to_dict()])
+        pipe.watch = AsyncMock()
+        pipe.reset = AsyncMock()
+
+        redis_cache = AsyncRedisCache(client, {"host": "redis"}, ttl=60)
+        return redis_cache, client, pipe
+
+    def test_client_kwargs(self, setup_async_redis_cache):
+        _, client, _ = setup_async_redis_cache
+        kwargs = client.call_args.kwargs
+        assert kwargs["host"] == "redis"
+        assert kwargs["health_check_interval"] == 30
+
+    def test_upsert(self, setup_async_redis_cache):
+        redis_cache, _, pipe = setup_async_redis_cache
+        pipe.execute.return_value = [None]
+        asyncio.run(redis_cache.upsert(test_username, test_session_entry))
+        pipe.json.return_value.set.assert_called_with(
+            name=test_username,
+            path=RedisJsonPath.root_path(),
+            obj=test_session_entry.to_dict(),
+            decode_keys=True,
+        )
+        pipe.expire.assert_any_call(test_username, 60)
+        pipe.expire.assert_any_call("jupyterhub_saml_auth:name_id:mynameid", 60)
+        pipe.watch.assert_awaited_once_with(test_username)
+        pipe.reset.assert_awaited_once()
+
+    def test_get(self, setup_async_redis_cache):
+        redis_cache, _, pipe = setup_async_redis_cache
+        assert asyncio.run(redis_cache.get(test_username)) == test_session_entry
+
+        pipe.execute.return_value = [None]
+        assert asyncio.run(redis_cache.get(test_username)) == SessionEntry()
+
+    def test_remove(self, setup_async_redis_cache):
+        redis_cache, _, pipe = setup_async_redis_cache
+        pipe.execute.return_value = [None]
+        asyncio.run(redis_cache.remove(test_username))
+        pipe.json.return_value.delete.assert_called_with(
+            test_username, path=RedisJsonPath.root_path()
+        )
+        pipe.multi.assert_called_once()
+
+    def test_pop(self, setup_async_redis_cache):
+        redis_cache, client, pipe = setup_async_redis_cache
+
+        assert asyncio.run(redis_cache.pop(test_username)) == test_session_entry
+        pipe.json.return_value.delete.assert_called_with(
+            test_username, path=RedisJsonPath.root_path()
+        )
+        pipe.delete.assert_any_call("jupyterhub_saml_auth:name_id:mynameid")
+        pipe.multi.assert_called_once()
+        client.return_value.delete.assert_not_awaited()
+
+    def test_pop_retries(self, setup_async_redis_cache):
+        redis_cache, _, pipe = setup_async_redis_cache
+        pipe.execute.side_effect = [
+            [test_session_entry.to_dict()],
+            WatchError(),
+            [None],
+            [],
+        ]
+
+        assert asyncio.run(redis_cache.pop(test_username)) == SessionEntry()
+        assert pipe.watch.await_count == 2
+
+    def test_find_username(self, setup_async_redis_cache):
+        redis_cache, client, pipe = setup_async_redis_cache
+        assert asyncio.run(redis_cache.find_username(name_id="mynameid")) is None
+
+        client.return_value.get.return_value = test_username.encode()
+        pipe.execute.return_value = [
+            {".name_id": "mynameid", ".session_index": "sessionindex"}
+        ]
+        got = asyncio.run(redis_cache.find_username(name_id="mynameid"))
+        assert got == test_username
+
+
+class TestTieredCache:
+    @pytest.fixture
+    def setup_tiered_cache(self):
+        client = MagicMock()
+        client.return_value.delete = AsyncMock()
+        pipe = client.return_value.pipeline.return_value
+        pipe.execute = AsyncMock(return_value=[test_session_entry.to_dict()])
+        pipe.watch = AsyncMock()
+        pipe.reset = AsyncMock()
+
+        tiered_cache = TieredCache(client, {})
+        # don't subscribe to a real redis
+        tiered_cache._listener = MagicMock()
+        return tiered_cache, pipe
+
+    def test_get_is_local_after_first_read(self, setup_tiered_cache):
+        tiered_cache, pipe = setup_tiered_cache
+
+        assert asyncio.run(tiered_cache.get(test_username)) == test_session_entry
+        assert asyncio.run(tiered_cache.get(test_username)) == test_session_entry
+        pipe.execute.assert_awaited_once()
+
+    def test_upsert_publishes(self, setup_tiered_cache):
+        tiered_cache, pipe = setup_tiered_cache
+        pipe.execute.return_value = [None]
+        asyncio.run(tiered_cache.upsert(test_username, test_session_entry))
+
+        pipe.publish.assert_called_with(
+            tiered_cache.channel, f"{tiered_cache._origin}:{test_username}"
+        )
+        assert tiered_cache.local.lookup(test_username) == test_session_entry
+
+    def test_local_ttl(self, setup_tiered_cache, monkeypatch):
+        tiered_cache, pipe = setup_tiered_cache
+        monkeypatch.setattr(time, "time", lambda: 1000.0)
+        pipe.execute.return_value = [None]
+        long_session = SessionEntry(name_id="mynameid", session_expiration=29800)
+        asyncio.run(tiered_cache.upsert(test_username, long_session))
+        # local_ttl bounds the local copy although the session lasts 8 hours
+        assert tiered_cache.local._expires_at[test_username] == 1300.0
+
+        short_session = SessionEntry(name_id="mynameid", session_expiration=1100)
+        asyncio.run(tiered_cache.upsert(test_username, short_session))
+        assert tiered_cache.local._expires_at[test_username] == 1100
+
+    def test_channel(self, setup_tiered_cache):
+        tiered_cache, _ = setup_tiered_cache
+        assert tiered_cache.channel == "jupyterhub_saml_auth:invalidate"
+        tiered_cache = TieredCache(MagicMock(), {}, key_prefix="hub1")
+        assert tiered_cache.channel == "hub1:invalidate"
+        tiered_cache = TieredCache(MagicMock(), {}, channel="sessions")
+        assert tiered_cache.channel == "sessions"
+
+    def test_pop(self, setup_tiered_cache):
+        tiered_cache, pipe = setup_tiered_cache
+        tiered_cache.local.upsert(test_username, test_session_entry)
+
+        assert asyncio.run(tiered_cache.pop(test_username)) == test_session_entry
+        assert tiered_cache.local.lookup(test_username) is None
+        pipe.publish.assert_called_once()
+
+    def test_invalidation_message(self, setup_tiered_cache):
+        tiered_cache, _ = setup_tiered_cache
+        tiered_cache.local.upsert(test_username, test_session_entry)
+
+        # own messages are ignored
+        tiered_cache._handle_message(
+            {"type": "message", "data": f"{tiered_cache._origin}:{test_username}"}
+        )
+        assert tiered_cache.local.lookup(test_username) == test_session_entry
+
+        tiered_cache._handle_message(
+            {"type": "message", "data": f"otherprocess:{test_username}".encode()}
+        )
+        assert tiered_cache.local.lookup(test_username) is None
+
+
+class TestAuthStateCache:
+    @pytest.fixture
+    def setup_auth_state_cache(self):
+        user = MagicMock()
+        user.get_auth_state = AsyncMock(return_value=test_session_entry.to_dict())
+        user.save_auth_state = AsyncMock()
+
+        auth_state_cache = AuthStateCache()
+        auth_state_cache.users = {test_username: user}
+        return auth_state_cache, user
+
+    def test_get(self, setup_auth_state_cache):
+        auth_state_cache, user = setup_auth_state_cache
+        assert asyncio.run(auth_state_cache.get(test_username)) == test_session_entry
+        assert asyncio.run(auth_state_cache.get("doesntexist")) == SessionEntry()
+
+        user.get_auth_state.return_value = None
+        assert asyncio.run(auth_state_cache.get(test_username)) == SessionEntry()
+
+    def test_upsert_is_noop(self, setup_auth_state_cache):
+        auth_state_cache, user = setup_auth_state_cache
+        asyncio.run(auth_state_cache.upsert(test_username, test_session_entry))
+        user.save_auth_state.assert_not_called()
+
+    def test_pop(self, setup_auth_state_cache):
+        auth_state_cache, user = setup_auth_state_cache
+        got = asyncio.run(auth_state_cache.pop(test_username, include_attrs=False))
+        assert got == test_session_entry
+        user.save_auth_state.assert_awaited_with(None)
+
+    def test_requires_users(self):
+        with pytest.raises(CacheError):
+            asyncio.run(AuthStateCache().get(test_username))
+
+    def test_find_username(self, setup_auth_state_cache):
+        auth_state_cache, _ = setup_auth_state_cache
+        assert asyncio.run(auth_state_cache.find_username(name_id="mynameid")) is None
+
+
+class TestSQLiteCache:
+    @pytest.fixture
+    def sqlite_cache(self, tmp_path):
+        sqlite_cache = SQLiteCache(path=str(tmp_path / "sessions.sqlite"))
+        yield sqlite_cache
+        sqlite_cache.close()
+
+    def test_wal(self, sqlite_cache):
+        mode = sqlite_cache._connect().execute("PRAGMA journal_mode").fetchone()[0]
+        assert mode == "wal"
+
+    def test_read_your_writes(self, sqlite_cache):
+        sqlite_cache.upsert(test_username, test_session_entry)
+        assert sqlite_cache.get(test_username) == test_session_entry
+
+        sqlite_cache.remove(test_username)
+        assert sqlite_cache.get(test_username) == SessionEntry()
+
+    def test_flush(self, sqlite_cache):
+        sqlite_cache.upsert(test_username, test_session_entry)
+        sqlite_cache.upsert("user2", test_session_entry)
+        sqlite_cache.remove("user2")
+        sqlite_cache.flush()
+
+        assert not sqlite_cache._pending
+        rows = sqlite_cache._connect().execute("SELECT username FROM sessions").fetchall()
+        assert rows == [(test_username,)]
+        assert sqlite_cache.get(test_username) == test_session_entry
+
+    def test_failed_commit(self, sqlite_cache, monkeypatch):
+        monkeypatch.setattr(sqlite_cache, "_upsert", "INSERT INTO missing VALUES (?)")
+        sqlite_cache.upsert(test_username, test_session_entry)
+        sqlite_cache.flush()
+
+        assert not sqlite_cache._pending
+        assert sqlite_cache.get(test_username) == SessionEntry()
+
+    def test_pop(self, sqlite_cache):
+        sqlite_cache.upsert(test_username, test_session_entry)
+        sqlite_cache.flush()
+
+        assert sqlite_cache.pop(test_username) == test_session_entry
+        assert sqlite_cache.pop(test_username) == SessionEntry()
+
+    def test_find_username(self, sqlite_cache):
+        sqlite_cache.upsert(test_username, test_session_entry)
+        assert sqlite_cache.find_username(session_index="sessionindex") == test_username
+
+        sqlite_cache.flush()
+        assert sqlite_cache.find_username(name_id="mynameid") == test_username
+        assert sqlite_cache.find_username(name_id="unknown") is None
+
+        # a queued delete hides the committed row
+        sqlite_cache.remove(test_username)
+        assert sqlite_cache.find_username(name_id="mynameid") is None
+
+    def test_find_usernames(self, tmp_path):
+        sqlite_cache = SQLiteCache(
+            path=str(tmp_path / "sessions.sqlite"), indexed_attributes=["memberOf"]
+        )
+        sqlite_cache.upsert(
+            "user1",
+            SessionEntry(
+                name_id="user1", saml_attrs={"memberOf": ["a"]}, created_at=100
+            ),
+        )
+        sqlite_cache.flush()
+        sqlite_cache.upsert(
+            "user2",
+            SessionEntry(
+                name_id="user2", saml_attrs={"memberOf": ["a"]}, created_at=200
+            ),
+        )
+
+        # one committed, one still queued
+        assert sorted(sqlite_cache.find_usernames("memberOf", "a")) == [
+            "user1",
+            "user2",
+        ]
+        assert sqlite_cache.find_usernames(created_before=150) == ["user1"]
+
+        sqlite_cache.flush()
+        assert sqlite_cache.find_usernames("memberOf", "a", created_before=150) == [
+            "user1"
+        ]
+        with pytest.raises(CacheError):
+            sqlite_cache.find_usernames("email", "user1@example.com")
+
+        assert sqlite_cache.remove_many(["user1", "nobody"]) == ["user1"]
+        sqlite_cache.flush()
+        assert sqlite_cache.find_usernames("memberOf", "a") == ["user2"]
+        sqlite_cache.close()
+
+    def test_survives_restart(self, tmp_path):
+        path = str(tmp_path / "sessions.sqlite")
+        sqlite_cache = SQLiteCache(path=path)
+        sqlite_cache.upsert(test_username, test_session_entry)
+        sqlite_cache.close()
+
+        reopened = SQLiteCache(path=path)
+        assert reopened.get(test_username) == test_session_entry
+        reopened.close()
+
+    def test_ttl(self, sqlite_cache, monkeypatch):
+        now = 1000.0
+        monkeypatch.setattr(time, "time", lambda: now)
+        sqlite_cache.ttl = 60
+        sqlite_cache.upsert(test_username, test_session_entry)
+        sqlite_cache.upsert(
+            "user2", SessionEntry(name_id="mynameid", session_expiration=2000)
+        )
+        sqlite_cache.flush()
+
+        now += 60
+        assert sqlite_cache.get(test_username) == SessionEntry()
+        assert sqlite_cache.get("user2").name_id == "mynameid"
+
+    def test_sweep(self, tmp_path, monkeypatch):
+        sqlite_cache = SQLiteCache(
+            path=str(tmp_path / "sessions.sqlite"), sweep_interval=0.01
+        )
+        sqlite_cache.upsert(
+            test_username, SessionEntry(name_id="mynameid", session_expiration=1)
+        )
+        sqlite_cache.flush()
+        time.sleep(0.05)
+        sqlite_cache.flush()
+
+        rows = sqlite_cache._connect().execute("SELECT username FROM sessions").fetchall()
+        assert rows == []
+        sqlite_cache.close()
 
 
 @pytest.fixture
-def cache_details():
+def cache_details(tmp_path):
     cache_details = []
     for cache_type, cache_cls in cache_map.items():
         cache_spec = {"type": cache_type}
         if cache_cls.client_required:
             cache_spec.update({"client": MagicMock(), "client_kwargs": {}})
+        if cache_cls is SQLiteCache:
+            cache_spec["path"] = str(tmp_path / "sessions.sqlite")
         cache_details.append((cache_type, cache_cls, cache_spec))
 
     return cache_details
@@ -111,6 +1101,13 @@ def test_create(cache_details):
         created_cache = create(cache_spec)
         assert isinstance(created_cache, cache_cls), cache_type
 
+    created_cache = create(
+        {"type": "in-memory", "max_entries": 10, "ttl": 60, "snapshot_path": "sessions"}
+    )
+    assert created_cache.max_entries == 10
+    assert created_cache.ttl == 60
+    assert created_cache.snapshot_path == "sessions"
+
     with pytest.raises(CacheError):
         create({"type": "unspecified"})
 
@@ -144,3 +1141,10 @@ def test_get_success():
     """
     cache = get()
     assert isinstance(cache, Cache)
+
+    assert isinstance(get_async(), SyncCacheAdapter)
+    assert get_async().cache is cache
+
+    namespaced = get_async(namespace="campus-a")
+    assert namespaced.cache is get_async() and namespaced.namespace == "campus-a"
+    assert get_async(namespace="campus-a") is namespaced
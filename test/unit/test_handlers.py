@@ -1,5 +1,28 @@
-from tornado.httputil import HTTPServerRequest
-from jupyterhub_saml_auth.handlers import format_request
+from tornado.httputil import HTTPServerRequest, format_timestamp
+from tornado.web import HTTPError
+from jupyterhub import orm
+from lxml import etree
+from jupyterhub_saml_auth.handlers import (
+    format_request,
+    project_attributes,
+    render_metadata,
+    revoke_hub_logins,
+    ACSHandler,
+    BaseHandlerMixin,
+    MetadataHandler,
+    SamlLoginHandler,
+    SamlSLOHandler,
+    SessionRevocationHandler,
+)
+from jupyterhub_saml_auth import cache, idstore, prefilter, settings, tenants
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+import asyncio
+import base64
+import gzip
+import json
+import threading
+import time
 import pytest
 import os
 
@@ -30,3 +53,512 @@ def test_format_request_https_override(mock_request):
     os.environ['SAML_HTTPS_OVERRIDE'] = 'true'
     res = format_request(mock_request)
     assert res['https'] == 'on'
+
+
+class TestACSHandlerProcessResponse:
+    @pytest.fixture
+    def acs_handler(self):
+        handler = SimpleNamespace(executor=None, max_pending=0)
+        handler.check_pending = lambda: ACSHandler.check_pending(handler)
+        yield handler
+        ACSHandler._pending = 0
+
+    def test_runs_off_event_loop(self, acs_handler):
+        auth = MagicMock()
+        caller = {}
+        auth.process_response.side_effect = lambda request_id: caller.setdefault(
+            "thread", threading.current_thread()
+        )
+
+        asyncio.run(ACSHandler.process_response(acs_handler, auth, "_request1"))
+
+        auth.process_response.assert_called_once_with("_request1")
+        assert caller["thread"] is not threading.current_thread()
+        assert ACSHandler._pending == 0
+
+    def test_rejects_when_overloaded(self, acs_handler):
+        acs_handler.max_pending = 1
+        ACSHandler._pending = 1
+        auth = MagicMock()
+
+        with pytest.raises(HTTPError) as e:
+            asyncio.run(ACSHandler.process_response(acs_handler, auth))
+
+        assert e.value.status_code == 503
+        auth.process_response.assert_not_called()
+
+    def post_overloaded(self, acs_handler, process_response=None):
+        """Post a response to the outstanding AuthnRequest _request1, which the 503
+        leaves outstanding for the retry"""
+        store = idstore.InMemoryIdStore()
+        asyncio.run(store.add("_request1"))
+        header = prefilter.ResponseHeader(in_response_to="_request1")
+        acs_handler.request = HTTPServerRequest(
+            method="POST", uri="/hub/acs", host="hub.example.com"
+        )
+        acs_handler.https_override = False
+        acs_handler.prefilter_response = lambda request: header
+        acs_handler.setup_auth = lambda request: MagicMock()
+        acs_handler.request_store = store
+        acs_handler.allow_unsolicited = False
+        acs_handler.consume_request_id = lambda header: ACSHandler.consume_request_id(
+            acs_handler, header
+        )
+        acs_handler.process_response = process_response
+
+        with pytest.raises(HTTPError) as e:
+            asyncio.run(ACSHandler.post(acs_handler))
+        assert e.value.status_code == 503
+        assert asyncio.run(store.take("_request1"))
+
+    def test_overloaded_keeps_request_id(self, acs_handler):
+        acs_handler.max_pending = 1
+        ACSHandler._pending = 1
+        self.post_overloaded(acs_handler)
+
+    def test_overloaded_meanwhile_keeps_request_id(self, acs_handler):
+        # other responses take the last slot while the ID is consumed
+        async def process_response(auth, request_id):
+            raise HTTPError(503)
+
+        self.post_overloaded(acs_handler, process_response)
+
+
+
+def test_login_records_request_id():
+    auth = MagicMock()
+    auth.login.return_value = "https://idp.example.com/sso?SAMLRequest=..."
+    auth.get_last_request_id.return_value = "_request1"
+    handler = SimpleNamespace(
+        setup_auth=lambda: auth,
+        request=SimpleNamespace(host="hub.example.com"),
+        redirect=MagicMock(),
+        request_store=idstore.InMemoryIdStore(),
+        tenant_router=None,
+    )
+
+    asyncio.run(SamlLoginHandler.get(handler))
+
+    handler.redirect.assert_called_once_with(auth.login.return_value)
+    assert asyncio.run(handler.request_store.take("_request1"))
+
+
+class TestACSHandlerConsumeRequestId:
+    @pytest.fixture
+    def acs_handler(self):
+        store = idstore.InMemoryIdStore()
+        asyncio.run(store.add("_request1"))
+        return SimpleNamespace(request_store=store, allow_unsolicited=True)
+
+    def test_consumes_once(self, acs_handler):
+        header = prefilter.ResponseHeader(in_response_to="_request1")
+        consume = ACSHandler.consume_request_id
+        assert asyncio.run(consume(acs_handler, header)) == "_request1"
+
+        with pytest.raises(HTTPError) as e:
+            asyncio.run(consume(acs_handler, header))
+        assert e.value.status_code == 403
+
+    def test_unsolicited(self, acs_handler):
+        header = prefilter.ResponseHeader()
+        assert asyncio.run(ACSHandler.consume_request_id(acs_handler, header)) is None
+
+        acs_handler.allow_unsolicited = False
+        with pytest.raises(HTTPError) as e:
+            asyncio.run(ACSHandler.consume_request_id(acs_handler, header))
+        assert e.value.status_code == 403
+
+    def test_disabled(self, acs_handler):
+        acs_handler.request_store = None
+        header = prefilter.ResponseHeader(in_response_to="_request1")
+        assert asyncio.run(ACSHandler.consume_request_id(acs_handler, header)) is None
+
+    def test_decoy_comment(self, acs_handler):
+        acs_handler.allow_unsolicited = False
+        xml = (
+            '<!--<samlp:Response InResponseTo="_request1">-->'
+            '<samlp:Response xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" '
+            'ID="_response1"/>'
+        )
+        # what a scan misled by the comment finds
+        header = prefilter.ResponseHeader(in_response_to="_request1")
+        request_id = asyncio.run(ACSHandler.consume_request_id(acs_handler, header))
+
+        # the validated response is unsolicited, whatever the scan found
+        auth = SimpleNamespace(_last_response=etree.fromstring(xml.encode()))
+        with pytest.raises(HTTPError) as e:
+            ACSHandler.check_in_response_to(acs_handler, auth, request_id)
+        assert e.value.status_code == 403
+
+    def test_in_response_to(self, acs_handler):
+        xml = b'<Response InResponseTo="_request1"/>'
+        auth = SimpleNamespace(_last_response=etree.fromstring(xml))
+        ACSHandler.check_in_response_to(acs_handler, auth, "_request1")
+        with pytest.raises(HTTPError):
+            ACSHandler.check_in_response_to(acs_handler, auth, None)
+
+
+class TestACSHandlerPrefilter:
+    @pytest.fixture
+    def acs_handler(self, monkeypatch):
+        saml_settings = MagicMock()
+        saml_settings.get_idp_data.return_value = {"entityId": "https://idp"}
+        saml_settings.is_strict.return_value = True
+        monkeypatch.setattr(settings, "get", lambda path: saml_settings)
+        return SimpleNamespace(
+            settings_path="/etc/saml",
+            response_prefilter=prefilter.Prefilter(),
+            saml_settings=saml_settings,
+        )
+
+    def request(self, xml):
+        saml_response = base64.b64encode(xml.encode()).decode()
+        return {
+            "https": "on",
+            "http_host": "hub.example.com",
+            "script_name": "/hub/acs",
+            "server_port": None,
+            "post_data": {"SAMLResponse": saml_response},
+        }
+
+    def test_accepts(self, acs_handler):
+        request = self.request(
+            '<samlp:Response Destination="https://hub.example.com/hub/acs" '
+            'InResponseTo="_request1"><saml:Issuer>https://idp</saml:Issuer>'
+        )
+        header = ACSHandler.prefilter_response(acs_handler, request)
+        assert header.in_response_to == "_request1"
+
+    def test_rejects(self, acs_handler):
+        request = self.request(
+            '<samlp:Response Destination="https://evil.example.com/acs">'
+        )
+        with pytest.raises(HTTPError) as e:
+            ACSHandler.prefilter_response(acs_handler, request)
+        assert e.value.status_code == 400
+
+    def test_not_strict(self, acs_handler):
+        # e.g. behind a TLS terminating proxy without https_override
+        acs_handler.saml_settings.is_strict.return_value = False
+        request = self.request(
+            '<samlp:Response Destination="https://hub.example.com/hub/acs" '
+            'InResponseTo="_request1"><saml:Issuer>https://other-idp</saml:Issuer>'
+        )
+        request["https"] = "off"
+        header = ACSHandler.prefilter_response(acs_handler, request)
+        assert header.in_response_to == "_request1"
+
+    def test_disabled(self, acs_handler):
+        acs_handler.response_prefilter = None
+        request = self.request('<samlp:Response InResponseTo="_request1">')
+        header = ACSHandler.prefilter_response(acs_handler, request)
+        assert header.in_response_to == "_request1"
+
+        request["post_data"]["SAMLResponse"] = "not base64!"
+        assert ACSHandler.prefilter_response(acs_handler, request).issuer is None
+
+
+settings_path = os.path.join(os.path.dirname(__file__), "..", "..", "etc")
+
+
+def test_render_metadata():
+    saml_settings = settings.load(settings_path)
+    rendered = render_metadata(saml_settings, 1767225600.5)
+
+    assert rendered.errors == []
+    assert b"EntityDescriptor" in rendered.body
+    assert gzip.decompress(rendered.gzipped) == rendered.body
+    assert rendered.etag.startswith('"') and rendered.etag != rendered.gzip_etag
+    assert render_metadata(saml_settings, 0, compress=False).gzipped is None
+
+
+def test_tenant_routing():
+    def handler(path):
+        handler = BaseHandlerMixin()
+        handler.saml_settings_path = settings_path
+        handler.tenant_router = tenants.TenantRouter({"campus-a": "/etc/saml/a"})
+        handler.request = SimpleNamespace(host="hub.example.com", path=path)
+        handler.get_query_argument = lambda name, default: default
+        handler.get_cookie = lambda name: None
+        handler.session_cache = SimpleNamespace(
+            get_async=lambda namespace=None: namespace
+        )
+        return handler
+
+    routed = handler("/hub/saml/campus-a/acs")
+    assert routed.tenant == "campus-a"
+    assert routed.settings_path == "/etc/saml/a"
+    assert routed.session_cache == "campus-a"
+
+    default = handler("/hub/acs")
+    assert default.tenant is None
+    assert default.settings_path == settings_path
+    assert default.session_cache is None
+
+    with pytest.raises(HTTPError) as e:
+        handler("/hub/saml/campus-b/acs").settings_path
+    assert e.value.status_code == 404
+
+
+def test_tenant_username():
+    handler = SimpleNamespace(tenant="campus-a", tenant_username_prefix="{tenant}-")
+    assert ACSHandler.tenant_username(handler, "alice") == "campus-a-alice"
+
+    handler.tenant_username_prefix = ""
+    assert ACSHandler.tenant_username(handler, "alice") == "alice"
+
+    handler.tenant, handler.tenant_username_prefix = None, "{tenant}-"
+    assert ACSHandler.tenant_username(handler, "alice") == "alice"
+
+
+class TestMetadataHandler:
+    @pytest.fixture
+    def metadata_handler(self):
+        handler = SimpleNamespace(
+            settings_path=settings_path,
+            max_age=600,
+            compress=True,
+            request=SimpleNamespace(headers={}),
+            headers={},
+            status=200,
+            body=None,
+        )
+        handler.set_header = handler.headers.__setitem__
+        handler.write = lambda body: setattr(handler, "body", body)
+        handler.set_status = lambda status: setattr(handler, "status", status)
+        handler.rendered_metadata = lambda: MetadataHandler.rendered_metadata(handler)
+        handler.not_modified = lambda *args: MetadataHandler.not_modified(
+            handler, *args
+        )
+        yield handler
+        settings.invalidate()
+        MetadataHandler._rendered.clear()
+
+    def test_rendered_once_per_snapshot(self, metadata_handler):
+        first = metadata_handler.rendered_metadata()
+        assert metadata_handler.rendered_metadata() is first
+
+        settings.invalidate(settings_path)
+        assert metadata_handler.rendered_metadata() is not first
+
+    def test_get(self, metadata_handler):
+        MetadataHandler.get(metadata_handler)
+        rendered = metadata_handler.rendered_metadata()
+
+        assert metadata_handler.body == rendered.body
+        assert metadata_handler.headers["ETag"] == rendered.etag
+        assert metadata_handler.headers["Cache-Control"] == "public, max-age=600"
+        assert "Last-Modified" in metadata_handler.headers
+
+    def test_get_gzip(self, metadata_handler):
+        metadata_handler.request.headers["Accept-Encoding"] = "gzip, deflate"
+        MetadataHandler.get(metadata_handler)
+        rendered = metadata_handler.rendered_metadata()
+
+        assert metadata_handler.body == rendered.gzipped
+        assert metadata_handler.headers["Content-Encoding"] == "gzip"
+        assert metadata_handler.headers["ETag"] == rendered.gzip_etag
+
+    @pytest.mark.parametrize(
+        "headers, status",
+        [
+            ({"If-None-Match": "{etag}"}, 304),
+            ({"If-None-Match": 'W/"other", W/{etag}'}, 304),
+            ({"If-None-Match": '"other"'}, 200),
+            ({"If-Modified-Since": "{last_modified}"}, 304),
+            ({"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"}, 200),
+            ({"If-Modified-Since": "yesterday"}, 200),
+        ],
+    )
+    def test_conditional_get(self, metadata_handler, headers, status):
+        rendered = metadata_handler.rendered_metadata()
+        last_modified = format_timestamp(rendered.last_modified)
+        metadata_handler.request.headers = {
+            name: value.format(etag=rendered.etag, last_modified=last_modified)
+            for name, value in headers.items()
+        }
+
+        MetadataHandler.get(metadata_handler)
+
+        assert metadata_handler.status == status
+        assert (metadata_handler.body is None) == (status == 304)
+
+
+def test_check_replay():
+    handler = SimpleNamespace(replay_store=idstore.InMemoryIdStore())
+    auth = MagicMock()
+    auth.get_last_assertion_id.return_value = "_assertion1"
+    auth.get_last_assertion_not_on_or_after.return_value = int(time.time()) + 300
+
+    asyncio.run(ACSHandler.check_replay(handler, auth))
+    with pytest.raises(HTTPError) as e:
+        asyncio.run(ACSHandler.check_replay(handler, auth))
+    assert e.value.status_code == 403
+
+    # falls back to the response ID when the assertion has none
+    auth.get_last_assertion_id.return_value = None
+    auth.get_last_message_id.return_value = "_response1"
+    asyncio.run(ACSHandler.check_replay(handler, auth))
+
+    handler.replay_store = None
+    asyncio.run(ACSHandler.check_replay(handler, auth))
+
+
+def test_project_attributes():
+    attributes = {
+        "email": ["user1@example.com"],
+        "memberOf": ["group1", "group2", "group3"],
+        "department": ["cse"],
+    }
+
+    assert project_attributes(attributes) == attributes
+    assert project_attributes(attributes, ["email", "memberOf", "missing"]) == {
+        "email": ["user1@example.com"],
+        "memberOf": ["group1", "group2", "group3"],
+    }
+    assert project_attributes(attributes, ["memberOf"], {"memberOf": 2}) == {
+        "memberOf": ["group1", "group2"]
+    }
+    assert project_attributes(attributes, [], {}) == {}
+
+
+logout_request_xml = """<samlp:LogoutRequest
+    xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol"
+    xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion"
+    ID="_logoutrequest" Version="2.0" IssueInstant="2026-01-01T00:00:00Z">
+  <saml:Issuer>https://idp.example.com</saml:Issuer>
+  <saml:NameID>mynameid</saml:NameID>
+  <samlp:SessionIndex>otherindex</samlp:SessionIndex>
+  <samlp:SessionIndex>sessionindex</samlp:SessionIndex>
+</samlp:LogoutRequest>"""
+
+
+@pytest.fixture
+def hub_db():
+    db = orm.new_session_factory("sqlite://")()
+    for client_id in ("jupyterhub", "jupyterhub-user-user1"):
+        db.add(orm.OAuthClient(identifier=client_id))
+    for name in ("user1", "user2"):
+        db.add(orm.User(name=name))
+    db.commit()
+
+    user1 = orm.User.find(db, "user1")
+    orm.APIToken.new(user=user1, client_id="jupyterhub")
+    orm.APIToken.new(user=user1, client_id="jupyterhub-user-user1")
+    return db
+
+
+def test_revoke_hub_logins(hub_db):
+    user1 = orm.User.find(hub_db, "user1")
+    user2 = orm.User.find(hub_db, "user2")
+    cookie_ids = user1.cookie_id, user2.cookie_id
+
+    assert revoke_hub_logins(hub_db, ["user1", "nobody"]) == 1
+    hub_db.expire_all()
+
+    assert user1.cookie_id != cookie_ids[0]
+    assert user2.cookie_id == cookie_ids[1]
+    # tokens the user created are kept
+    assert [token.client_id for token in user1.api_tokens] == ["jupyterhub"]
+
+
+class TestSamlSLOHandler:
+    @pytest.fixture
+    def slo_handler(self, hub_db):
+        in_memory_cache = cache.InMemoryCache()
+        session_entry = cache.SessionEntry(name_id="mynameid", session_index="sessionindex")
+        in_memory_cache.upsert("user1", session_entry)
+        handler = SimpleNamespace(
+            session_cache=cache.SyncCacheAdapter(in_memory_cache), db=hub_db
+        )
+        return handler, in_memory_cache
+
+    def test_find_logout_user(self, slo_handler):
+        handler, _ = slo_handler
+        auth = MagicMock()
+        auth.get_last_request_xml.return_value = logout_request_xml
+        auth.get_settings.return_value.get_sp_key.return_value = None
+
+        username = asyncio.run(SamlSLOHandler.find_logout_user(handler, auth))
+        assert username == "user1"
+
+    def test_revoke_user(self, slo_handler):
+        handler, in_memory_cache = slo_handler
+        user1 = orm.User.find(handler.db, "user1")
+        cookie_id = user1.cookie_id
+
+        asyncio.run(SamlSLOHandler.revoke_user(handler, "user1"))
+
+        handler.db.expire_all()
+        assert user1.cookie_id != cookie_id
+        assert in_memory_cache.find_username(name_id="mynameid") is None
+
+
+class TestSessionRevocationHandler:
+    @pytest.fixture
+    def revocation_handler(self, hub_db, monkeypatch):
+        in_memory_cache = cache.InMemoryCache(indexed_attributes=["memberOf"])
+        in_memory_cache.upsert(
+            "user1",
+            cache.SessionEntry(
+                name_id="user1", saml_attrs={"memberOf": ["course1"]}, created_at=100
+            ),
+        )
+        in_memory_cache.upsert(
+            "user2",
+            cache.SessionEntry(
+                name_id="user2", saml_attrs={"memberOf": ["course2"]}, created_at=900
+            ),
+        )
+        adapted = cache.SyncCacheAdapter(in_memory_cache)
+        monkeypatch.setattr(cache, "get_async", lambda: adapted)
+        monkeypatch.setattr(time, "time", lambda: 1000.0)
+
+        written = []
+        handler = SimpleNamespace(
+            db=hub_db,
+            set_header=MagicMock(),
+            write=written.append,
+            tenant_router=None,
+        )
+        handler.session_caches = lambda: SessionRevocationHandler.session_caches(
+            handler
+        )
+
+        def post(body):
+            handler.get_json_body = lambda: body
+            written.clear()
+            asyncio.run(SessionRevocationHandler.post.__wrapped__(handler))
+            return json.loads(written[0])
+
+        return post, in_memory_cache
+
+    def test_by_attribute(self, revocation_handler):
+        post, in_memory_cache = revocation_handler
+        revoked = post({"attribute": "memberOf", "value": "course1"})
+        assert revoked == {"revoked": ["user1"]}
+        assert list(in_memory_cache._cache) == ["user2"]
+
+    def test_by_age_and_usernames(self, revocation_handler):
+        post, in_memory_cache = revocation_handler
+        assert post({"older_than": 500, "usernames": ["user2"]}) == {"revoked": []}
+        assert post({"older_than": 500}) == {"revoked": ["user1"]}
+
+    def test_by_usernames(self, revocation_handler):
+        post, in_memory_cache = revocation_handler
+        revoked = post({"usernames": ["user1", "user2"]})
+        assert revoked == {"revoked": ["user1", "user2"]}
+        assert not in_memory_cache._cache
+
+    def test_bad_requests(self, revocation_handler):
+        post, _ = revocation_handler
+        for body in (
+            {},
+            {"usernames": "user1"},
+            {"attribute": "memberOf"},
+            {"attribute": "email", "value": "user1@example.com"},
+            {"older_than": "a day"},
+        ):
+            with pytest.raises(HTTPError) as e:
+                post(body)
+            assert e.value.status_code == 400
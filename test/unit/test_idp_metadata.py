@@ -0,0 +1,170 @@
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
+from jupyterhub_saml_auth import idp_metadata, settings
+import asyncio
+import json
+import os
+import shutil
+import pytest
+
+settings_path = os.path.join(os.path.dirname(__file__), "..", "..", "etc")
+
+with open(os.path.join(settings_path, "settings.json")) as f:
+    settings_json = json.load(f)
+
+# the SP key pair stands in for the IdP's
+CERT = OneLogin_Saml2_Utils.format_cert(settings_json["sp"]["x509cert"])
+KEY = OneLogin_Saml2_Utils.format_private_key(settings_json["sp"]["privateKey"])
+
+
+def metadata(entity_id="https://idp2.example.com", valid_until="2100-01-01T00:00:00Z"):
+    return f"""<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"
+    xmlns:ds="http://www.w3.org/2000/09/xmldsig#"
+    entityID="{entity_id}" validUntil="{valid_until}">
+  <md:IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+    <md:KeyDescriptor use="signing"><ds:KeyInfo><ds:X509Data>
+      <ds:X509Certificate>{settings_json["sp"]["x509cert"]}</ds:X509Certificate>
+    </ds:X509Data></ds:KeyInfo></md:KeyDescriptor>
+    <md:SingleSignOnService Location="{entity_id}/sso"
+        Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect"/>
+  </md:IDPSSODescriptor>
+</md:EntityDescriptor>""".encode()
+
+
+@pytest.fixture
+def settings_dir(tmp_path):
+    for f in ("settings.json", "advanced_settings.json"):
+        shutil.copy(os.path.join(settings_path, f), tmp_path / f)
+    yield str(tmp_path)
+    settings.invalidate()
+    settings.clear_idp_metadata()
+
+
+def entity_id(path):
+    return settings.get(path).get_idp_data()["entityId"]
+
+
+def test_parse():
+    parsed = idp_metadata.parse(metadata())
+    assert parsed["idp"]["entityId"] == "https://idp2.example.com"
+    assert parsed["idp"]["singleSignOnService"]["url"] == "https://idp2.example.com/sso"
+
+
+@pytest.mark.parametrize(
+    "xml",
+    [
+        b"not xml",
+        metadata(valid_until="2001-01-01T00:00:00Z"),
+        b'<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"/>',
+    ],
+)
+def test_parse_invalid(xml):
+    with pytest.raises(idp_metadata.IdPMetadataError):
+        idp_metadata.parse(xml)
+
+
+def test_parse_signed():
+    signed = OneLogin_Saml2_Utils.add_sign(metadata(), KEY, CERT)
+    assert idp_metadata.parse(signed, signing_cert=CERT)["idp"]
+
+    for xml in (metadata(), signed.replace(b"idp2.example.com", b"evil.example.com")):
+        with pytest.raises(idp_metadata.IdPMetadataError):
+            idp_metadata.parse(xml, signing_cert=CERT)
+
+
+def test_update_idp_metadata(settings_dir):
+    before = settings.snapshot(settings_dir)
+    settings.update_idp_metadata(settings_dir, idp_metadata.parse(metadata()))
+    assert settings.snapshot(settings_dir) is not before
+    assert entity_id(settings_dir) == "https://idp2.example.com"
+
+    # merged into reloads as well
+    settings.invalidate(settings_dir)
+    assert entity_id(settings_dir) == "https://idp2.example.com"
+    assert settings.get(settings_dir).get_sp_data() == before.settings.get_sp_data()
+
+
+class MetadataStandIn(RequestHandler):
+    def initialize(self, state):
+        self.state = state
+
+    def get(self):
+        self.state["requests"].append(dict(self.request.headers))
+        if self.state["status"] != 200:
+            self.send_error(self.state["status"])
+            return
+
+        etag = f'"{len(self.state["metadata"])}-{self.state["version"]}"'
+        if self.request.headers.get("If-None-Match") == etag:
+            self.set_status(304)
+            return
+        self.set_header("ETag", etag)
+        self.write(self.state["metadata"])
+
+
+def test_fetch_url(settings_dir):
+    state = {"status": 200, "version": 1, "metadata": metadata(), "requests": []}
+
+    async def run():
+        sock, port = bind_unused_port()
+        server = HTTPServer(
+            Application([("/metadata", MetadataStandIn, {"state": state})])
+        )
+        server.add_sockets([sock])
+
+        fetcher = idp_metadata.IdPMetadataFetcher(
+            settings_dir, f"http://127.0.0.1:{port}/metadata", 60
+        )
+        try:
+            assert await fetcher.check()
+            assert entity_id(settings_dir) == "https://idp2.example.com"
+
+            # conditional GET
+            assert not await fetcher.check()
+            assert state["requests"][-1]["If-None-Match"] == '"{}-1"'.format(
+                len(state["metadata"])
+            )
+
+            # the last good copy keeps serving
+            state["status"] = 500
+            assert not await fetcher.check()
+            state["status"] = 200
+            state["version"] = 2
+            state["metadata"] = metadata(valid_until="2001-01-01T00:00:00Z")
+            assert not await fetcher.check()
+            assert entity_id(settings_dir) == "https://idp2.example.com"
+
+            state["version"] = 3
+            state["metadata"] = metadata("https://idp3.example.com")
+            assert await fetcher.check()
+            assert entity_id(settings_dir) == "https://idp3.example.com"
+        finally:
+            server.stop()
+
+    asyncio.run(run())
+
+
+def test_fetch_unreachable(settings_dir):
+    fetcher = idp_metadata.IdPMetadataFetcher(
+        settings_dir, "http://127.0.0.1:1/metadata", 60, timeout=5
+    )
+    assert not asyncio.run(fetcher.check())
+    assert entity_id(settings_dir) == settings_json["idp"]["entityId"]
+
+
+def test_fetch_file(settings_dir, tmp_path):
+    path = tmp_path / "idp-metadata.xml"
+    path.write_bytes(metadata())
+    fetcher = idp_metadata.IdPMetadataFetcher(settings_dir, str(path), 60)
+
+    assert asyncio.run(fetcher.check())
+    assert not asyncio.run(fetcher.check())
+    assert entity_id(settings_dir) == "https://idp2.example.com"
+
+    path.write_bytes(metadata("https://idp3.example.com"))
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert asyncio.run(fetcher.check())
+    assert entity_id(settings_dir) == "https://idp3.example.com"
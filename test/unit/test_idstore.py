@@ -0,0 +1,120 @@
+from jupyterhub_saml_auth import idstore
+from unittest.mock import AsyncMock, MagicMock
+import asyncio
+import pytest
+
+
+@pytest.fixture
+def now(monkeypatch):
+    clock = {"now": 1000.0}
+    monkeypatch.setattr(idstore.time, "time", lambda: clock["now"])
+    return clock
+
+
+class TestInMemoryIdStore:
+    def test_add(self, now):
+        store = idstore.InMemoryIdStore()
+
+        assert asyncio.run(store.add("id1", 1100))
+        assert not asyncio.run(store.add("id1", 1100))
+        assert asyncio.run(store.add("id2"))
+        assert len(store) == 2
+
+    def test_expiry(self, now):
+        store = idstore.InMemoryIdStore(bucket_seconds=60, default_ttl=30)
+        asyncio.run(store.add("id1", 1010))
+        asyncio.run(store.add("id2"))
+        asyncio.run(store.add("id3", 1200))
+
+        # expired, though its bucket isn't complete yet
+        now["now"] = 1015
+        assert asyncio.run(store.add("id1", 1100))
+
+        # the bucket of id2 is complete, id3's bucket isn't
+        now["now"] = 1090
+        assert asyncio.run(store.add("id4", 1300))
+        assert "id2" not in store._ids
+        assert not asyncio.run(store.add("id3", 1200))
+
+    def test_readd_after_expiry(self, now):
+        store = idstore.InMemoryIdStore(bucket_seconds=60)
+        asyncio.run(store.add("id1", 1010))
+        now["now"] = 1020
+        asyncio.run(store.add("id1", 1500))
+
+        # dropping the old bucket keeps the new copy
+        now["now"] = 1200
+        assert not asyncio.run(store.add("id1", 1500))
+
+    def test_take(self, now):
+        store = idstore.InMemoryIdStore(bucket_seconds=60)
+        asyncio.run(store.add("id1", 1100))
+        asyncio.run(store.add("id2", 1010))
+
+        assert asyncio.run(store.take("id1"))
+        assert not asyncio.run(store.take("id1"))
+        assert not asyncio.run(store.take("missing"))
+
+        now["now"] = 1020
+        assert not asyncio.run(store.take("id2"))
+        assert len(store) == 0
+
+    def test_max_entries(self, now):
+        store = idstore.InMemoryIdStore(max_entries=2, bucket_seconds=60)
+        asyncio.run(store.add("id1", 1100))
+        asyncio.run(store.add("id2", 1500))
+        asyncio.run(store.add("id3", 1500))
+
+        # the bucket expiring first was dropped early
+        assert len(store) == 2
+        assert "id1" not in store._ids
+
+
+class TestRedisIdStore:
+    @pytest.fixture
+    def store(self, now):
+        client = MagicMock()
+        client.return_value.set = AsyncMock(return_value=True)
+        return idstore.RedisIdStore(client, {"host": "localhost"}, default_ttl=60)
+
+    def test_add(self, store):
+        assert asyncio.run(store.add("id1", 1100.5))
+        store.client.set.assert_awaited_once_with(
+            "jupyterhub_saml_auth:id:id1", 1, nx=True, px=100500
+        )
+
+    def test_add_existing(self, store):
+        store.client.set.return_value = None
+        assert not asyncio.run(store.add("id1"))
+        store.client.set.assert_awaited_once_with(
+            "jupyterhub_saml_auth:id:id1", 1, nx=True, px=60000
+        )
+
+    def test_take(self, store):
+        store.client.delete = AsyncMock(side_effect=[1, 0])
+        assert asyncio.run(store.take("id1"))
+        assert not asyncio.run(store.take("id1"))
+        store.client.delete.assert_awaited_with("jupyterhub_saml_auth:id:id1")
+
+    def test_add_expired(self, store):
+        asyncio.run(store.add("id1", 900))
+        assert store.client.set.call_args.kwargs["px"] == 1
+
+
+def test_create():
+    assert idstore.create({"type": "disabled"}) is None
+    assert idstore.create(None) is None
+
+    store = idstore.create({"type": "in-memory", "max_entries": 10})
+    assert isinstance(store, idstore.InMemoryIdStore)
+    assert store.max_entries == 10
+
+    client = MagicMock()
+    store = idstore.create(
+        {"type": "redis", "client": client, "client_kwargs": {"port": 6379}}
+    )
+    assert isinstance(store, idstore.RedisIdStore)
+    client.assert_called_once_with(port=6379)
+
+    with pytest.raises(idstore.IdStoreError):
+        idstore.create({"type": "memcached"})
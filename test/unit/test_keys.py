@@ -0,0 +1,83 @@
+from onelogin.saml2.settings import OneLogin_Saml2_Settings
+from onelogin.saml2.utils import OneLogin_Saml2_Utils
+from jupyterhub_saml_auth import keys
+import base64
+import json
+import os
+import pytest
+
+settings_path = os.path.join(os.path.dirname(__file__), "..", "..", "etc")
+
+with open(os.path.join(settings_path, "settings.json")) as f:
+    settings_json = json.load(f)
+
+# the SP certificate stands in for a second IdP certificate, since its key is known
+IDP_CERT = OneLogin_Saml2_Utils.format_cert(settings_json["idp"]["x509cert"])
+SIGNING_CERT = OneLogin_Saml2_Utils.format_cert(settings_json["sp"]["x509cert"])
+SIGNING_KEY = OneLogin_Saml2_Utils.format_private_key(settings_json["sp"]["privateKey"])
+
+
+def make_settings(signing_certs):
+    settings_dict = json.loads(json.dumps(settings_json))
+    settings_dict["idp"]["x509certMulti"] = {"signing": signing_certs}
+    return OneLogin_Saml2_Settings(settings_dict)
+
+
+def signed_response():
+    xml = (
+        '<samlp:Response xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" '
+        'xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="_response1">'
+        "<saml:Issuer>idp</saml:Issuer></samlp:Response>"
+    )
+    signed = OneLogin_Saml2_Utils.add_sign(xml, SIGNING_KEY, SIGNING_CERT)
+    return base64.b64encode(signed).decode()
+
+
+def test_fingerprint():
+    bare = settings_json["idp"]["x509cert"]
+    assert keys.fingerprint(IDP_CERT) == keys.fingerprint(bare)
+    assert keys.fingerprint(IDP_CERT) != keys.fingerprint(SIGNING_CERT)
+    assert keys.fingerprint("not a certificate!") is None
+
+
+def test_key_index():
+    key_index = keys.index(make_settings([IDP_CERT, SIGNING_CERT]))
+    # x509cert is also listed in x509certMulti
+    assert len(key_index) == 2
+
+    trusting = key_index.find([settings_json["sp"]["x509cert"]])
+    assert trusting.get_idp_cert() == SIGNING_CERT
+    assert "x509certMulti" not in trusting.get_idp_data()
+
+    assert key_index.find([]) is None
+    assert key_index.find([IDP_CERT, SIGNING_CERT]) is None
+
+
+def test_index_is_cached():
+    saml_settings = make_settings([IDP_CERT, SIGNING_CERT])
+    assert keys.index(saml_settings) is keys.index(saml_settings)
+
+
+def test_invalid_cert():
+    broken = IDP_CERT.replace("MIID", "MIIE")
+    with pytest.raises(keys.KeyIndexError):
+        keys.KeyIndex(make_settings([broken]))
+
+
+def test_indexed_response():
+    saml_settings = make_settings([IDP_CERT, SIGNING_CERT])
+    response = keys.IndexedResponse(saml_settings, signed_response())
+
+    # only the certificate named in KeyInfo is tried
+    trusted = response._settings.get_idp_data()
+    assert trusted["x509cert"] == SIGNING_CERT
+    assert "x509certMulti" not in trusted
+    assert OneLogin_Saml2_Utils.validate_sign(
+        response.document, response._settings.get_idp_cert(), raise_exceptions=True
+    )
+
+
+def test_indexed_response_single_cert():
+    saml_settings = make_settings([IDP_CERT])
+    response = keys.IndexedResponse(saml_settings, signed_response())
+    assert response._settings is saml_settings
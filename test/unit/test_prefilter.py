@@ -0,0 +1,124 @@
+from jupyterhub_saml_auth import prefilter
+import base64
+import pytest
+
+ACS_URL = "https://hub.example.com/hub/acs"
+IDP = "https://idp.example.com/metadata"
+
+
+def encode_response(attributes, issuer=IDP):
+    xml = (
+        '<?xml version="1.0"?>'
+        '<samlp:Response xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" '
+        f'ID="_response1" {attributes}><saml:Issuer>{issuer}</saml:Issuer>'
+        "<ds:Signature/></samlp:Response>"
+    )
+    return base64.encodebytes(xml.encode()).decode()
+
+
+def test_decode():
+    assert prefilter.decode("PHhtbC8+\n") == b"<xml/>"
+    for saml_response in ("not base64!", "PHhtbC8", "é"):
+        with pytest.raises(prefilter.PrefilterError):
+            prefilter.decode(saml_response)
+
+    xml = b"<samlp:Response>" + b"x" * 1000
+    encoded = base64.encodebytes(xml).decode()
+    head = prefilter.decode(encoded, limit=100)
+    assert 100 <= len(head) < len(xml) and xml.startswith(head)
+    with pytest.raises(prefilter.PrefilterError):
+        prefilter.decode(encoded + "!", limit=100)
+
+
+def test_scan():
+    xml = prefilter.decode(
+        encode_response(
+            f"Destination='{ACS_URL}' InResponseTo=\"_request1\"", "https://a&amp;b"
+        )
+    )
+    assert prefilter.scan(xml) == prefilter.ResponseHeader(
+        ACS_URL, "_request1", "https://a&b"
+    )
+
+    assert prefilter.scan(xml, limit=20) == prefilter.ResponseHeader()
+    assert prefilter.scan(b"<samlp:LogoutResponse ID='_1'>") == (None, None, None)
+
+
+def test_scan_skips_decoys():
+    xml = prefilter.decode(encode_response(""))
+    decoy = (
+        b'<!--<samlp:Response InResponseTo="_request1">'
+        b"<saml:Issuer>https://evil</saml:Issuer>-->"
+    )
+    header = prefilter.scan(xml.replace(b"<samlp:Response", decoy + b"<samlp:Response"))
+    assert header == prefilter.ResponseHeader(issuer=IDP)
+
+    # the Response has to be the root element, and the Issuer its first child
+    nested = b"<Envelope>" + xml.replace(b'<?xml version="1.0"?>', b"")
+    assert prefilter.scan(nested) == prefilter.ResponseHeader()
+    decoy = b"<!--<saml:Issuer>https://evil</saml:Issuer>--><saml:Issuer>"
+    header = prefilter.scan(xml.replace(b"<saml:Issuer>", decoy, 1))
+    assert header.issuer == IDP
+
+
+class TestPrefilter:
+    @pytest.fixture
+    def response_prefilter(self):
+        return prefilter.Prefilter(max_size=4096, rejected_entries=2)
+
+    def check(self, response_prefilter, saml_response):
+        return response_prefilter.check(saml_response, IDP, ACS_URL)
+
+    def test_accepts(self, response_prefilter):
+        header = self.check(
+            response_prefilter, encode_response(f'Destination="{ACS_URL}"')
+        )
+        assert header.destination == ACS_URL
+
+        # Destination is optional, as for python3-saml
+        assert self.check(response_prefilter, encode_response("")).issuer == IDP
+
+    @pytest.mark.parametrize(
+        "saml_response",
+        [
+            None,
+            "",
+            "A" * 4100,
+            "not base64!",
+            encode_response('Destination="https://evil.example.com/hub/acs"'),
+            encode_response('Destination=""'),
+            encode_response("", issuer="https://evil.example.com"),
+        ],
+    )
+    def test_rejects(self, response_prefilter, saml_response):
+        with pytest.raises(prefilter.PrefilterError):
+            self.check(response_prefilter, saml_response)
+
+    def test_not_strict(self, response_prefilter):
+        saml_response = encode_response(
+            'Destination="https://evil.example.com/hub/acs"', issuer="https://other"
+        )
+        header = response_prefilter.check(saml_response, IDP, ACS_URL, strict=False)
+        assert header.issuer == "https://other"
+
+    def test_remembers_rejected(self, response_prefilter, monkeypatch):
+        bad = [encode_response("", issuer=f"https://evil{i}") for i in range(3)]
+        for saml_response in bad:
+            with pytest.raises(prefilter.PrefilterError):
+                self.check(response_prefilter, saml_response)
+
+        def fail(saml_response):
+            raise AssertionError("should not be decoded")
+
+        monkeypatch.setattr(prefilter, "decode", fail)
+        with pytest.raises(prefilter.PrefilterError, match="already rejected"):
+            self.check(response_prefilter, bad[2])
+
+        # only the last rejected_entries responses are kept
+        assert len(response_prefilter._rejected) == 2
+
+    def test_reject(self, response_prefilter):
+        saml_response = encode_response("")
+        response_prefilter.reject(saml_response)
+        with pytest.raises(prefilter.PrefilterError, match="already rejected"):
+            self.check(response_prefilter, saml_response)
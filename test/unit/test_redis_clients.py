@@ -0,0 +1,58 @@
+from unittest.mock import MagicMock
+
+import pytest
+import redis
+import redis.asyncio
+import redis.asyncio.cluster
+
+from jupyterhub_saml_auth import redis_clients
+
+
+def test_create_class():
+    client = MagicMock()
+    redis_clients.create(client, {"port": 6379})
+    client.assert_called_once_with(port=6379)
+
+
+def test_create_redis():
+    client = redis_clients.create(None, {"max_connections": 20}, retries=5)
+    assert isinstance(client, redis.Redis)
+    assert client.connection_pool.max_connections == 20
+    assert client.get_retry()._retries == 5
+
+    client = redis_clients.create("redis", {}, use_asyncio=True)
+    assert isinstance(client, redis.asyncio.Redis)
+    assert not redis_clients.is_cluster(client)
+
+
+def test_create_cluster():
+    client = redis_clients.create(
+        "cluster", {"startup_nodes": [["redis-1", 7000]]}, use_asyncio=True
+    )
+    assert isinstance(client, redis.asyncio.cluster.RedisCluster)
+    assert redis_clients.is_cluster(client)
+    assert [node.name for node in client.startup_nodes] == ["redis-1:7000"]
+
+
+def test_create_sentinel():
+    client = redis_clients.create(
+        "sentinel",
+        {
+            "sentinels": [["sentinel-1", 26379], ["sentinel-2", 26379]],
+            "service_name": "sessions",
+            "max_connections": 20,
+        },
+        use_asyncio=True,
+    )
+    assert isinstance(client, redis.asyncio.Redis)
+    assert client.connection_pool.service_name == "sessions"
+    assert client.connection_pool.max_connections == 20
+    assert len(client.connection_pool.sentinel_manager.sentinels) == 2
+
+    with pytest.raises(redis_clients.RedisClientError):
+        redis_clients.create("sentinel", {"sentinels": [["sentinel-1", 26379]]})
+
+
+def test_create_unknown():
+    with pytest.raises(redis_clients.RedisClientError):
+        redis_clients.create("memcached", {})
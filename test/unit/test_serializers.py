@@ -0,0 +1,47 @@
+import pytest
+from jupyterhub_saml_auth.serializers import *
+
+test_obj = {
+    "name_id": "mynameid",
+    "saml_attrs": {"memberOf": [f"group{i}" for i in range(100)]},
+    "session_index": "sessionindex",
+    "session_expiration": None,
+}
+
+
+@pytest.mark.parametrize("name", serializer_map.keys())
+def test_roundtrip(name):
+    if name == "msgpack":
+        pytest.importorskip("msgpack")
+    serializer = create(name)
+    assert serializer.loads(serializer.dumps(test_obj)) == test_obj
+
+
+@pytest.mark.parametrize("codec", ["zlib", "zstd"])
+def test_compression(codec):
+    if codec == "zstd":
+        pytest.importorskip("zstandard")
+    serializer = create("json", codec, compression_threshold=64)
+    raw = create("json").dumps(test_obj)
+
+    payload = serializer.dumps(test_obj)
+    assert len(payload) < len(raw)
+    assert serializer.loads(payload) == test_obj
+
+    small = {"name_id": "mynameid"}
+    payload = serializer.dumps(small)
+    assert payload[:1] == CompressedSerializer.RAW
+    assert serializer.loads(payload) == small
+
+
+def test_create_fail():
+    with pytest.raises(SerializerError):
+        create("unknown")
+
+    with pytest.raises(SerializerError):
+        create("json", "unknown")
+
+
+def test_compression_reads_uncompressed():
+    serializer = create("json", "zlib")
+    assert serializer.loads(create("json").dumps(test_obj)) == test_obj
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import shutil
+import os
+import pytest
+from onelogin.saml2.settings import OneLogin_Saml2_Settings
+from jupyterhub_saml_auth import settings
+
+settings_path = os.path.join(os.path.dirname(__file__), "..", "..", "etc")
+
+
+@pytest.fixture(autouse=True)
+def clear_settings_cache():
+    settings.invalidate()
+    yield
+    settings.invalidate()
+
+
+def test_load():
+    loaded = settings.load(settings_path)
+    assert isinstance(loaded, OneLogin_Saml2_Settings)
+    assert loaded.get_sp_key()
+    assert loaded.get_idp_cert()
+
+
+def test_load_fail(tmp_path):
+    with pytest.raises(settings.SettingsError):
+        settings.load(str(tmp_path))
+
+
+def test_load_invalid_cert(tmp_path):
+    with open(os.path.join(settings_path, "settings.json")) as f:
+        settings_json = json.load(f)
+    settings_json["idp"]["x509cert"] = settings_json["idp"]["x509cert"][:-40]
+    (tmp_path / "settings.json").write_text(json.dumps(settings_json))
+    shutil.copy(os.path.join(settings_path, "advanced_settings.json"), tmp_path)
+
+    with pytest.raises(settings.SettingsError):
+        settings.load(str(tmp_path))
+
+
+def test_get_is_cached():
+    first = settings.get(settings_path)
+    assert settings.get(settings_path) is first
+
+
+def test_invalidate():
+    first = settings.get(settings_path)
+    settings.invalidate(settings_path)
+    assert settings.get(settings_path) is not first
+
+    second = settings.get(settings_path)
+    settings.invalidate()
+    assert settings.get(settings_path) is not second
+
+
+@pytest.fixture
+def settings_dir(tmp_path):
+    for f in ("settings.json", "advanced_settings.json"):
+        shutil.copy(os.path.join(settings_path, f), tmp_path / f)
+    return tmp_path
+
+
+def touch(path, content):
+    path.write_text(content)
+    # make sure the change is visible even on filesystems with coarse mtimes
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_watcher_reloads(settings_dir):
+    path = str(settings_dir)
+    first = settings.get(path)
+    watcher = settings.SettingsWatcher(path, 1)
+
+    assert not asyncio.run(watcher.check())
+    assert settings.get(path) is first
+
+    advanced = json.loads((settings_dir / "advanced_settings.json").read_text())
+    advanced["security"]["wantAssertionsSigned"] = True
+    touch(settings_dir / "advanced_settings.json", json.dumps(advanced))
+
+    assert asyncio.run(watcher.check())
+    reloaded = settings.get(path)
+    assert reloaded is not first
+    assert reloaded.get_security_data()["wantAssertionsSigned"]
+
+
+def test_watcher_keeps_last_good(settings_dir):
+    path = str(settings_dir)
+    first = settings.get(path)
+    watcher = settings.SettingsWatcher(path, 1)
+
+    touch(settings_dir / "settings.json", "{not json")
+
+    assert not asyncio.run(watcher.check())
+    assert settings.get(path) is first
+
+
+def test_watcher_waits_for_first_use(settings_dir):
+    path = str(settings_dir)
+    watcher = settings.SettingsWatcher(path, 1)
+
+    assert not asyncio.run(watcher.check())
+    assert not settings.loaded(path)
+
+    settings.get(path)
+    assert settings.loaded(path)
+    assert not asyncio.run(watcher.check())
+
+
+def test_watcher_survives_failed_first_load(settings_dir, monkeypatch):
+    path = str(settings_dir)
+    settings.get(path)
+    watcher = settings.SettingsWatcher(path, 1)
+
+    def broken(path):
+        raise settings.SettingsError("half written settings.json")
+
+    monkeypatch.setattr(settings, "snapshot", broken)
+    assert not asyncio.run(watcher.check())
+    assert watcher._last_seen is None
@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+
+from jupyterhub_saml_auth.tenants import TenantError, TenantRouter
+
+
+@pytest.fixture
+def router():
+    return TenantRouter(
+        {"campus-a": "/etc/saml/campus-a", "campus-b": "/etc/saml/campus-b"},
+        hosts={"Hub.Campus-B.edu": "campus-b"},
+    )
+
+
+def handler(host="hub.example.com", path="/hub/saml_login", query=None, cookie=None):
+    return SimpleNamespace(
+        request=SimpleNamespace(host=host, path=path),
+        get_query_argument=lambda name, default: (query or {}).get(name, default),
+        get_cookie=lambda name: cookie,
+        set_cookie=MagicMock(),
+        clear_cookie=MagicMock(),
+    )
+
+
+def test_invalid_configuration():
+    with pytest.raises(TenantError):
+        TenantRouter({"campus:a": "/etc/saml/campus-a"})
+    with pytest.raises(TenantError):
+        TenantRouter({"campus-a": "/etc/saml/campus-a"}, hosts={"hub": "campus-c"})
+
+
+def test_resolve(router):
+    assert router.resolve(handler(host="hub.campus-b.edu:443")) == "campus-b"
+    assert router.resolve(handler(path="/hub/saml/campus-a/acs")) == "campus-a"
+    assert router.resolve(handler(query={"idp": "campus-b"})) == "campus-b"
+    assert router.resolve(handler(path="/hub/acs", cookie="campus-a")) == "campus-a"
+    assert router.resolve(handler(path="/hub/logout", cookie="campus-a")) == "campus-a"
+    # the host wins over the path
+    host_and_path = handler(host="hub.campus-b.edu", path="/hub/saml/campus-a/acs")
+    assert router.resolve(host_and_path) == "campus-b"
+
+    assert router.resolve(handler()) is None
+    assert router.resolve(handler(path="/hub/acs", cookie="removed-tenant")) is None
+    assert router.resolve(handler(path="/hub/api/saml/sessions/revoke")) is None
+
+
+def test_resolve_unknown(router):
+    with pytest.raises(TenantError):
+        router.resolve(handler(path="/hub/saml/campus-c/acs"))
+    with pytest.raises(TenantError):
+        router.resolve(handler(query={"idp": "campus-c"}))
+
+
+def test_remember(router):
+    login = handler()
+    router.remember(login, "campus-a", secure=True)
+    login.set_cookie.assert_called_once_with(
+        "jupyterhub-saml-tenant",
+        "campus-a",
+        httponly=True,
+        secure=True,
+        samesite="None",
+    )
+
+    remembered = handler(cookie="campus-a")
+    router.remember(remembered, "campus-a", secure=True)
+    remembered.set_cookie.assert_not_called()
+    remembered.clear_cookie.assert_not_called()
+
+
+def test_default_login_after_tenant_login(router):
+    # /saml_login and /metadata don't follow the remembered tenant
+    login = handler(path="/hub/saml_login", cookie="campus-a")
+    assert router.resolve(login) is None
+    assert router.resolve(handler(path="/hub/metadata", cookie="campus-a")) is None
+
+    # and logging in with the default IdP forgets it, so its response goes there too
+    router.remember(login, None, secure=True)
+    login.clear_cookie.assert_called_once_with("jupyterhub-saml-tenant")
+    login.set_cookie.assert_not_called()
+    no_cookie = handler()
+    router.remember(no_cookie, None, secure=True)
+    no_cookie.clear_cookie.assert_not_called()
+
+
+def test_namespaced(router):
+    assert router.namespaced("campus-a/user1")
+    assert not router.namespaced("user1")
+    # hub usernames may contain ":"
+    assert not router.namespaced("campus-a:user1")
+    assert not router.namespaced("campus-c/user1")